@@ -10,18 +10,18 @@ dotenv.load_dotenv()
 
 #os.environ["LANGCHAIN_PROJECT"] = "thegrid"
 
-def run(type:str):
+def run(type:str, delta:bool=False):
     client_id = "agent1"
     server_url = 'http://localhost:5666'
     print(f"Starting agent {client_id}")
 
     # Create and start the agent.
     if type == "llm":
-        agent = LlmAgent(client_id, server_url)
+        agent = LlmAgent(client_id, server_url, delta=delta)
     elif type == "simplellm":
-        agent = SimpleLlmAgent(client_id, server_url)
+        agent = SimpleLlmAgent(client_id, server_url, delta=delta)
     elif type == "coded":
-        agent = CodedAgent(client_id, server_url)
+        agent = CodedAgent(client_id, server_url, delta=delta)
     else:
         raise ValueError(f"Unknown agent type: {type}")
     agent.start()
@@ -6,8 +6,14 @@ from .socketagent import SocketAgent
 
 class CodedAgent(SocketAgent):
 
-    def __init__(self, client_id, server_url):
-        super().__init__(client_id, server_url)
+    # The known positions are kept between messages, so only the changed cells have to be processed.
+    handles_deltas = True
+
+    def __init__(self, client_id, server_url, delta=False):
+        super().__init__(client_id, server_url, delta=delta)
+        self.__gold_positions = {}
+        self.__obstacle_positions = set()
+        self.__trove_position = None
 
 
     def _handle_message(self, data):
@@ -19,8 +25,12 @@ class CodedAgent(SocketAgent):
         # Get the current inventory of the agent.
         inventory = data["observations"]["inventory"]
 
-        self.__gold_positions = []
-        self.__obstacle_positions = []
+        # Forget the known positions, unless the message is a delta on top of the previous messages.
+        # The gold positions are a dictionary to keep the order in which they were seen.
+        if not data.get("delta", False) or data["keyframe"]:
+            self.__gold_positions = {}
+            self.__obstacle_positions = set()
+            self.__trove_position = None
 
         # Update the gold_positions and obstacle_positions.
         for cell in data["observations"]["cells"]:
@@ -29,29 +39,26 @@ class CodedAgent(SocketAgent):
             elements = cell["elements"]
             coordinates = (x, y)
 
-            # Delete the coordinates from the list of gold_positions and obstacle_positions if they are present.
+            # Delete the coordinates from the gold_positions and obstacle_positions if they are present.
+            self.__gold_positions.pop(coordinates, None)
+            self.__obstacle_positions.discard(coordinates)
             if elements == "empty":
-                if coordinates in self.__gold_positions:
-                    self.__gold_positions.remove(coordinates)
-                if coordinates in self.__obstacle_positions:
-                    self.__obstacle_positions.remove(coordinates)
                 continue
 
             # Now it is a list.
             for element in elements:
                 if element == "wall":
-                    self.__obstacle_positions.append((x, y))
+                    self.__obstacle_positions.add((x, y))
                 elif element == "gold":
-                    self.__gold_positions.append((x, y))
+                    self.__gold_positions[(x, y)] = True
                 elif element == "trove":
-                    trove_x = x
-                    trove_y = y
+                    self.__trove_position = (x, y)
                 else:
                     raise Exception(f"Unknown element: {element}")
                 
 
         # Handle the case when there is no gold on the map and the agent has no gold in the inventory.
-        if self.__gold_positions == [] and inventory == []:
+        if len(self.__gold_positions) == 0 and inventory == []:
             print(f"{self.client_id}: No gold on the map.")
             response = {"action": "none"}
             return response
@@ -98,6 +105,7 @@ class CodedAgent(SocketAgent):
 
         # Find the shortest route to the trove.
         elif inventory == ["gold"]:
+            trove_x, trove_y = self.__trove_position
 
             if (me_x, me_y) == (trove_x, trove_y):
                 print(f"{self.client_id}: Dropping gold at {me_x}, {me_y}.")
@@ -35,8 +35,8 @@ class AgentGraphState(TypedDict):
 
 class SimpleLlmAgent(SocketAgent):
 
-    def __init__(self, client_id, server_url):
-        super().__init__(client_id, server_url)
+    def __init__(self, client_id, server_url, delta=False):
+        super().__init__(client_id, server_url, delta=delta)
 
         # Set up the llm.
         self.__temperature = 0.4
@@ -1,13 +1,28 @@
+import sys
 import socketio
 
+# The bitplane observations are decoded with the module of the simulation. It is imported with the first planes,
+# so that the other agents do not need numpy.
+sys.path.append("..")
+
 
 class SocketAgent:
 
-    def __init__(self, client_id, server_url):
+    # Set to True in subclasses that process delta messages themselves. The other agents receive the full
+    # observations, which are reconstructed from the deltas.
+    handles_deltas = False
+
+    def __init__(self, client_id, server_url, delta=False, keyframe_interval=100):
         self.client_id = client_id
         self.server_url = server_url
+        self.delta = delta
+        self.keyframe_interval = keyframe_interval
         self.sio = socketio.Client()
 
+        # The cells and exits that are known from the delta messages.
+        self.__cells = {}
+        self.__exits = []
+
         # Register event handlers
         self.sio.on('connect', self.__on_connect)
         self.sio.on('disconnect', self.__on_disconnect)
@@ -23,8 +38,66 @@ class SocketAgent:
 
     def __on_message(self, data):
         #print(f"{self.client_id}: Received message: {data['observations']}")
+        if "planes" in data["observations"]:
+            from simulation.source import bitplanes
+            data["observations"] = bitplanes.decode(data["observations"])
+        elif data.get("delta", False):
+            data = self.__apply_delta(data)
         response = self._handle_message(data)
-        self.sio.emit('response', {'id': self.client_id, 'response': response})
+        self.sio.emit('response', {'id': self.client_id, 'response': response, 'step': data["observations"].get("step")})
+
+
+    def __apply_delta(self, data):
+        observations = data["observations"]
+
+        # Update the known cells and forget the ones that are no longer observed. In the fov memory mode the
+        # remembered cells keep the step in which they were seen, their staleness grows with the step.
+        step = observations["step"]
+        if data["keyframe"]:
+            self.__cells = {}
+            self.__exits = observations["exits"]
+        for x, y in observations.get("removed_cells", []):
+            self.__cells.pop((x, y), None)
+        for cell in observations["cells"]:
+            seen_step = None
+            if "staleness" in cell:
+                seen_step = "visible" if cell["staleness"] == 0 else step - cell["staleness"]
+            self.__cells[(cell["x"], cell["y"])] = (cell["elements"], seen_step)
+
+        if self.handles_deltas:
+            return data
+
+        # Reconstruct the full observations with the relative positions for the current position.
+        me_x = observations["me"]["x"]
+        me_y = observations["me"]["y"]
+        cells = []
+        for (x, y), (elements, seen_step) in self.__cells.items():
+            cell = {
+                "x": x,
+                "y": y,
+                "x_relative": x - me_x,
+                "y_relative": y - me_y,
+                "elements": elements,
+            }
+            if seen_step is not None:
+                cell["staleness"] = 0 if seen_step == "visible" else step - seen_step
+            cells.append(cell)
+        exits = []
+        for exit in self.__exits:
+            exits.append({
+                "x": exit["x"],
+                "y": exit["y"],
+                "x_relative": exit["x"] - me_x,
+                "y_relative": exit["y"] - me_y,
+            })
+        full_observations = {
+            "me": observations["me"],
+            "exits": exits,
+            "step": observations["step"],
+            "inventory": observations["inventory"],
+            "cells": cells,
+        }
+        return {"observations": full_observations, "id": data["id"]}
 
 
     def _handle_message(self, data):
@@ -32,6 +105,10 @@ class SocketAgent:
 
 
     def start(self, wait=True):
-        self.sio.connect(self.server_url, headers={'id': self.client_id})
+        headers = {'id': self.client_id}
+        if self.delta:
+            headers['observation-protocol'] = 'delta'
+            headers['keyframe-interval'] = str(self.keyframe_interval)
+        self.sio.connect(self.server_url, headers=headers)
         if wait:
             self.sio.wait()
@@ -0,0 +1,19 @@
+import json
+import fire
+from source.levelcompiler import CompiledLevel
+
+
+def run(config:str, output:str):
+    # Convert the custom layout of a simulation config to a binary level.
+    with open(config) as f:
+        config = json.load(f)
+    if config["grid"]["type"] != "custom":
+        raise ValueError("Only custom layouts can be converted to binary levels")
+    level = CompiledLevel.compile(config["grid"]["layout"][::-1], config.get("exits", {}), config.get("triggers", []))
+    level.save(output)
+    print(f"Wrote {level.cells.shape[1]}x{level.cells.shape[0]} level with {len(level.entity_types)} entities and {len(level.agent_x)} agent positions to {output}")
+    print(f"Use it with \"grid\": {{\"type\": \"binary\", \"path\": \"{output}\"}}")
+
+
+if __name__ == '__main__':
+    fire.Fire(run)
@@ -1,18 +1,35 @@
 from flask import Flask, request, jsonify, render_template, send_from_directory
 from flask_socketio import SocketIO, emit
+import socketio
 import threading
+import asyncio
 import os
+import sys
 import json
+import time
+import argparse
+import importlib.util
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from jinja2 import Environment, FileSystemLoader
 from source.simulation import Simulation
+from source.replay import ReplayRecorder
+from source.checkpointer import Checkpointer
+from source.tickscheduler import TickScheduler
+from source.deltaencoder import DeltaEncoder
+from source import bitplanes
+from source.policyloader import create_policy
+
+# In-process policies are loaded from the root of the repository, for example "agents.source.codedagent:CodedAgent".
+sys.path.append("..")
 
 class Server:
     
-    def __init__(self, simulation_config_path, secret_key='secret!'):
-        self.app = Flask(__name__)
-        self.app.config['SECRET_KEY'] = secret_key
-        self.socketio = SocketIO(self.app)
+    def __init__(self, simulation_config_path, secret_key='secret!', replay_dir=None, checkpoint_dir=None, checkpoint_interval=10.0, resume=False, tick_mode=None):
         self.clients = {}
-        self.sleep_time = 0.1
+
+        # The delta encoders of the clients that use the delta observation protocol.
+        self.delta_encoders = {}
 
         # Statistics.
         self.durations = []
@@ -25,6 +42,40 @@ class Server:
             self.simulation_config = json.load(f)
         self.simulation = Simulation(self.simulation_config)
 
+        # Decides when to step, at a fixed rate or when the clients have responded. Measures their response latencies.
+        self.scheduler = TickScheduler.from_config(self.simulation_config, tick_mode)
+
+        # Write checkpoints periodically if there is a checkpoint directory. Resume from the latest one if requested.
+        self.checkpointer = None
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_interval = checkpoint_interval
+        self.last_checkpoint_time = time.monotonic()
+        if resume:
+            if checkpoint_dir is None:
+                raise ValueError("Resuming requires a checkpoint directory")
+            static_config, state = Checkpointer.load_latest(checkpoint_dir)
+            self.simulation = Simulation(static_config)
+            self.simulation.restore(state)
+            print(f"Resumed from checkpoint at step {self.simulation.get_step()}")
+        if checkpoint_dir is not None:
+            self.checkpointer = Checkpointer(checkpoint_dir)
+
+        # Record each simulation run if there is a replay directory.
+        self.replay_dir = replay_dir
+        self.recorder = None
+        self.start_recording()
+
+        # The agents with a policy in the config run in-process. The others connect as socket clients.
+        self.local_policies = {}
+        self.create_local_policies()
+
+        self.create_transport(secret_key)
+
+    def create_transport(self, secret_key):
+        self.app = Flask(__name__)
+        self.app.config['SECRET_KEY'] = secret_key
+        self.socketio = SocketIO(self.app)
+
         # Register routes and event handlers
         self.app.route('/')(self.index)
         self.app.route('/static/<path:filename>', methods=['GET'])(self.serve_static_file)
@@ -37,6 +88,9 @@ class Server:
         return render_template('index.html')
 
     def get_renderer_data(self):
+        return jsonify(self.collect_renderer_data())
+
+    def collect_renderer_data(self):
         # Get the render data.
         renderer_data = self.simulation.get_renderer_data()
 
@@ -44,9 +98,10 @@ class Server:
         renderer_data["statistics"] = {
             "current_step": self.simulation.simulation_step,
             "average_duration": f"{self.average_duration:.2f}",
+            "tick": self.scheduler.get_stats(),
         }
 
-        return jsonify(renderer_data)
+        return renderer_data
     
     def serve_static_file(self, filename):
         return send_from_directory('static', filename)
@@ -55,50 +110,331 @@ class Server:
         # Get the client id from the request headers.
         client_id = request.headers.get("id")
         assert client_id is not None, f"Client ID not provided in arguments {request.args} {request}"
-        self.clients[client_id] = request.sid
-        print(f"Client {client_id} connected")
+        return self.add_client(client_id, request.sid, request.headers.get("observation-protocol"), request.headers.get("keyframe-interval", 100))
 
     def handle_disconnect(self):
+        self.remove_client(request.sid)
+
+    def handle_response(self, data):
+        print(f"Received response from {data['id']}: {data['response']}")
+        self.add_response(data)
+
+    def add_client(self, client_id, sid, observation_protocol=None, keyframe_interval=100):
+        if client_id in self.local_policies:
+            print(f"Client {client_id} rejected, the agent runs in-process")
+            return False
+        self.clients[client_id] = sid
+
+        # Use the delta observation protocol if the client asks for it.
+        if observation_protocol == "delta":
+            self.delta_encoders[client_id] = DeltaEncoder(int(keyframe_interval))
+        else:
+            self.delta_encoders.pop(client_id, None)
+        print(f"Client {client_id} connected")
+        return True
+
+    def remove_client(self, sid):
+        # Returns the id of the client with the session id, if there is one.
         client_id = None
-        for cid, sid in self.clients.items():
-            if sid == request.sid:
+        for cid, client_sid in self.clients.items():
+            if client_sid == sid:
                 client_id = cid
                 break
         if client_id:
             del self.clients[client_id]
+            self.delta_encoders.pop(client_id, None)
+            self.scheduler.remove_agent(client_id)
             print(f"Client {client_id} disconnected")
+        return client_id
 
-    def handle_response(self, data):
-        print(f"Received response from {data['id']}: {data['response']}")
-        self.simulation.add_action(data['id'], data['response'])
+    def add_response(self, data):
+        # The clients send the step of the observations they respond to. The action targets the next step.
+        target_step = data["step"] + 1 if data.get("step") is not None else None
+        self.simulation.add_action(data['id'], data['response'], target_step)
+        self.scheduler.on_response(data['id'], data.get("step"))
+
+    def add_default_actions(self, missed):
+        # The clients that missed the deadline get the default action.
+        for client_id in missed:
+            print(f"Client {client_id} missed the deadline")
+            if self.scheduler.default_action is not None:
+                self.simulation.add_action(client_id, dict(self.scheduler.default_action))
 
     def main_loop(self):
+        # One long-lived loop. The scheduler waits for the next tick.
+        while True:
+            self.tick()
+            self.add_default_actions(self.scheduler.wait(self.socketio.sleep))
+
+    def tick(self):
+        messages, phases = self.prepare_messages()
+
+        # Start the tick before the messages go out, a client can respond before the last one is sent.
+        self.scheduler.start_tick([client_id for client_id, _, _ in messages], self.simulation.world_snapshot_step)
+
+        # Send a message to each client
+        print(f"Sending messages to clients {self.clients}")
+        emit_start = time.perf_counter()
+        for client_id, sid, message in messages:
+            self.socketio.emit("message", message, room=sid)
+        phases["emit"] = time.perf_counter() - emit_start
+        self.scheduler.record_phases(phases)
+
+    def prepare_messages(self):
+        # Steps the simulation and returns the messages for the clients, with their ids and session ids,
+        # and the durations of the phases.
 
         if self.simulation.is_finished():
             self.durations.append(self.simulation.simulation_step)
             self.average_duration = sum(self.durations) / len(self.durations)
             self.simulation = Simulation(self.simulation.config)
+            self.start_recording()
+            self.create_local_policies()
+
+            # The checkpoints of the old simulation are written before the ones of the new simulation.
+            if self.checkpointer is not None:
+                self.checkpointer.close()
+                self.checkpointer = Checkpointer(self.checkpoint_dir)
+
+            # The clients have to receive a keyframe of the new simulation.
+            for delta_encoder in self.delta_encoders.values():
+                delta_encoder.reset()
 
         # Let the simulation step
+        step_start = time.perf_counter()
         self.simulation.step()
+        step_seconds = time.perf_counter() - step_start
 
-        # Send a message to each client
-        print(f"Sending messages to clients {self.clients}")
-        for client_id, sid in self.clients.items():
+        # Write a checkpoint if it is time.
+        if self.checkpointer is not None and time.monotonic() - self.last_checkpoint_time >= self.checkpoint_interval:
+            self.checkpointer.checkpoint(self.simulation)
+            self.last_checkpoint_time = time.monotonic()
+
+        # Let the in-process agents act. The observations are passed without serialization.
+        policies_start = time.perf_counter()
+        for agent_id, policy in self.local_policies.items():
+            observations = self.simulation.get_agent_observations(agent_id)
+            response = policy({"observations": observations, "id": agent_id})
+            self.simulation.add_action(agent_id, response)
+        policies_seconds = time.perf_counter() - policies_start
+
+        # The observations of each client. The clients that connect in the meantime get observations in the next step.
+        observe_start = time.perf_counter()
+        messages = []
+        for client_id, sid in list(self.clients.items()):
             observations = self.simulation.get_agent_observations(client_id)
-            self.socketio.emit("message", {"observations": observations, "id": client_id}, room=sid)
+            delta_encoder = self.delta_encoders.get(client_id)
+
+            # Bitplane observations are sent in full, with the planes as a binary attachment.
+            if "planes" in observations:
+                message = {"observations": bitplanes.encode(observations), "id": client_id}
+            elif delta_encoder is not None:
+                message = delta_encoder.encode(observations)
+                message["id"] = client_id
+            # The cells are only turned into dictionaries now, the simulation shares them between the agents.
+            else:
+                message = {"observations": dict(observations, cells=list(observations["cells"])), "id": client_id}
+            messages.append((client_id, sid, message))
+        observe_seconds = time.perf_counter() - observe_start
+
+        return messages, {"step": step_seconds, "policies": policies_seconds, "observe": observe_seconds}
 
-        # Schedule the next loop
-        self.socketio.start_background_task(self.timer_callback)
+    def start_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        if self.replay_dir is not None and self.simulation.get_step() != 0:
+            print("A resumed simulation run is not recorded")
+        elif self.replay_dir is not None:
+            os.makedirs(self.replay_dir, exist_ok=True)
+            replay_path = os.path.join(self.replay_dir, f"replay-{time.strftime('%Y%m%d-%H%M%S')}-{len(self.durations):04d}.grr")
+            self.recorder = ReplayRecorder(self.simulation, replay_path)
+            print(f"Recording to {replay_path}")
 
-    def timer_callback(self):
-        self.socketio.sleep(self.sleep_time)
-        self.main_loop()
+    def create_local_policies(self):
+        self.local_policies = {}
+        for agent_config in self.simulation.config.get("agents", []):
+            if "policy" in agent_config:
+                agent_id = agent_config["identifier"]
+                self.local_policies[agent_id] = create_policy(agent_config["policy"], agent_id)
+                print(f"Agent {agent_id} runs in-process with policy {agent_config['policy']}")
+
+    def close(self):
+        # Wait for the checkpoints and the replay to be written.
+        if self.checkpointer is not None:
+            self.checkpointer.close()
+            self.checkpointer = None
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
 
     def run(self, host='0.0.0.0', port=5666):
         self.socketio.start_background_task(self.main_loop)
-        self.socketio.run(self.app, host=host, port=port)
+        try:
+            self.socketio.run(self.app, host=host, port=port)
+        finally:
+            self.close()
+
+
+# Serves the same message/response protocol with an asyncio Socket.IO server, so that one box can serve thousands of clients.
+# The tick runs in an executor thread while the event loop takes the responses and sends the messages.
+# Each client has a bounded send queue and a sender task that waits for the acknowledgement of a message before it sends
+# the next one, so a slow client only delays itself. If its queue is full, the stale messages are dropped. A delta client
+# then gets a keyframe with the next step.
+class AsyncServer(Server):
+
+    def __init__(self, *args, send_queue_size=2, ack_timeout=30.0, **kwargs):
+        self.send_queue_size = send_queue_size
+        self.ack_timeout = ack_timeout
+        self.send_queues = {}
+        self.sender_tasks = {}
+        self.dropped_messages = Counter()
+
+        # The ticks, the responses and the renderer data access the simulation in this thread only, never in the
+        # event loop. The scheduler waits in another one.
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        super().__init__(*args, **kwargs)
+
+    def create_transport(self, secret_key):
+        self.socketio = socketio.AsyncServer(async_mode="asgi")
+        self.socketio.on("connect", self.handle_connect)
+        self.socketio.on("disconnect", self.handle_disconnect)
+        self.socketio.on("response", self.handle_response)
+
+        # The page is rendered once. The static files are served by the Socket.IO app.
+        environment = Environment(loader=FileSystemLoader("templates"))
+        self.index_page = environment.get_template("index.html").render(url_for=lambda endpoint, filename: f"/{endpoint}/{filename}").encode()
+        self.asgi_app = socketio.ASGIApp(self.socketio, other_asgi_app=self.handle_http, static_files={"/static": "static"})
+
+    async def handle_http(self, scope, receive, send):
+        if scope["path"] == "/":
+            body, content_type, status = self.index_page, b"text/html; charset=utf-8", 200
+        elif scope["path"] == "/api/renderer/data":
+            renderer_data = await asyncio.get_running_loop().run_in_executor(self.executor, self.collect_renderer_data)
+            body, content_type, status = json.dumps(renderer_data).encode(), b"application/json", 200
+        else:
+            body, content_type, status = b"Not Found", b"text/plain", 404
+        await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def handle_connect(self, sid, environ):
+        client_id = environ.get("HTTP_ID")
+        if client_id is None:
+            print("Client rejected, no client ID provided")
+            return False
+        if not self.add_client(client_id, sid, environ.get("HTTP_OBSERVATION_PROTOCOL"), environ.get("HTTP_KEYFRAME_INTERVAL", 100)):
+            return False
+
+        # A client that reconnects before its old session disconnected replaces that session and its sender.
+        sender_task = self.sender_tasks.pop(client_id, None)
+        if sender_task is not None:
+            sender_task.cancel()
+        self.send_queues[client_id] = asyncio.Queue(self.send_queue_size)
+        self.sender_tasks[client_id] = asyncio.create_task(self.send_messages(client_id, sid, self.send_queues[client_id]))
+
+    async def handle_disconnect(self, sid, reason=None):
+        client_id = self.remove_client(sid)
+        if client_id is not None:
+            self.send_queues.pop(client_id, None)
+            sender_task = self.sender_tasks.pop(client_id, None)
+            if sender_task is not None:
+                sender_task.cancel()
+
+    async def handle_response(self, sid, data):
+        # The responses are not printed, that does not scale to thousands of clients. The action is added in the
+        # thread of the simulation.
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.add_response, data)
+
+    async def send_messages(self, client_id, sid, send_queue):
+        while True:
+            message = await send_queue.get()
+            try:
+                await self.socketio.call("message", message, to=sid, timeout=self.ack_timeout)
+            except socketio.exceptions.TimeoutError:
+                print(f"Client {client_id} did not acknowledge a message")
+            except socketio.exceptions.SocketIOError:
+                return
+
+    def put_message(self, client_id, message):
+        send_queue = self.send_queues.get(client_id)
+        if send_queue is None:
+            return
+        if send_queue.full():
+            while not send_queue.empty():
+                send_queue.get_nowait()
+                self.dropped_messages[client_id] += 1
+
+            # A delta message needs the ones before it. Skip it and start over with a keyframe.
+            delta_encoder = self.delta_encoders.get(client_id)
+            if delta_encoder is not None:
+                delta_encoder.reset()
+                self.dropped_messages[client_id] += 1
+                return
+        send_queue.put_nowait(message)
+
+    def collect_renderer_data(self):
+        renderer_data = super().collect_renderer_data()
+        renderer_data["statistics"]["dropped_messages"] = sum(self.dropped_messages.values())
+        return renderer_data
+
+    async def main_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            messages, phases = await loop.run_in_executor(self.executor, self.prepare_messages)
+
+            # Start the tick and fan out the messages to the send queues.
+            self.scheduler.start_tick([client_id for client_id, _, _ in messages], self.simulation.world_snapshot_step)
+            emit_start = time.perf_counter()
+            for client_id, sid, message in messages:
+                self.put_message(client_id, message)
+            phases["emit"] = time.perf_counter() - emit_start
+            self.scheduler.record_phases(phases)
+
+            # Wait for the next tick without blocking the event loop.
+            missed = await loop.run_in_executor(None, self.scheduler.wait)
+            await loop.run_in_executor(self.executor, self.add_default_actions, missed)
+
+    async def serve(self, host, port):
+        import uvicorn
+        server = uvicorn.Server(uvicorn.Config(self.asgi_app, host=host, port=port, log_level="warning"))
+        main_loop = asyncio.create_task(self.main_loop())
+        try:
+            await server.serve()
+        finally:
+            main_loop.cancel()
+
+    def run(self, host='0.0.0.0', port=5666):
+        if importlib.util.find_spec("uvicorn") is None:
+            raise ValueError("The asyncio server requires uvicorn")
+        try:
+            asyncio.run(self.serve(host, port))
+        finally:
+            # Close in the thread of the simulation, after the tick that may still run there.
+            self.executor.submit(self.close).result()
+            self.executor.shutdown()
 
 if __name__ == '__main__':
-    server = Server(simulation_config_path="simulations/simulation.json")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config", nargs="?", default="simulations/simulation.json", help="The simulation config")
+    parser.add_argument("--replay-dir", default=None, help="Record a replay of each simulation run into this directory")
+    parser.add_argument("--checkpoint-dir", default=None, help="Write periodic checkpoints into this directory")
+    parser.add_argument("--checkpoint-interval", type=float, default=10.0, help="The seconds between two checkpoints")
+    parser.add_argument("--resume", action="store_true", help="Resume from the latest checkpoint in the checkpoint directory")
+    parser.add_argument("--tick-mode", choices=["fixed_rate", "lockstep", "lockstep_deadline"], default=None, help="When to step, overrides the tick mode of the config")
+    parser.add_argument("--asyncio", action="store_true", help="Use the asyncio server, for thousands of clients")
+    parser.add_argument("--quiet", action="store_true", help="Do not print the output of the simulation")
+    args = parser.parse_args()
+
+    if args.quiet:
+        sys.stdout = open(os.devnull, "w")
+
+    server_class = AsyncServer if args.asyncio else Server
+    server = server_class(
+        simulation_config_path=args.config,
+        replay_dir=args.replay_dir,
+        checkpoint_dir=args.checkpoint_dir,
+        checkpoint_interval=args.checkpoint_interval,
+        resume=args.resume,
+        tick_mode=args.tick_mode
+    )
     server.run()
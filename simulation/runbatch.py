@@ -0,0 +1,24 @@
+import sys
+import fire
+from source.batchrunner import BatchRunner
+
+# The policies are loaded from the root of the repository, for example "agents.source.codedagent:CodedAgent".
+sys.path.append("..")
+
+
+def run(config:str="simulations/simulation.json", policy:str=None, episodes:int=100, workers:int=None, max_steps:int=1000, seed:int=0, output:str="results.csv"):
+    batch_runner = BatchRunner(config, policy, max_steps=max_steps, seed=seed)
+    results = batch_runner.run(episodes, workers=workers)
+    BatchRunner.write_summary(results, output)
+
+    # Print a short summary.
+    finished = [result for result in results if result["finished"]]
+    errors = [result for result in results if result["error"] is not None]
+    print(f"Episodes: {len(results)}, finished: {len(finished)}, errors: {len(errors)}")
+    if len(finished) > 0:
+        print(f"Average steps to finish: {sum(result['steps'] for result in finished) / len(finished):.2f}")
+    print(f"Summary written to {output}")
+
+
+if __name__ == '__main__':
+    fire.Fire(run)
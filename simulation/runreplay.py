@@ -0,0 +1,16 @@
+import fire
+from source.replay import ReplayPlayer
+
+
+def run(path:str, interval:float=None, quiet:bool=True):
+    player = ReplayPlayer(path, quiet=quiet)
+    print(f"Replaying {len(player.steps)} steps from {path}")
+    simulation = player.play(interval=interval)
+
+    # Print the final state of the agents.
+    for agent in simulation.get_agents():
+        print(f"Agent {agent.id}: position {agent.x}, {agent.y}, score {agent.score}, actions {agent.action_count}, state {agent.state}")
+
+
+if __name__ == '__main__':
+    fire.Fire(run)
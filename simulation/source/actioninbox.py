@@ -0,0 +1,71 @@
+import threading
+from collections import Counter
+
+
+# Collects the actions of the agents for the next step. The server handlers put actions from their threads
+# while the tick thread takes all of them at once. There are two buffers: the handlers write into the front
+# buffer and a step swaps it with the back buffer, so taking the actions is O(1) and does not copy them.
+# The lock is only held for a dictionary assignment or a swap.
+#
+# An action can carry the step that it targets, which is the step after the observations it responds to.
+# If that step has already been executed, the action is late. It is still executed in the next step and is
+# labeled with the step it targeted. If an agent sends another action before the step, the first one is dropped.
+class ActionInbox:
+
+    def __init__(self, actions=None, next_step=0):
+        self.lock = threading.Lock()
+        self.next_step = next_step
+
+        # The front buffer with the actions and the late targeted steps, and the back buffer.
+        self.actions = dict(actions or {})
+        self.late = {}
+        self.back_actions = {}
+        self.back_late = {}
+
+        # The numbers of late and dropped actions per agent.
+        self.late_counts = Counter()
+        self.dropped_counts = Counter()
+
+
+    def copy(self):
+        inbox = ActionInbox(self.get_pending(), self.next_step)
+        with self.lock:
+            inbox.late = dict(self.late)
+            inbox.late_counts = Counter(self.late_counts)
+            inbox.dropped_counts = Counter(self.dropped_counts)
+        return inbox
+
+
+    def put(self, agent_id, action, target_step=None):
+        with self.lock:
+            if agent_id in self.actions:
+                self.dropped_counts[agent_id] += 1
+                self.late.pop(agent_id, None)
+            self.actions[agent_id] = action
+            if target_step is not None and target_step < self.next_step:
+                self.late[agent_id] = target_step
+                self.late_counts[agent_id] += 1
+
+
+    def swap(self, step):
+        # Returns the actions for the step and the steps that the late actions targeted.
+        # They are valid until the next swap, which reuses the buffers.
+        self.back_actions.clear()
+        self.back_late.clear()
+        with self.lock:
+            actions, late = self.actions, self.late
+            self.actions, self.late = self.back_actions, self.back_late
+            self.next_step = step + 1
+        self.back_actions, self.back_late = actions, late
+        return actions, late
+
+
+    def get_pending(self):
+        with self.lock:
+            return dict(self.actions)
+
+
+    def get_stats(self):
+        # Returns the numbers of late and dropped actions per agent.
+        with self.lock:
+            return {agent_id: {"late": self.late_counts[agent_id], "dropped": self.dropped_counts[agent_id]} for agent_id in set(self.late_counts) | set(self.dropped_counts)}
@@ -2,6 +2,8 @@ from .entity import Entity
 
 class Agent(Entity):
 
+    __slots__ = ("name", "x", "y", "state", "id", "observations", "actions", "inventory", "score", "action_count", "explored")
+
     def __init__(self, agent_id, name, x, y):
         super().__init__(name, x, y)
         self.id = agent_id
@@ -10,3 +12,13 @@ class Agent(Entity):
         self.inventory = []
         self.score = 0
         self.action_count = 0
+
+        # The cells that the agent has seen in the fov observation mode, with the step and the elements.
+        self.explored = {}
+
+    def copy(self):
+        # The items of the inventory are views of the entity store. A fork replaces them with the items of its store.
+        agent = super().copy()
+        agent.inventory = list(self.inventory)
+        agent.explored = dict(self.explored)
+        return agent
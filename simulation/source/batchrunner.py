@@ -0,0 +1,128 @@
+import os
+import io
+import csv
+import json
+import copy
+import time
+import random
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+from .simulation import Simulation
+from .policyloader import create_policy
+
+
+# Runs many episodes of a simulation config without a server. The agents run in-process and the steps run
+# as fast as possible. Each episode gets its own seed, which is used for the layout, the order of the
+# actions and the global random module. Without a policy, the policies of the agents in the config are used.
+class BatchRunner:
+
+    def __init__(self, config, policy=None, max_steps=1000, seed=0, quiet=True):
+
+        # If config is a file, load it with json.
+        if isinstance(config, str) and os.path.exists(config):
+            with open(config) as f:
+                config = json.load(f)
+        if not isinstance(config, dict):
+            raise ValueError("Invalid simulation config")
+
+        self.config = config
+        self.policy = policy
+        self.max_steps = max_steps
+        self.seed = seed
+        self.quiet = quiet
+
+
+    def run(self, episodes, workers=None):
+
+        # Run in this process if there is only one worker.
+        if workers == 1:
+            return [self.run_episode(episode) for episode in range(episodes)]
+
+        # Distribute the episodes over a process pool.
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunksize = max(1, episodes // (4 * (workers or os.cpu_count() or 1)))
+            return list(executor.map(self.run_episode, range(episodes), chunksize=chunksize))
+
+
+    def run_episode(self, episode):
+        seed = self.seed + episode
+
+        # Seed the config of the episode.
+        config = copy.deepcopy(self.config)
+        config["seed"] = seed
+        if config["grid"]["type"] != "custom":
+            config["grid"]["parameters"]["seed"] = seed
+        random.seed(seed)
+
+        result = {
+            "episode": episode,
+            "seed": seed,
+            "finished": False,
+            "steps": 0,
+            "score": 0,
+            "action_count": 0,
+            "dead_agents": 0,
+            "duration_seconds": 0.0,
+            "error": None,
+        }
+
+        # The simulation prints a lot. Discard it if requested.
+        output = io.StringIO() if self.quiet else None
+        start_time = time.time()
+        with contextlib.redirect_stdout(output) if output is not None else contextlib.nullcontext():
+            try:
+                simulation = Simulation(config)
+                policies = {}
+                for agent_config in config["agents"]:
+                    agent_id = agent_config["identifier"]
+                    policy = self.policy if self.policy is not None else agent_config.get("policy")
+                    if policy is None:
+                        raise ValueError(f"No policy for agent {agent_id}")
+                    policies[agent_id] = create_policy(policy, agent_id)
+
+                # Do one step to initialize the observations. Then step until the simulation is finished.
+                simulation.step()
+                while simulation.get_step() < self.max_steps:
+                    if simulation.is_finished():
+                        break
+                    if all(agent.state == "dead" for agent in simulation.get_agents()):
+                        break
+                    for agent_id, policy in policies.items():
+                        observations = simulation.get_agent_observations(agent_id)
+                        response = policy({"observations": observations, "id": agent_id})
+                        simulation.add_action(agent_id, response)
+                    simulation.step()
+
+                # Collect the results. The simulation can also finish in the last step.
+                agents = simulation.get_agents()
+                result["finished"] = simulation.is_finished()
+                result["steps"] = simulation.get_step()
+                result["score"] = sum(agent.score for agent in agents)
+                result["action_count"] = sum(agent.action_count for agent in agents)
+                result["dead_agents"] = len([agent for agent in agents if agent.state == "dead"])
+
+            # A failing episode should not stop the batch.
+            except Exception as exception:
+                result["error"] = f"{type(exception).__name__}: {exception}"
+        result["duration_seconds"] = time.time() - start_time
+
+        return result
+
+
+    @staticmethod
+    def write_summary(results, path):
+
+        # Parquet needs pandas.
+        if path.endswith(".parquet"):
+            try:
+                import pandas
+            except ImportError:
+                raise ValueError("Writing parquet files requires pandas")
+            pandas.DataFrame(results).to_parquet(path)
+
+        # Everything else is written as CSV.
+        else:
+            with open(path, "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+                writer.writeheader()
+                writer.writerows(results)
@@ -0,0 +1,26 @@
+import numpy as np
+
+# The bitplane observation format. The observed window is a (C, H, W) uint8 array with one channel per
+# element, in the order of CHANNELS. The walls, then the items, then the other agents.
+CHANNELS = ["wall", "gold", "trove", "enemy", "door", "key", "staircase", "agent"]
+CHANNEL_CODES = {channel: code for code, channel in enumerate(CHANNELS)}
+
+
+def encode(observations):
+    # Replaces the planes array with its shape and the bits packed into bytes, so that it can be sent as a binary attachment.
+    planes = observations["planes"]
+    encoded = dict(observations)
+    encoded["planes"] = {
+        "shape": list(planes.shape),
+        "bits": np.packbits(planes).tobytes(),
+    }
+    return encoded
+
+
+def decode(observations):
+    # Restores the (C, H, W) uint8 array of the planes from the packed bits. Used by the socket agents.
+    planes = observations["planes"]
+    decoded = dict(observations)
+    count = int(np.prod(planes["shape"]))
+    decoded["planes"] = np.unpackbits(np.frombuffer(planes["bits"], dtype=np.uint8), count=count).reshape(planes["shape"])
+    return decoded
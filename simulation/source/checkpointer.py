@@ -0,0 +1,225 @@
+import os
+import re
+import copy
+import json
+import queue
+import threading
+from collections import Counter
+
+# Use msgpack if it is installed. Otherwise fall back to JSON.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# The checkpoint files are numbered. Full checkpoints hold the static layout and the whole dynamic state,
+# delta checkpoints only the dynamic state that changed since the last full checkpoint.
+CHECKPOINT_FILE_PATTERN = re.compile(r"^checkpoint-(\d+)-(full|delta)\.ckpt$")
+
+
+def encode(data):
+    if msgpack is not None:
+        return b"M" + msgpack.packb(data, use_bin_type=True)
+    return b"J" + json.dumps(data).encode("utf-8")
+
+
+def decode(data):
+    if data[:1] == b"M":
+        if msgpack is None:
+            raise ValueError("The checkpoint was written with msgpack, which is not installed")
+        return msgpack.unpackb(data[1:], raw=False, strict_map_key=False)
+    if data[:1] == b"J":
+        return json.loads(data[1:].decode("utf-8"))
+    raise ValueError("Unknown checkpoint encoding")
+
+
+# Writes periodic checkpoints of a simulation to a directory. The state is captured on the calling thread,
+# the diffing, encoding and writing happen on a background thread. Only full checkpoints capture all the
+# entities. After that the entity store tracks the rows that change, and a delta only captures those.
+# Files are written to a temporary file first and then renamed, so a checkpoint is either complete or not there.
+class Checkpointer:
+
+    def __init__(self, directory, full_interval=10):
+        self.directory = directory
+        self.full_interval = full_interval
+        os.makedirs(directory, exist_ok=True)
+
+        # Continue the numbering of the existing checkpoints.
+        numbers = [number for number, _ in Checkpointer.list_checkpoints(directory)]
+        self.sequence = max(numbers) + 1 if len(numbers) > 0 else 0
+
+        # The last full checkpoint, for the deltas. The records of its entities and the latest records of the rows
+        # that changed since then are kept by row.
+        self.simulation = None
+        self.base_sequence = None
+        self.base_state = None
+        self.base_records = None
+        self.changed_records = None
+        self.deltas_since_full = 0
+
+        # The background writer.
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.__write_loop, daemon=True)
+        self.thread.start()
+
+
+    def checkpoint(self, simulation):
+
+        # Write a full checkpoint for a new simulation, after full_interval deltas, or if the entity store does not
+        # track its changes, for example after a restore.
+        full = simulation is not self.simulation or self.deltas_since_full >= self.full_interval or simulation.entities.changed_rows is None
+        if full:
+            # Capture all the entities with their rows and track the changes from now on.
+            state = simulation.snapshot()
+            changes = simulation.entities.get_rows(owned=False).tolist()
+            simulation.entities.track_changes()
+
+            # Binary levels are referenced by their path and procedural grids by their parameters.
+            # The other layouts are stored as custom layouts.
+            static = copy.deepcopy(simulation.config)
+            if simulation.config["grid"]["type"] in ["binary", "procedural"]:
+                static["grid"] = dict(simulation.config["grid"])
+            else:
+                static["grid"] = {
+                    "type": "custom",
+                    "layout": list(simulation.config["grid"]["layout"][::-1]),
+                }
+            static["seed"] = simulation.seed
+            self.simulation = simulation
+            self.deltas_since_full = 0
+        else:
+            # Only capture the rows that changed. The rest of the state is small.
+            state = simulation.snapshot(include_entities=False)
+            changes = simulation.entities.take_changes()
+            static = None
+            self.deltas_since_full += 1
+        self.queue.put((self.sequence, static, state, changes))
+        self.sequence += 1
+
+
+    def close(self):
+        # Wait until all the checkpoints are written.
+        self.queue.put(None)
+        self.thread.join()
+
+
+    def __write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            sequence, static, state, changes = item
+            try:
+                if static is not None:
+                    self.base_sequence = sequence
+                    self.base_state = state
+                    self.base_records = dict(zip(changes, state["entities"]))
+                    self.changed_records = {}
+                    self.__write(sequence, "full", {"static": static, "state": state})
+                    self.__prune(sequence)
+                else:
+                    self.changed_records.update(changes)
+                    self.__write(sequence, "delta", {"base": self.base_sequence, "delta": Checkpointer.diff(self.base_state, self.base_records, self.changed_records, state)})
+                    self.__prune(sequence)
+            except Exception as exception:
+                print(f"Writing checkpoint {sequence} failed: {exception}")
+
+
+    def __write(self, sequence, kind, data):
+        path = os.path.join(self.directory, f"checkpoint-{sequence:08d}-{kind}.ckpt")
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(encode(data))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+
+
+    def __prune(self, sequence):
+        # Remove all the checkpoints before the new one, except for the full checkpoint that it is based on.
+        for number, kind in Checkpointer.list_checkpoints(self.directory):
+            if number < sequence and number != self.base_sequence:
+                os.remove(os.path.join(self.directory, f"checkpoint-{number:08d}-{kind}.ckpt"))
+
+
+    @staticmethod
+    def diff(base_state, base_records, changed_records, state):
+        # The entities that were removed and added since the base, from the records of the rows that changed.
+        # A record is None if the row has no entity on the grid. And the agents that changed.
+        entities_removed = []
+        entities_added = []
+        for row, record in changed_records.items():
+            base_record = base_records.get(row)
+            if record != base_record:
+                if base_record is not None:
+                    entities_removed.append(base_record)
+                if record is not None:
+                    entities_added.append(record)
+        base_agents = {agent[0]: agent for agent in base_state["agents"]}
+        return {
+            "simulation_step": state["simulation_step"],
+            "entities_removed": entities_removed,
+            "entities_added": entities_added,
+            "agents": [agent for agent in state["agents"] if base_agents.get(agent[0]) != agent],
+            "triggers": state["triggers"],
+            "actions": state["actions"],
+            "random": state["random"],
+            "world_snapshot_step": state["world_snapshot_step"],
+            "chunks": state["chunks"],
+            "explored": state["explored"],
+        }
+
+
+    @staticmethod
+    def apply(base_state, delta):
+        entities = Counter(tuple(entity) for entity in base_state["entities"])
+        entities -= Counter(tuple(entity) for entity in delta["entities_removed"])
+        entities += Counter(tuple(entity) for entity in delta["entities_added"])
+        agents = {agent[0]: agent for agent in base_state["agents"]}
+        for agent in delta["agents"]:
+            agents[agent[0]] = agent
+        return {
+            "simulation_step": delta["simulation_step"],
+            "entities": list(entities.elements()),
+            "agents": list(agents.values()),
+            "triggers": delta["triggers"],
+            "actions": delta["actions"],
+            "random": delta["random"],
+            "world_snapshot_step": delta["world_snapshot_step"],
+            "chunks": delta.get("chunks"),
+            "explored": delta.get("explored", {}),
+        }
+
+
+    @staticmethod
+    def list_checkpoints(directory):
+        checkpoints = []
+        for file_name in os.listdir(directory):
+            match = CHECKPOINT_FILE_PATTERN.match(file_name)
+            if match is not None:
+                checkpoints.append((int(match.group(1)), match.group(2)))
+        return sorted(checkpoints)
+
+
+    @staticmethod
+    def load_latest(directory):
+        # Returns the static config and the dynamic state of the latest checkpoint.
+        def read(number, kind):
+            with open(os.path.join(directory, f"checkpoint-{number:08d}-{kind}.ckpt"), "rb") as f:
+                return decode(f.read())
+
+        checkpoints = Checkpointer.list_checkpoints(directory) if os.path.exists(directory) else []
+        full_numbers = [number for number, kind in checkpoints if kind == "full"]
+        if len(full_numbers) == 0:
+            raise ValueError(f"No checkpoint found in {directory}")
+        full = read(full_numbers[-1], "full")
+        state = full["state"]
+
+        # Apply the latest delta of this full checkpoint.
+        delta_numbers = [number for number, kind in checkpoints if kind == "delta" and number > full_numbers[-1]]
+        if len(delta_numbers) > 0:
+            delta = read(delta_numbers[-1], "delta")
+            if delta["base"] == full_numbers[-1]:
+                state = Checkpointer.apply(state, delta["delta"])
+
+        return full["static"], state
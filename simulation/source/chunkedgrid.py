@@ -0,0 +1,332 @@
+import itertools
+import numpy as np
+from .grid import CELL_TYPES, CELL_CODES
+
+# The default width and height of a chunk in cells.
+CHUNK_SIZE = 64
+
+
+# The entities of one chunk. The number of entities per cell and the entities of the occupied cells.
+class EntityChunk:
+
+    def __init__(self, chunk_size):
+        self.entity_counts = np.zeros((chunk_size, chunk_size), dtype=np.uint16)
+        self.cells_entities = {}
+        self.count = 0
+
+
+    def copy(self, copy_entity=None):
+        # Copy the entity index. copy_entity gives the entities of the copy, the same ones if it is None.
+        chunk = EntityChunk.__new__(EntityChunk)
+        chunk.entity_counts = self.entity_counts.copy()
+        if copy_entity is None:
+            chunk.cells_entities = {position: list(entities) for position, entities in self.cells_entities.items()}
+        else:
+            chunk.cells_entities = {position: [copy_entity(entity) for entity in entities] for position, entities in self.cells_entities.items()}
+        chunk.count = self.count
+        return chunk
+
+
+# A grid that is stored in fixed-size chunks, for very large worlds. It has the same API as Grid.
+# Chunks that are all empty or all wall share one immutable array, the other chunks have their own static cells.
+# The entities are indexed per chunk and a chunk only has an entity index while there are entities in it.
+# That way the memory scales with the area that has content and not with the size of the grid.
+class ChunkedGrid:
+
+    def __init__(self, width, height, chunk_size=CHUNK_SIZE):
+        self.width = width
+        self.height = height
+        self.chunk_size = chunk_size
+        self.chunks_x = -(-width // chunk_size)
+        self.chunks_y = -(-height // chunk_size)
+
+        # The shared immutable chunks.
+        self.uniform_chunks = []
+        for code in range(len(CELL_TYPES)):
+            chunk = np.full((chunk_size, chunk_size), code, dtype=np.uint8)
+            chunk.flags.writeable = False
+            self.uniform_chunks.append(chunk)
+
+        # The static cells per chunk. Missing chunks are empty. The version changes when the static cells change.
+        self.static_chunks = {}
+        self.static_version = 0
+
+        # The entity index per chunk and the positions per entity name.
+        self.entity_chunks = {}
+        self.positions_by_name = {}
+
+        # The number of entities per name, and the cells that the triggers watch and that entities entered.
+        self.name_counts = {}
+        self.watched_cells = set()
+        self.entered_cells = set()
+
+        # The chunks and the names whose entity index and positions this grid owns. None while it shares none with a
+        # fork. copy_entity returns the own entity for an entity of the grid this one was forked from.
+        self.owned_chunks = None
+        self.owned_names = None
+        self.copy_entity = None
+
+
+    @staticmethod
+    def from_cells(cells, chunk_size=CHUNK_SIZE):
+        # Create a chunked grid from an array of static cell codes, indexed by [y, x].
+        height, width = cells.shape
+        grid = ChunkedGrid(width, height, chunk_size)
+
+        # The minimum and the maximum code of each chunk, all at once. The edge chunks only cover the cells that exist.
+        starts_y = np.arange(0, height, chunk_size)
+        starts_x = np.arange(0, width, chunk_size)
+        minimum = np.minimum.reduceat(np.minimum.reduceat(cells, starts_y, axis=0), starts_x, axis=1)
+        maximum = np.maximum.reduceat(np.maximum.reduceat(cells, starts_y, axis=0), starts_x, axis=1)
+
+        # Only keep the chunks that are not empty. Each chunk is sliced from the cells, the edge chunks are padded
+        # with empty cells. Uniform chunks that are whole use the shared array.
+        empty = CELL_CODES["empty"]
+        for chunk_y, chunk_x in zip(*np.nonzero((minimum != empty) | (maximum != empty))):
+            chunk_x, chunk_y = int(chunk_x), int(chunk_y)
+            block = cells[chunk_y * chunk_size:(chunk_y + 1) * chunk_size, chunk_x * chunk_size:(chunk_x + 1) * chunk_size]
+            if minimum[chunk_y, chunk_x] == maximum[chunk_y, chunk_x] and block.shape == (chunk_size, chunk_size):
+                chunk = grid.uniform_chunks[minimum[chunk_y, chunk_x]]
+            else:
+                chunk = np.full((chunk_size, chunk_size), empty, dtype=np.uint8)
+                chunk[:block.shape[0], :block.shape[1]] = block
+                chunk.flags.writeable = False
+            grid.static_chunks[(chunk_x, chunk_y)] = chunk
+        return grid
+
+
+    def fork(self, copy_entity):
+        # Create a grid that shares the static chunks and the entity index. The entity index of a chunk and the
+        # positions of a name stay shared until one of the grids changes them, then that grid copies them first.
+        grid = self.__class__.__new__(self.__class__)
+        grid.width = self.width
+        grid.height = self.height
+        grid.chunk_size = self.chunk_size
+        grid.chunks_x = self.chunks_x
+        grid.chunks_y = self.chunks_y
+        grid.uniform_chunks = self.uniform_chunks
+        grid.static_chunks = self.static_chunks
+        grid.static_version = self.static_version
+        grid.entity_chunks = dict(self.entity_chunks)
+        grid.positions_by_name = dict(self.positions_by_name)
+        grid.name_counts = dict(self.name_counts)
+        grid.watched_cells = set()
+        grid.entered_cells = set()
+        grid.owned_chunks = set()
+        grid.owned_names = set()
+        grid.copy_entity = copy_entity
+        self.owned_chunks = set()
+        self.owned_names = set()
+        return grid
+
+
+    def own_chunk(self, key):
+        # Returns the entity index of a chunk to change it, after creating it or copying it if it is shared.
+        chunk = self.entity_chunks.get(key)
+        if chunk is None:
+            chunk = EntityChunk(self.chunk_size)
+        elif self.owned_chunks is None or key in self.owned_chunks:
+            return chunk
+        else:
+            chunk = chunk.copy(self.copy_entity)
+        self.entity_chunks[key] = chunk
+        if self.owned_chunks is not None:
+            self.owned_chunks.add(key)
+        return chunk
+
+
+    def own_positions(self, name):
+        # Returns the positions of a name to change them, after copying them if they are shared.
+        positions = self.positions_by_name.get(name)
+        if positions is None:
+            positions = {}
+            self.positions_by_name[name] = positions
+        elif self.owned_names is None or name in self.owned_names:
+            return positions
+        else:
+            positions = dict(positions)
+            self.positions_by_name[name] = positions
+        if self.owned_names is not None:
+            self.owned_names.add(name)
+        return positions
+
+
+    def get_own_entities(self, key, entities):
+        # Returns the own entities of a fork for entities of a chunk that can still be shared.
+        if self.copy_entity is None or key in self.owned_chunks:
+            return entities
+        return [self.copy_entity(entity) for entity in entities]
+
+
+    def get_static_chunk(self, chunk_x, chunk_y):
+        return self.static_chunks.get((chunk_x, chunk_y), self.uniform_chunks[CELL_CODES["empty"]])
+
+
+    def clear_entities(self):
+        self.entity_chunks.clear()
+        self.positions_by_name.clear()
+        self.name_counts.clear()
+
+    def add_entity(self, entity, x, y):
+        entity.x = x
+        entity.y = y
+
+        # Add the entity to the bucket of the cell. Create the entity index of the chunk on first touch.
+        key = (x // self.chunk_size, y // self.chunk_size)
+        chunk = self.own_chunk(key)
+        position = (x, y)
+        bucket = chunk.cells_entities.get(position)
+        if bucket is None:
+            chunk.cells_entities[position] = [entity]
+        else:
+            bucket.append(entity)
+        chunk.entity_counts[y % self.chunk_size, x % self.chunk_size] += 1
+        chunk.count += 1
+
+        # Add the position to the positions of the name.
+        positions = self.own_positions(entity.name)
+        positions[position] = positions.get(position, 0) + 1
+        self.name_counts[entity.name] = self.name_counts.get(entity.name, 0) + 1
+        if position in self.watched_cells:
+            self.entered_cells.add(position)
+
+    def add_entities(self, entities, xs, ys, codes, names):
+        # Adds many entities that already have their positions, for example the items of a level. The names are
+        # given as codes into names. Entities in chunks that had no entities, on cells that get only one of them,
+        # are indexed chunk by chunk with array operations, otherwise the entities are added one by one.
+        if len(entities) == 0:
+            return
+        size = self.chunk_size
+        chunk_indices = (ys // size).astype(np.int64) * self.chunks_x + xs // size
+        order = np.argsort(chunk_indices, kind="stable")
+        sorted_indices = chunk_indices[order]
+        starts = np.concatenate([[0], np.nonzero(sorted_indices[1:] != sorted_indices[:-1])[0] + 1, [len(order)]])
+        keys = [(index % self.chunks_x, index // self.chunks_x) for index in sorted_indices[starts[:-1]].tolist()]
+        if any(key in self.entity_chunks for key in keys) or len(np.unique(ys.astype(np.int64) * self.width + xs)) < len(xs):
+            for entity, x, y in zip(entities, xs.tolist(), ys.tolist()):
+                self.add_entity(entity, x, y)
+            return
+
+        # Every entity gets a new bucket in a new entity index of its chunk.
+        positions = list(zip(xs.tolist(), ys.tolist()))
+        for key, start, end in zip(keys, starts[:-1].tolist(), starts[1:].tolist()):
+            indices = order[start:end]
+            chunk = self.own_chunk(key)
+            chunk.entity_counts[ys[indices] % size, xs[indices] % size] = 1
+            chunk.count = end - start
+            chunk.cells_entities.update((positions[index], [entities[index]]) for index in indices.tolist())
+
+        # Add the positions to the positions of the names.
+        for code in np.unique(codes).tolist():
+            selected = codes == code
+            positions_of_name = self.own_positions(names[code])
+            positions_of_name.update(zip(itertools.compress(positions, selected.tolist()), itertools.repeat(1)))
+            self.name_counts[names[code]] = self.name_counts.get(names[code], 0) + int(np.count_nonzero(selected))
+        if len(self.watched_cells) > 0:
+            self.entered_cells.update(self.watched_cells.intersection(positions))
+
+    def remove_entity(self, entity):
+        x, y = entity.x, entity.y
+
+        # Remove the entity from the bucket of the cell. Free the entity index of the chunk when it is empty.
+        key = (x // self.chunk_size, y // self.chunk_size)
+        chunk = self.own_chunk(key)
+        bucket = chunk.cells_entities[(x, y)]
+        bucket.remove(entity)
+        if len(bucket) == 0:
+            del chunk.cells_entities[(x, y)]
+        chunk.entity_counts[y % self.chunk_size, x % self.chunk_size] -= 1
+        chunk.count -= 1
+        if chunk.count == 0:
+            del self.entity_chunks[key]
+
+        # Remove the position from the positions of the name.
+        positions = self.own_positions(entity.name)
+        if positions[(x, y)] == 1:
+            del positions[(x, y)]
+        else:
+            positions[(x, y)] -= 1
+        self.name_counts[entity.name] -= 1
+
+    def move_entity(self, entity, x, y):
+        self.remove_entity(entity)
+        self.add_entity(entity, x, y)
+
+    def move_entities(self, entities, xs, ys):
+        for entity, x, y in zip(entities, xs.tolist(), ys.tolist()):
+            self.move_entity(entity, x, y)
+
+    def get_positions(self, name):
+        # Returns the positions of all the entities with the given name as a set-like view.
+        return self.positions_by_name.get(name, {}).keys()
+
+    def count_entities(self, name):
+        return self.name_counts.get(name, 0)
+
+    def count_entities_at(self, name, xs, ys):
+        # Returns the numbers of the entities with the given name at the positions as an array.
+        counts = self.positions_by_name.get(name, {})
+        return np.fromiter((counts.get(position, 0) for position in zip(xs.tolist(), ys.tolist())), dtype=np.int64, count=len(xs))
+
+    def get_celltype_code(self, x, y):
+        return self.get_static_chunk(x // self.chunk_size, y // self.chunk_size)[y % self.chunk_size, x % self.chunk_size]
+
+    def get_celltype_at(self, x, y):
+        return CELL_TYPES[self.get_celltype_code(x, y)]
+
+    def get_celltype_codes_at(self, xs, ys):
+        # Returns the cell codes at arrays of coordinates. Looked up chunk by chunk.
+        codes = np.empty(len(xs), dtype=np.uint8)
+        chunk_xs = xs // self.chunk_size
+        chunk_ys = ys // self.chunk_size
+        for chunk_x, chunk_y in set(zip(chunk_xs.tolist(), chunk_ys.tolist())):
+            in_chunk = (chunk_xs == chunk_x) & (chunk_ys == chunk_y)
+            codes[in_chunk] = self.get_static_chunk(chunk_x, chunk_y)[ys[in_chunk] % self.chunk_size, xs[in_chunk] % self.chunk_size]
+        return codes
+
+    def get_celltype_codes(self, start_x, start_y, end_x, end_y):
+        # Returns a read-only array with the cell codes of a region, indexed by [y, x]. Assembled from the chunks.
+        region = self.__assemble(start_x, start_y, end_x, end_y, np.uint8, lambda chunk_x, chunk_y: self.get_static_chunk(chunk_x, chunk_y))
+        region.flags.writeable = False
+        return region
+
+    def get_entity_counts(self, start_x, start_y, end_x, end_y):
+        # Returns a read-only array with the number of entities per cell of a region, indexed by [y, x].
+        def get_chunk(chunk_x, chunk_y):
+            chunk = self.entity_chunks.get((chunk_x, chunk_y))
+            return chunk.entity_counts if chunk is not None else None
+        region = self.__assemble(start_x, start_y, end_x, end_y, np.uint16, get_chunk)
+        region.flags.writeable = False
+        return region
+
+    def get_entity_names_at(self, x, y):
+        # Include the names of the entities in the list.
+        return [entity.name for entity in self.get_entities_at(x, y)]
+
+    def get_entities_at(self, x, y):
+        key = (x // self.chunk_size, y // self.chunk_size)
+        chunk = self.entity_chunks.get(key)
+        if chunk is None:
+            return []
+        return self.get_own_entities(key, chunk.cells_entities.get((x, y), []))
+
+    def get_occupied_cells(self):
+        # Returns the positions and the entities of all the cells with entities. The entities of the shared
+        # chunks of a fork can be the ones of the grid it was forked from, which have the same names.
+        for chunk in self.entity_chunks.values():
+            yield from chunk.cells_entities.items()
+
+
+    def __assemble(self, start_x, start_y, end_x, end_y, dtype, get_chunk):
+        # Copy the parts of the chunks that overlap the region. Missing chunks are zero.
+        region = np.zeros((max(0, end_y - start_y), max(0, end_x - start_x)), dtype=dtype)
+        size = self.chunk_size
+        for chunk_y in range(start_y // size, -(-end_y // size)):
+            for chunk_x in range(start_x // size, -(-end_x // size)):
+                chunk = get_chunk(chunk_x, chunk_y)
+                if chunk is None:
+                    continue
+                x0, x1 = max(start_x, chunk_x * size), min(end_x, (chunk_x + 1) * size)
+                y0, y1 = max(start_y, chunk_y * size), min(end_y, (chunk_y + 1) * size)
+                region[y0 - start_y:y1 - start_y, x0 - start_x:x1 - start_x] = chunk[y0 - chunk_y * size:y1 - chunk_y * size, x0 - chunk_x * size:x1 - chunk_x * size]
+        return region
@@ -0,0 +1,73 @@
+# Encodes the observations of one client as deltas. The first message and every keyframe_interval-th
+# message after it is a keyframe with the full observations. The other messages only carry the cells
+# whose elements changed since the last message, the coordinates of the cells that are no longer observed,
+# for example because they left the window, plus the fields that change every step.
+#
+# In the fov memory mode the staleness of the remembered cells grows every step. A remembered cell is only
+# sent again when its elements change or when it becomes visible or remembered, the client computes the
+# staleness from the step.
+class DeltaEncoder:
+
+    def __init__(self, keyframe_interval=100):
+        if keyframe_interval < 1:
+            raise ValueError("The keyframe interval must be at least 1")
+        self.keyframe_interval = keyframe_interval
+        self.reset()
+
+
+    def reset(self):
+        # Forget what the client knows. The next message will be a keyframe.
+        self.cells = {}
+        self.messages_since_keyframe = None
+
+
+    @staticmethod
+    def get_state(cell, step):
+        # The state of a cell that the client knows. A visible cell stays visible and the step in which
+        # a remembered cell was seen does not change.
+        staleness = cell.get("staleness")
+        if staleness is None:
+            return cell["elements"], None
+        if staleness == 0:
+            return cell["elements"], "visible"
+        return cell["elements"], step - staleness
+
+
+    def encode(self, observations):
+        step = observations["step"]
+        cells = list(observations["cells"])
+
+        # Send a keyframe if it is the first message or if the interval has passed.
+        if self.messages_since_keyframe is None or self.messages_since_keyframe >= self.keyframe_interval:
+            self.cells = {(cell["x"], cell["y"]): DeltaEncoder.get_state(cell, step) for cell in cells}
+            self.messages_since_keyframe = 1
+            return {
+                "observations": dict(observations, cells=cells),
+                "delta": True,
+                "keyframe": True,
+            }
+
+        # Only keep the cells that changed and remember the ones that are no longer observed.
+        changed_cells = []
+        known_cells = {}
+        for cell in cells:
+            coordinates = (cell["x"], cell["y"])
+            state = DeltaEncoder.get_state(cell, step)
+            if self.cells.get(coordinates) != state:
+                changed_cells.append(cell)
+            known_cells[coordinates] = state
+        removed_cells = [[x, y] for x, y in self.cells.keys() - known_cells.keys()]
+        self.cells = known_cells
+        self.messages_since_keyframe += 1
+
+        return {
+            "observations": {
+                "me": observations["me"],
+                "step": step,
+                "inventory": observations["inventory"],
+                "cells": changed_cells,
+                "removed_cells": removed_cells,
+            },
+            "delta": True,
+            "keyframe": False,
+        }
@@ -1,7 +1,24 @@
 class Entity:
 
+    # The entities have a name, a position and a state. The subclasses declare where they are kept.
+    # There can be very many entities, so they have no __dict__.
+    __slots__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.attributes = tuple(attribute for base in reversed(cls.__mro__) for attribute in base.__dict__.get("__slots__", ()))
+
     def __init__(self, name, x, y):
         self.name = name
         self.x = x
         self.y = y
-        self.state = "normal"
\ No newline at end of file
+        self.state = "normal"
+
+    def copy(self):
+        # A shallow copy that is faster than copy.copy.
+        entity = self.__class__.__new__(self.__class__)
+        for attribute in self.attributes:
+            setattr(entity, attribute, getattr(self, attribute))
+        return entity
+
+Entity.attributes = Entity.__slots__
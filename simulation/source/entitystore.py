@@ -0,0 +1,245 @@
+import itertools
+import numpy as np
+from .item import Item
+
+# The owner code of the items that are on the grid.
+NO_OWNER = -1
+
+# The columns of the store.
+COLUMNS = ["xs", "ys", "types", "states", "owners", "used", "generations"]
+
+
+# The items of a simulation, on the grid and in the inventories, with their data in columns.
+# The columns are the only copy of the data. They hold the position, the type code, the state code and the
+# owner code of each item, so that scans by type or owner are array operations. The Item objects are views
+# of the rows that read and write the columns, only the name is also kept by the item. The id of an item is
+# its row. The row of a removed item is given to the next item that is added, so the columns only grow with
+# the number of items that exist at once. The generation of a row counts its removals, the items check it, so
+# that an item that was removed does not read the item that got its row.
+class EntityStore:
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.size = 0
+
+        # The number of rows that were ever used and the rows that are free again.
+        self.next_id = 0
+        self.free_ids = []
+
+        # The tables of the codes. The owners are the ids of the agents.
+        self.type_names = []
+        self.type_codes = {}
+        self.state_names = []
+        self.state_codes = {}
+        self.owner_ids = []
+        self.owner_codes = {}
+
+        # The columns and the item of each row, None for the free rows.
+        self.xs = np.zeros(capacity, dtype=np.int32)
+        self.ys = np.zeros(capacity, dtype=np.int32)
+        self.types = np.zeros(capacity, dtype=np.uint16)
+        self.states = np.zeros(capacity, dtype=np.uint8)
+        self.owners = np.zeros(capacity, dtype=np.int32)
+        self.used = np.zeros(capacity, dtype=bool)
+        self.generations = np.zeros(capacity, dtype=np.uint32)
+        self.items = []
+
+        # The rows that changed since the changes were last taken. None while the changes are not tracked.
+        self.changed_rows = None
+
+
+    def __len__(self):
+        return self.size
+
+
+    def __iter__(self):
+        return (self.get_item(uid) for uid, item in enumerate(self.items) if item is not None)
+
+
+    def fork(self):
+        # Create a store with copies of the columns. It shares the items with this store until it reads them.
+        store = EntityStore.__new__(EntityStore)
+        store.__dict__.update(self.__dict__)
+        store.free_ids = list(self.free_ids)
+        for name in ["type_names", "state_names", "owner_ids"]:
+            setattr(store, name, list(getattr(self, name)))
+        for name in ["type_codes", "state_codes", "owner_codes"]:
+            setattr(store, name, dict(getattr(self, name)))
+        for name in COLUMNS:
+            setattr(store, name, getattr(self, name).copy())
+        store.items = list(self.items)
+        store.changed_rows = None
+        return store
+
+
+    def get_item(self, uid):
+        # Returns the item of a row. An item that is shared with the store this one was forked from is replaced
+        # with a view of this store.
+        item = self.items[uid]
+        if item.store is not self:
+            item = Item(self, uid, item.name, item.generation)
+            self.items[uid] = item
+        return item
+
+
+    def get_code(self, codes, values, value):
+        code = codes.get(value)
+        if code is None:
+            code = len(values)
+            codes[value] = code
+            values.append(value)
+        return code
+
+
+    def reserve(self, count):
+        # Grow the columns so that count more rows fit.
+        if self.next_id + count <= self.capacity:
+            return
+        while self.next_id + count > self.capacity:
+            self.capacity *= 2
+        for name in COLUMNS:
+            column = getattr(self, name)
+            grown = np.zeros(self.capacity, dtype=column.dtype)
+            grown[:self.next_id] = column[:self.next_id]
+            setattr(self, name, grown)
+
+
+    def allocate(self, count):
+        # Returns the ids of count new items. The free rows are used first.
+        reused = [self.free_ids.pop() for _ in range(min(count, len(self.free_ids)))]
+        count -= len(reused)
+        self.reserve(count)
+        self.items += [None] * count
+        uids = np.concatenate([np.array(reused, dtype=np.int64), np.arange(self.next_id, self.next_id + count)])
+        self.next_id += count
+        return uids
+
+
+    def add(self, name, x, y, state="normal", owner=None):
+        # Adds an item and returns it.
+        uid = int(self.allocate(1)[0])
+        self.xs[uid] = x
+        self.ys[uid] = y
+        self.types[uid] = self.get_code(self.type_codes, self.type_names, name)
+        self.set_state(uid, state)
+        self.set_owner(uid, owner)
+        self.used[uid] = True
+        if self.changed_rows is not None:
+            self.changed_rows.add(uid)
+        item = Item(self, uid, self.type_names[self.types[uid]], self.generations.item(uid))
+        self.items[uid] = item
+        self.size += 1
+        return item
+
+
+    def extend(self, names, codes, xs, ys):
+        # Adds many items on the grid at once, given as arrays of codes into names and of positions. The columns are
+        # filled with array operations. Returns the items. Without free rows, the items get the rows at the end.
+        first = self.next_id if len(self.free_ids) == 0 else None
+        uids = self.allocate(len(codes))
+        type_codes = np.array([self.get_code(self.type_codes, self.type_names, name) for name in names], dtype=np.uint16)
+        self.xs[uids] = xs
+        self.ys[uids] = ys
+        self.types[uids] = type_codes[codes]
+        self.states[uids] = self.get_code(self.state_codes, self.state_names, "normal")
+        self.owners[uids] = NO_OWNER
+        self.used[uids] = True
+        uids = uids.tolist()
+        if self.changed_rows is not None:
+            self.changed_rows.update(uids)
+        items = list(map(Item, itertools.repeat(self, len(uids)), uids, np.array(names, dtype=object)[codes].tolist(), self.generations[uids].tolist()))
+        if first is not None:
+            self.items[first:first + len(items)] = items
+        else:
+            for uid, item in zip(uids, items):
+                self.items[uid] = item
+        self.size += len(items)
+        return items
+
+
+    def set_state(self, uid, state):
+        self.states[uid] = self.get_code(self.state_codes, self.state_names, state)
+        if self.changed_rows is not None:
+            self.changed_rows.add(uid)
+
+
+    def get_owner(self, uid):
+        code = self.owners.item(uid)
+        return None if code == NO_OWNER else self.owner_ids[code]
+
+
+    def set_owner(self, uid, owner):
+        self.owners[uid] = NO_OWNER if owner is None else self.get_code(self.owner_codes, self.owner_ids, owner)
+        if self.changed_rows is not None:
+            self.changed_rows.add(uid)
+
+
+    def remove(self, item):
+        # Free the row of the item. The item keeps its id, so that a fork can still find its own item for it.
+        # The generation of the row changes, so the item can not be used anymore.
+        uid = item.uid
+        self.used[uid] = False
+        self.generations[uid] += 1
+        self.items[uid] = None
+        self.free_ids.append(uid)
+        self.size -= 1
+        if self.changed_rows is not None:
+            self.changed_rows.add(uid)
+
+
+    def track_changes(self):
+        # Start to track the rows that change, for take_changes.
+        self.changed_rows = set()
+
+
+    def take_changes(self):
+        # Returns the rows that changed since the tracking started or since the last call. Each is mapped to the
+        # name, the position and the state of the item on the grid in it, or to None if there is none.
+        changes = {}
+        for row in sorted(self.changed_rows):
+            if self.used[row] and self.owners[row] == NO_OWNER:
+                changes[row] = (self.type_names[self.types.item(row)], self.xs.item(row), self.ys.item(row), self.state_names[self.states.item(row)])
+            else:
+                changes[row] = None
+        self.changed_rows = set()
+        return changes
+
+
+    def get_mask(self, name=None, owned=None):
+        # Returns a mask of the rows of the items with the name, and that are owned or on the grid.
+        mask = self.used[:self.next_id].copy()
+        if name is not None:
+            code = self.type_codes.get(name)
+            if code is None:
+                return np.zeros(self.next_id, dtype=bool)
+            mask &= self.types[:self.next_id] == code
+        if owned is not None:
+            mask &= (self.owners[:self.next_id] != NO_OWNER) == owned
+        return mask
+
+
+    def count(self, name=None, owned=None):
+        if name is None and owned is None:
+            return self.size
+        return int(np.count_nonzero(self.get_mask(name, owned)))
+
+
+    def get_rows(self, name=None, owned=None):
+        # Returns the rows of the items with the name, and that are owned or on the grid, ordered by position and
+        # then by id. The ids are reused, so they do not give an order that survives a restore.
+        rows = np.flatnonzero(self.get_mask(name, owned))
+        return rows[np.lexsort((rows, self.xs[rows], self.ys[rows]))]
+
+
+    def select(self, name=None, owned=None):
+        # Returns the items in the order of get_rows.
+        return [self.get_item(row) for row in self.get_rows(name, owned).tolist()]
+
+
+    def get_records(self, name=None, owned=None):
+        # Returns the name, the position and the state of the items in the order of get_rows. Read from the columns
+        # only, so a fork does not need its own items for it.
+        rows = self.get_rows(name, owned)
+        names = [self.type_names[code] for code in self.types[rows].tolist()]
+        states = [self.state_names[code] for code in self.states[rows].tolist()]
+        return list(zip(names, self.xs[rows].tolist(), self.ys[rows].tolist(), states))
@@ -0,0 +1,79 @@
+import itertools
+import numpy as np
+from .grid import CELL_CODES
+
+# The ray tables per radius. They only depend on the radius and are shared by all the simulations.
+RAY_TABLES = {}
+
+# The static versions of the grids. A grid gets a new version whenever its static cells change.
+STATIC_VERSIONS = itertools.count(1)
+
+
+def get_ray_table(radius):
+    # Returns the offsets of the cells within the radius, and for each of them the indices of the cells on
+    # the line of sight from the center. The lines are padded with the index of the center.
+    table = RAY_TABLES.get(radius)
+    if table is None:
+        offsets = [(dx, dy) for dy in range(-radius, radius + 1) for dx in range(-radius, radius + 1) if dx * dx + dy * dy <= radius * radius + radius]
+        indices = {offset: index for index, offset in enumerate(offsets)}
+        lines = []
+        for dx, dy in offsets:
+            steps = max(abs(dx), abs(dy))
+            lines.append([indices[(round(dx * step / steps), round(dy * step / steps))] for step in range(1, steps)])
+        blockers = np.full((len(offsets), max(1, max(len(line) for line in lines))), indices[(0, 0)], dtype=np.int32)
+        for index, line in enumerate(lines):
+            blockers[index, :len(line)] = line
+        table = (np.array(offsets, dtype=np.int64), blockers, indices[(0, 0)])
+        RAY_TABLES[radius] = table
+    return table
+
+
+# Computes the cells that are visible from a position. Walls block the sight, but are visible themselves.
+# The visible cells are cached per position until the static cells of the grid change.
+class FieldOfView:
+
+    def __init__(self, radius, max_cached_positions=65536):
+        self.radius = radius
+        self.offsets, self.blockers, self.center = get_ray_table(radius)
+        self.max_cached_positions = max_cached_positions
+        self.cache = {}
+        self.static_version = None
+
+
+    def get_visible_cells(self, grid, x, y):
+        # Forget the cached cells if the static cells changed.
+        if grid.static_version != self.static_version or len(self.cache) >= self.max_cached_positions:
+            self.cache.clear()
+            self.static_version = grid.static_version
+
+        cells = self.cache.get((x, y))
+        if cells is None:
+            radius = self.radius
+
+            # Get the walls around the position. The cells outside of the grid are walls.
+            size = 2 * radius + 1
+            walls = np.ones((size, size), dtype=bool)
+            start_x, start_y = max(0, x - radius), max(0, y - radius)
+            end_x, end_y = min(grid.width, x + radius + 1), min(grid.height, y + radius + 1)
+            region = (slice(start_y - y + radius, end_y - y + radius), slice(start_x - x + radius, end_x - x + radius))
+            walls[region] = grid.get_celltype_codes(start_x, start_y, end_x, end_y) == CELL_CODES["wall"]
+
+            # A cell is visible if there is no wall on its line of sight.
+            offset_rows = self.offsets[:, 1] + radius
+            offset_columns = self.offsets[:, 0] + radius
+            transparent = ~walls[offset_rows, offset_columns]
+            transparent[self.center] = True
+            visible = transparent[self.blockers].all(axis=1)
+
+            # Walls next to a visible free cell are visible too. Otherwise the lines of sight along a wall hide it.
+            lit = np.zeros((size + 2, size + 2), dtype=bool)
+            lit[offset_rows[visible & transparent] + 1, offset_columns[visible & transparent] + 1] = True
+            lit = lit[:-2, 1:-1] | lit[2:, 1:-1] | lit[1:-1, :-2] | lit[1:-1, 2:]
+            visible |= ~transparent & lit[offset_rows, offset_columns]
+
+            xs = self.offsets[:, 0] + x
+            ys = self.offsets[:, 1] + y
+            visible &= (xs >= 0) & (xs < grid.width) & (ys >= 0) & (ys < grid.height)
+            cells = list(zip(xs[visible].tolist(), ys[visible].tolist()))
+            self.cache[(x, y)] = cells
+        return cells
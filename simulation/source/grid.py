@@ -1,5 +1,20 @@
-# A grid with with and height of cells. Each cell contains a list of entities.
+import operator
+import itertools
+import numpy as np
 
+# The static cell types. The index of a cell type is its code in the static cells array.
+CELL_TYPES = ["empty", "wall"]
+CELL_CODES = {cell_type: code for code, cell_type in enumerate(CELL_TYPES)}
+
+# Maps layout characters to static cell codes. Every other character is an empty cell.
+LAYOUT_CELL_CODES = np.full(256, CELL_CODES["empty"], dtype=np.uint8)
+LAYOUT_CELL_CODES[ord("X")] = CELL_CODES["wall"]
+
+
+# A grid with with and height of cells. Each cell has a static cell type and contains a list of entities.
+# The static cell types are stored as a uint8 array of codes, indexed by [y, x].
+# The entities are stored in an incremental spatial index. Only the occupied cells have a bucket and
+# the index is updated when entities are added, moved or removed, never rebuilt.
 class Grid:
 
     def __init__(self, config):
@@ -9,29 +24,104 @@ class Grid:
 
         # Load the config and get the with and height of the grid.
         layout = config["layout"]
-        height = len(layout)
-        widths = [len(row.replace(" ", "")) for row in layout]
+        rows = [row.replace(" ", "") for row in layout]
+        height = len(rows)
+        widths = [len(row) for row in rows]
         if len(set(widths)) != 1:
             raise ValueError("All rows in the grid must have the same width")
         width = widths[0]
         del widths
 
-        # Set the cells.
-        self.static_cells = [["empty" for _ in range(width)] for _ in range(height)]
-        y = 0
-        for row in layout:
-            row = row.replace(" ", "")
-            x = 0
-            for cell in row:
-                if cell == "X":
-                    self.static_cells[y][x] = "wall"
-                x += 1
-            y += 1
+        # Set the cells. Map all characters to cell codes at once.
+        characters = np.frombuffer("".join(rows).encode("ascii"), dtype=np.uint8).reshape(height, width)
+        self.__initialize(LAYOUT_CELL_CODES[characters])
+
+
+    @staticmethod
+    def from_cells(cells):
+        # Create a grid from an array of static cell codes, indexed by [y, x]. For example from a compiled level.
+        grid = Grid.__new__(Grid)
+        grid.__initialize(cells)
+        return grid
+
+
+    def __initialize(self, cells):
+        self.static_cells = cells
+        self.height, self.width = cells.shape
+
+        # The version of the static cells. They do not change.
+        self.static_version = 0
+
+        # The entities. The number of entities per cell and the entities of the occupied cells.
+        self.entity_counts = np.zeros((self.height, self.width), dtype=np.uint16)
+        self.cells_entities = {}
 
+        # The positions per entity name. Maps a name to a dictionary of positions and the number of entities there.
+        self.positions_by_name = {}
 
-        self.width = width
-        self.height = height
-        self.cells_entities = [[[] for _ in range(self.width)] for _ in range(self.height)]
+        # The number of entities per name, and the cells that the triggers watch and that entities entered.
+        self.name_counts = {}
+        self.watched_cells = set()
+        self.entered_cells = set()
+
+        # The cells and the names whose buckets and positions this grid owns. None while it shares none with a fork.
+        # copy_entity returns the own entity for an entity of the grid this one was forked from.
+        self.owned_cells = None
+        self.owned_names = None
+        self.copy_entity = None
+
+
+    def fork(self, copy_entity):
+        # Create a grid that shares the static cells and the entity index. The buckets and the positions of the
+        # names stay shared until one of the grids changes them, then that grid copies them first.
+        grid = Grid.__new__(Grid)
+        grid.static_cells = self.static_cells
+        grid.width = self.width
+        grid.height = self.height
+        grid.static_version = self.static_version
+        grid.entity_counts = self.entity_counts.copy()
+        grid.cells_entities = dict(self.cells_entities)
+        grid.positions_by_name = dict(self.positions_by_name)
+        grid.name_counts = dict(self.name_counts)
+        grid.watched_cells = set()
+        grid.entered_cells = set()
+        grid.owned_cells = set()
+        grid.owned_names = set()
+        grid.copy_entity = copy_entity
+        self.owned_cells = set()
+        self.owned_names = set()
+        return grid
+
+
+    def own_bucket(self, position):
+        # Returns the bucket of a cell to change it, after copying it if it is shared. A copy of the fork gets the
+        # own entities of the fork.
+        bucket = self.cells_entities[position]
+        if self.owned_cells is None or position in self.owned_cells:
+            return bucket
+        if self.copy_entity is None:
+            bucket = list(bucket)
+        else:
+            bucket = [self.copy_entity(entity) for entity in bucket]
+        self.cells_entities[position] = bucket
+        self.owned_cells.add(position)
+        return bucket
+
+
+    def own_positions(self, name):
+        # Returns the positions of a name to change them, after copying them if they are shared.
+        positions = self.positions_by_name.get(name)
+        if positions is None:
+            positions = {}
+            self.positions_by_name[name] = positions
+        elif self.owned_names is None or name in self.owned_names:
+            return positions
+        else:
+            positions = dict(positions)
+            self.positions_by_name[name] = positions
+        if self.owned_names is not None:
+            self.owned_names.add(name)
+        return positions
 
 
     def raiseIfConfigInvalid(self, config):
@@ -40,19 +130,169 @@ class Grid:
         pass
 
     def clear_entities(self):
-        self.cells_entities = [[[] for _ in range(self.width)] for _ in range(self.height)]
+        self.entity_counts.fill(0)
+        self.cells_entities.clear()
+        self.positions_by_name.clear()
+        self.name_counts.clear()
 
     def add_entity(self, entity, x, y):
-        self.cells_entities[y][x].append(entity)
+        entity.x = x
+        entity.y = y
+
+        # Add the entity to the bucket of the cell. The indexes share the position, to save memory.
+        position = (x, y)
+        if position not in self.cells_entities:
+            self.cells_entities[position] = [entity]
+            if self.owned_cells is not None:
+                self.owned_cells.add(position)
+        else:
+            self.own_bucket(position).append(entity)
+        self.entity_counts[y, x] += 1
+
+        # Add the position to the positions of the name.
+        positions = self.own_positions(entity.name)
+        positions[position] = positions.get(position, 0) + 1
+        self.name_counts[entity.name] = self.name_counts.get(entity.name, 0) + 1
+        if position in self.watched_cells:
+            self.entered_cells.add(position)
+
+    def add_entities(self, entities, xs, ys, codes, names):
+        # Adds many entities that already have their positions, for example the items of a level. The names are
+        # given as codes into names. Entities on cells that were empty and get only one of them are indexed with
+        # array operations, otherwise the entities are added one by one.
+        if len(entities) == 0:
+            return
+        if self.entity_counts[ys, xs].any() or len(np.unique(ys.astype(np.int64) * self.width + xs)) < len(xs):
+            for entity, x, y in zip(entities, xs.tolist(), ys.tolist()):
+                self.add_entity(entity, x, y)
+            return
+        self.entity_counts[ys, xs] = 1
+
+        # Every entity gets a new bucket.
+        positions = list(zip(xs.tolist(), ys.tolist()))
+        self.cells_entities.update(zip(positions, [[entity] for entity in entities]))
+        if self.owned_cells is not None:
+            self.owned_cells.update(positions)
+
+        # Add the positions to the positions of the names.
+        for code in np.unique(codes).tolist():
+            selected = codes == code
+            positions_of_name = self.own_positions(names[code])
+            positions_of_name.update(zip(itertools.compress(positions, selected.tolist()), itertools.repeat(1)))
+            self.name_counts[names[code]] = self.name_counts.get(names[code], 0) + int(np.count_nonzero(selected))
+        if len(self.watched_cells) > 0:
+            self.entered_cells.update(self.watched_cells.intersection(positions))
+
+    def remove_entity(self, entity):
+        x, y = entity.x, entity.y
+
+        # Remove the entity from the bucket of the cell.
+        bucket = self.own_bucket((x, y))
+        bucket.remove(entity)
+        if len(bucket) == 0:
+            del self.cells_entities[(x, y)]
+        self.entity_counts[y, x] -= 1
+
+        # Remove the position from the positions of the name.
+        positions = self.own_positions(entity.name)
+        if positions[(x, y)] == 1:
+            del positions[(x, y)]
+        else:
+            positions[(x, y)] -= 1
+        self.name_counts[entity.name] -= 1
+
+    def move_entity(self, entity, x, y):
+        self.remove_entity(entity)
+        self.add_entity(entity, x, y)
+
+    def move_entities(self, entities, xs, ys):
+        # Moves many entities at once. The numbers of entities per cell are updated with array operations.
+        old_xs = np.fromiter(map(operator.attrgetter("x"), entities), dtype=np.int64, count=len(entities))
+        old_ys = np.fromiter(map(operator.attrgetter("y"), entities), dtype=np.int64, count=len(entities))
+        np.subtract.at(self.entity_counts, (old_ys, old_xs), 1)
+        np.add.at(self.entity_counts, (ys, xs), 1)
+
+        # Update the buckets and the positions per name. The new positions are built as tuples in one go.
+        # The buckets and the positions are only looked up directly while the grid shares none with a fork.
+        cells_entities = self.cells_entities
+        if self.owned_cells is None:
+            get_bucket = cells_entities.__getitem__
+            get_positions = self.positions_by_name.__getitem__
+        else:
+            get_bucket = self.own_bucket
+            get_positions = self.own_positions
+        for entity, position in zip(entities, zip(xs.tolist(), ys.tolist())):
+            old_position = (entity.x, entity.y)
+            if len(cells_entities[old_position]) == 1:
+                del cells_entities[old_position]
+            else:
+                get_bucket(old_position).remove(entity)
+            positions = get_positions(entity.name)
+            count = positions[old_position]
+            if count == 1:
+                del positions[old_position]
+            else:
+                positions[old_position] = count - 1
+
+            if position not in cells_entities:
+                cells_entities[position] = [entity]
+                if self.owned_cells is not None:
+                    self.owned_cells.add(position)
+            else:
+                get_bucket(position).append(entity)
+            positions[position] = positions.get(position, 0) + 1
+            entity.x, entity.y = position
+
+        # Record the watched cells that were entered.
+        if len(self.watched_cells) > 0:
+            self.entered_cells.update(self.watched_cells.intersection(zip(xs.tolist(), ys.tolist())))
+
+    def get_positions(self, name):
+        # Returns the positions of all the entities with the given name as a set-like view.
+        return self.positions_by_name.get(name, {}).keys()
+
+    def count_entities(self, name):
+        return self.name_counts.get(name, 0)
+
+    def count_entities_at(self, name, xs, ys):
+        # Returns the numbers of the entities with the given name at the positions as an array.
+        counts = self.positions_by_name.get(name, {})
+        return np.fromiter((counts.get(position, 0) for position in zip(xs.tolist(), ys.tolist())), dtype=np.int64, count=len(xs))
+
+    def get_celltype_code(self, x, y):
+        return self.static_cells[y, x]
 
     def get_celltype_at(self, x, y):
-        return self.static_cells[y][x]
+        return CELL_TYPES[self.static_cells[y, x]]
+
+    def get_celltype_codes_at(self, xs, ys):
+        # Returns the cell codes at arrays of coordinates.
+        return self.static_cells[ys, xs]
+
+    def get_celltype_codes(self, start_x, start_y, end_x, end_y):
+        # Returns a read-only view on the cell codes of a region, indexed by [y, x].
+        region = self.static_cells[start_y:end_y, start_x:end_x]
+        region.flags.writeable = False
+        return region
+
+    def get_entity_counts(self, start_x, start_y, end_x, end_y):
+        # Returns a read-only view on the number of entities per cell of a region, indexed by [y, x].
+        region = self.entity_counts[start_y:end_y, start_x:end_x]
+        region.flags.writeable = False
+        return region
 
     def get_entity_names_at(self, x, y):
         # Include the names of the entities in the list.
-        return [entity.name for entity in self.cells_entities[y][x]]
+        return [entity.name for entity in self.cells_entities.get((x, y), [])]
 
     def get_entities_at(self, x, y):
-        return self.cells_entities[y][x]
+        # A fork gets its own entities for a shared bucket.
+        bucket = self.cells_entities.get((x, y), [])
+        if self.copy_entity is None or (x, y) in self.owned_cells:
+            return bucket
+        return [self.copy_entity(entity) for entity in bucket]
 
-    
+    def get_occupied_cells(self):
+        # Returns the positions and the entities of all the cells with entities. The entities of the shared
+        # buckets of a fork can be the ones of the grid it was forked from, which have the same names.
+        return self.cells_entities.items()
@@ -1,6 +1,62 @@
 from .entity import Entity
 
+# An item is a view of its row in the entity store. The position, the state and the owner are read from the
+# columns and written to them. The name never changes, the item keeps the name of its type so that the hot
+# paths do not have to look it up. Items are created by the store. A removed item keeps its uid. The row of a
+# removed item is reused, so the item keeps the generation of its row and checks it on access, a stale item
+# raises instead of reading the item that has the row now.
 class Item(Entity):
 
-    def __init__(self, name, x, y):
-        super().__init__(name, x, y)
+    __slots__ = ("store", "uid", "name", "generation")
+
+    def __init__(self, store, uid, name, generation):
+        self.store = store
+        self.uid = uid
+        self.name = name
+        self.generation = generation
+
+    def get_store(self):
+        store = self.store
+        if store.generations.item(self.uid) != self.generation:
+            raise ValueError(f"The item {self.uid} ({self.name}) was removed from the store")
+        return store
+
+    @property
+    def x(self):
+        return self.get_store().xs.item(self.uid)
+
+    @x.setter
+    def x(self, x):
+        store = self.get_store()
+        store.xs[self.uid] = x
+        if store.changed_rows is not None:
+            store.changed_rows.add(self.uid)
+
+    @property
+    def y(self):
+        return self.get_store().ys.item(self.uid)
+
+    @y.setter
+    def y(self, y):
+        store = self.get_store()
+        store.ys[self.uid] = y
+        if store.changed_rows is not None:
+            store.changed_rows.add(self.uid)
+
+    @property
+    def state(self):
+        store = self.get_store()
+        return store.state_names[store.states.item(self.uid)]
+
+    @state.setter
+    def state(self, state):
+        self.get_store().set_state(self.uid, state)
+
+    @property
+    def owner(self):
+        # The id of the agent that has the item in its inventory, None if it is on the grid.
+        return self.get_store().get_owner(self.uid)
+
+    @owner.setter
+    def owner(self, owner):
+        self.get_store().set_owner(self.uid, owner)
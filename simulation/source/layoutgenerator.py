@@ -1,57 +1,147 @@
-import random
+import numpy as np
+
+# Use scipy for labeling the regions if it is installed. Otherwise fall back to numpy.
+try:
+    from scipy import ndimage
+except ImportError:
+    ndimage = None
+
+# The layout characters as byte values.
+EMPTY = ord(".")
+WALL = ord("X")
+GOLD = ord("G")
+TROVE = ord("T")
+
 
 class LayoutGenerator:
-    
+
     @staticmethod
     def generate(seed, width, height, obstacle_density, gold_density, agents):
 
-        if seed is not None:
-            random.seed(seed)
-        
-        # Initialize layout with empty spaces
-        layout = [['.' for _ in range(width)] for _ in range(height)]
-        
-        # Fill borders with 'X'
-        for i in range(width):
-            layout[0][i] = 'X'
-            layout[height-1][i] = 'X'
-        for i in range(height):
-            layout[i][0] = 'X'
-            layout[i][width-1] = 'X'
-        
-        # Calculate number of obstacles and gold pieces
-        num_obstacles = int(obstacle_density * (width - 2) * (height - 2))
-        num_gold = int(gold_density * (width - 2) * (height - 2))
-        
-        # Function to place items randomly
-        def place_items(symbol, count):
-            placed = 0
-            while placed < count:
-                x = random.randint(1, width - 2)
-                y = random.randint(1, height - 2)
-                if layout[y][x] == '.':
-                    layout[y][x] = symbol
-                    placed += 1
-        
-        # Place obstacles and gold
-        place_items('X', num_obstacles)
-        place_items('G', num_gold)
-        place_items('T', 1)
-        
-        # Place agents
-        for agent_index in range(agents):
-            placed = False
-            while not placed:
-                x = random.randint(1, width - 2)
-                y = random.randint(1, height - 2)
-                if layout[y][x] == '.':
-                    layout[y][x] = str(agent_index + 1)
-                    placed = True
-        
-        # Convert layout to list of strings
-        layout =  [' '.join(row) for row in layout]
+        # Generate one layout and convert it to a list of strings.
+        characters = LayoutGenerator.generate_arrays(1, seed, width, height, obstacle_density, gold_density, agents)[0]
+        layout = LayoutGenerator.to_strings(characters)
 
         for row in layout:
             print(row)
 
         return layout
+
+
+    @staticmethod
+    def generate_batch(count, seed, width, height, obstacle_density, gold_density, agents):
+        characters = LayoutGenerator.generate_arrays(count, seed, width, height, obstacle_density, gold_density, agents)
+        return [LayoutGenerator.to_strings(layout_characters) for layout_characters in characters]
+
+
+    @staticmethod
+    def generate_arrays(count, seed, width, height, obstacle_density, gold_density, agents, max_attempts=100):
+        # Generates count layouts at once as a (count, height, width) array of layout characters.
+        # The seed can be an integer, None or a numpy random generator.
+        random = np.random.default_rng(seed)
+        if agents > 9:
+            raise ValueError("At most 9 agents are supported")
+
+        # Generate the layouts. The ones where the largest region is too small are generated again.
+        characters = np.zeros((count, height, width), dtype=np.uint8)
+        missing = np.arange(count)
+        for _ in range(max_attempts):
+            generated, valid = LayoutGenerator.__generate_arrays(random, len(missing), width, height, obstacle_density, gold_density, agents)
+            characters[missing[valid]] = generated[valid]
+            missing = missing[~valid]
+            if len(missing) == 0:
+                return characters
+        raise ValueError("Not enough reachable cells for the gold, the trove and the agents")
+
+
+    @staticmethod
+    def __generate_arrays(random, count, width, height, obstacle_density, gold_density, agents):
+
+        # Initialize layouts with empty spaces and fill the borders with walls.
+        characters = np.full((count, height, width), EMPTY, dtype=np.uint8)
+        characters[:, [0, height - 1], :] = WALL
+        characters[:, :, [0, width - 1]] = WALL
+
+        # Calculate number of obstacles and gold pieces.
+        interior_width = width - 2
+        interior_height = height - 2
+        num_obstacles = int(obstacle_density * interior_width * interior_height)
+        num_gold = int(gold_density * interior_width * interior_height)
+        if num_obstacles > interior_width * interior_height:
+            raise ValueError("Too many obstacles for the size of the layout")
+
+        # Place the obstacles without replacement. The cells with the smallest random keys are taken.
+        if num_obstacles > 0:
+            keys = random.random((count, interior_width * interior_height))
+            obstacles = np.argpartition(keys, num_obstacles - 1, axis=1)[:, :num_obstacles]
+            interior = characters[:, 1:-1, 1:-1].reshape(count, -1)
+            np.put_along_axis(interior, obstacles, WALL, axis=1)
+            characters[:, 1:-1, 1:-1] = interior.reshape(count, interior_height, interior_width)
+
+        # Find the largest connected region of free cells in each layout.
+        labels = LayoutGenerator.label_regions(characters != WALL)
+        flat_labels = labels.reshape(count, -1)
+        region_sizes = np.bincount(flat_labels[flat_labels >= 0], minlength=count * height * width).reshape(count, -1)
+        largest_labels = region_sizes.argmax(axis=1) + np.arange(count) * height * width
+        in_region = flat_labels == largest_labels[:, None]
+
+        # Place the gold, the trove and the agents without replacement in the largest region. That way all of them are reachable.
+        num_placed = num_gold + 1 + agents
+        valid = in_region.sum(axis=1) >= num_placed
+        keys = random.random((count, height * width))
+        keys[~in_region] = np.inf
+        placed = np.argpartition(keys, num_placed - 1, axis=1)[:, :num_placed]
+        placed = np.take_along_axis(placed, np.argsort(np.take_along_axis(keys, placed, axis=1), axis=1), axis=1)
+        symbols = np.array([GOLD] * num_gold + [TROVE] + [ord(str(agent_index + 1)) for agent_index in range(agents)], dtype=np.uint8)
+        flat_characters = characters.reshape(count, -1)
+        np.put_along_axis(flat_characters, placed, symbols[None, :], axis=1)
+
+        return flat_characters.reshape(count, height, width), valid
+
+
+    @staticmethod
+    def label_regions(free):
+        # Labels the 4-connected regions of free cells. Works on a batch of (count, height, width) masks.
+        # Every free cell gets the smallest flat index of its region, other cells get -1.
+        # Labels are propagated to the neighbors and then shortened by pointer jumping until nothing changes.
+        size = free.size
+
+        # Label with scipy and map the labels to the smallest flat index of each region.
+        if ndimage is not None:
+            structure = np.zeros((3, 3, 3), dtype=bool)
+            structure[1] = [[False, True, False], [True, True, True], [False, True, False]]
+            regions, region_count = ndimage.label(free, structure)
+            smallest_indices = ndimage.minimum(np.arange(size).reshape(free.shape), regions, np.arange(1, region_count + 1))
+            lookup = np.concatenate([[-1], np.asarray(smallest_indices, dtype=np.int64)])
+            return lookup[regions]
+
+        labels = np.where(free, np.arange(size).reshape(free.shape), size)
+        while True:
+            neighbors = labels.copy()
+            np.minimum(neighbors[:, 1:, :], labels[:, :-1, :], out=neighbors[:, 1:, :])
+            np.minimum(neighbors[:, :-1, :], labels[:, 1:, :], out=neighbors[:, :-1, :])
+            np.minimum(neighbors[:, :, 1:], labels[:, :, :-1], out=neighbors[:, :, 1:])
+            np.minimum(neighbors[:, :, :-1], labels[:, :, 1:], out=neighbors[:, :, :-1])
+            neighbors[~free] = size
+
+            # Pointer jumping. A label is the index of a cell with a smaller or equal label.
+            flat = neighbors.reshape(-1)
+            free_flat = free.reshape(-1)
+            while True:
+                jumped = flat.copy()
+                jumped[free_flat] = flat[flat[free_flat]]
+                if np.array_equal(jumped, flat):
+                    break
+                flat = jumped
+            neighbors = flat.reshape(free.shape)
+
+            if np.array_equal(neighbors, labels):
+                break
+            labels = neighbors
+        return np.where(free, labels, -1)
+
+
+    @staticmethod
+    def to_strings(characters):
+        # Convert layout characters to a list of strings with the cells separated by spaces.
+        return [" ".join(row.tobytes().decode("ascii")) for row in characters]
@@ -0,0 +1,170 @@
+import os
+import json
+import tempfile
+import struct
+import hashlib
+import numpy as np
+from .grid import LAYOUT_CELL_CODES
+
+# The entity types of a compiled level. The index of an entity type is its code in the entity table.
+ENTITY_TYPES = ["gold", "trove", "enemy", "door", "staircase", "key"]
+
+# Maps layout characters to entity codes. Every other character is no entity.
+LAYOUT_ENTITY_CODES = np.full(256, -1, dtype=np.int16)
+for character, entity_type in [("G", "gold"), ("T", "trove"), ("E", "enemy"), ("D", "door"), ("S", "staircase"), ("K", "key")]:
+    LAYOUT_ENTITY_CODES[ord(character)] = ENTITY_TYPES.index(entity_type)
+
+# The characters that are allowed in a layout.
+VALID_LAYOUT_CHARACTERS = np.zeros(256, dtype=bool)
+VALID_LAYOUT_CHARACTERS[np.frombuffer(b"12GTEDSK.X", dtype=np.uint8)] = True
+
+# The binary level format. A magic string, the version, a fixed header with the width, the height, the number of
+# entities, the number of agents and the length of the metadata, and the metadata with the exits and the triggers
+# as JSON. Then the raw uint8 cell plane, bottom row first, and the entity and agent tables, each starting at an
+# aligned offset so that they can be memory-mapped.
+MAGIC = b"GRIDLEVEL"
+VERSION = 1
+HEADER = struct.Struct("<IIIII")
+ALIGNMENT = 64
+
+
+# A level compiled from a layout. The cells are the static cell codes of the grid, indexed by [y, x], with the
+# first row at y = 0. The entities and agents are tables in the order in which they appear in the layout.
+class CompiledLevel:
+
+    def __init__(self, cells, entity_types, entity_x, entity_y, agent_x, agent_y, exits, triggers):
+        self.cells = cells
+        self.entity_types = entity_types
+        self.entity_x = entity_x
+        self.entity_y = entity_y
+        self.agent_x = agent_x
+        self.agent_y = agent_y
+        self.exits = exits
+        self.triggers = triggers
+
+
+    @staticmethod
+    def compile(layout, exits=None, triggers=None):
+        # Compiles a layout that is given bottom row first. All the characters are mapped at once.
+        rows = [row.replace(" ", "") for row in layout]
+        if len(set(len(row) for row in rows)) != 1:
+            raise ValueError("All rows in the grid must have the same width")
+        characters = np.frombuffer("".join(rows).encode("ascii"), dtype=np.uint8).reshape(len(rows), len(rows[0]))
+        invalid = ~VALID_LAYOUT_CHARACTERS[characters]
+        if invalid.any():
+            raise ValueError(f"Invalid cell type: {chr(characters[invalid][0])}")
+
+        # The static cells.
+        cells = LAYOUT_CELL_CODES[characters]
+
+        # The entities and the agents, row by row.
+        entity_codes = LAYOUT_ENTITY_CODES[characters]
+        entity_y, entity_x = np.nonzero(entity_codes >= 0)
+        entity_types = entity_codes[entity_y, entity_x].astype(np.uint8)
+        agent_y, agent_x = np.nonzero((characters == ord("1")) | (characters == ord("2")))
+
+        return CompiledLevel(
+            cells,
+            entity_types,
+            entity_x.astype(np.int32),
+            entity_y.astype(np.int32),
+            agent_x.astype(np.int32),
+            agent_y.astype(np.int32),
+            exits if exits is not None else {},
+            triggers if triggers is not None else [],
+        )
+
+
+    def get_entities(self):
+        # Returns the entities as a list of (entity_type, x, y).
+        return [(ENTITY_TYPES[entity_type], x, y) for entity_type, x, y in zip(self.entity_types.tolist(), self.entity_x.tolist(), self.entity_y.tolist())]
+
+
+    def get_agent_positions(self):
+        return list(zip(self.agent_x.tolist(), self.agent_y.tolist()))
+
+
+    def save(self, path):
+        metadata = json.dumps({"exits": self.exits, "triggers": self.triggers}).encode("utf-8")
+        height, width = self.cells.shape
+        header = MAGIC + bytes([VERSION]) + HEADER.pack(width, height, len(self.entity_types), len(self.agent_x), len(metadata)) + metadata
+
+        # Write the tables at aligned offsets. Write to a unique temporary file first and then rename it, so that
+        # processes that save the same level at once do not write into the same file.
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "wb") as f:
+                f.write(header)
+                for array in [self.cells, self.entity_types, self.entity_x, self.entity_y, self.agent_x, self.agent_y]:
+                    f.write(b"\0" * (-f.tell() % ALIGNMENT))
+                    f.write(np.ascontiguousarray(array).tobytes())
+            os.replace(temporary_path, path)
+        except Exception:
+            os.remove(temporary_path)
+            raise
+
+
+    @staticmethod
+    def load(path, mmap=False):
+        # With mmap the tables are memory-mapped read-only. Processes that load the same level share the pages.
+        with open(path, "rb") as f:
+            prefix = f.read(len(MAGIC) + 1 + HEADER.size)
+            if prefix[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"Not a compiled level: {path}")
+            if prefix[len(MAGIC)] != VERSION:
+                raise ValueError(f"Unsupported compiled level version: {prefix[len(MAGIC)]}")
+            width, height, entity_count, agent_count, metadata_length = HEADER.unpack_from(prefix, len(MAGIC) + 1)
+            metadata = json.loads(f.read(metadata_length).decode("utf-8"))
+            offset = len(prefix) + metadata_length
+
+            # Read or map the tables.
+            arrays = []
+            for dtype, count in [(np.uint8, width * height), (np.uint8, entity_count), (np.int32, entity_count), (np.int32, entity_count), (np.int32, agent_count), (np.int32, agent_count)]:
+                offset += -offset % ALIGNMENT
+                if count == 0:
+                    array = np.zeros(0, dtype=dtype)
+                elif mmap:
+                    array = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+                else:
+                    f.seek(offset)
+                    array = np.fromfile(f, dtype=dtype, count=count)
+                if len(array) != count:
+                    raise ValueError(f"Truncated compiled level: {path}")
+                arrays.append(array)
+                offset += count * np.dtype(dtype).itemsize
+        cells, entity_types, entity_x, entity_y, agent_x, agent_y = arrays
+
+        return CompiledLevel(cells.reshape(height, width), entity_types, entity_x, entity_y, agent_x, agent_y, metadata["exits"], metadata["triggers"])
+
+
+# Caches compiled levels on disk, keyed by a hash of the layout, the exits and the triggers.
+class LevelCache:
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.environ.get("GRID_LEVEL_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "thegrid", "levels"))
+        self.directory = directory
+
+
+    def load_or_compile(self, layout, exits=None, triggers=None):
+        # The layout is given bottom row first. The key also covers the version of the format and the entity types,
+        # so that a level compiled by another version is not loaded.
+        content = json.dumps({"version": VERSION, "entity_types": ENTITY_TYPES, "layout": list(layout), "exits": exits, "triggers": triggers}, sort_keys=True)
+        key = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        path = os.path.join(self.directory, f"{key}.level")
+
+        # Load the compiled level if it is in the cache.
+        if os.path.exists(path):
+            try:
+                return CompiledLevel.load(path, mmap=True)
+            except ValueError as exception:
+                print(f"Ignoring invalid cached level {path}: {exception}")
+
+        # Compile the level and store it. The cache is optional, a failing write is not an error.
+        level = CompiledLevel.compile(layout, exits, triggers)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            level.save(path)
+        except OSError as exception:
+            print(f"Could not cache the level in {self.directory}: {exception}")
+        return level
@@ -0,0 +1,26 @@
+import importlib
+
+
+# Loads a policy from a specification like "agents.source.codedagent:CodedAgent".
+def load_policy(specification):
+    if ":" not in specification:
+        raise ValueError(f"Invalid policy specification, expected 'module:name': {specification}")
+    module_name, attribute_name = specification.split(":", 1)
+    module = importlib.import_module(module_name)
+    if not hasattr(module, attribute_name):
+        raise ValueError(f"Policy {attribute_name} not found in module {module_name}")
+    return getattr(module, attribute_name)
+
+
+# Creates a function that maps a message to a response for one agent. The policy can be a specification,
+# a class that is instantiated like a socket agent, an object with a _handle_message method or a function.
+def create_policy(policy, agent_id):
+    if isinstance(policy, str):
+        policy = load_policy(policy)
+    if isinstance(policy, type):
+        policy = policy(agent_id, None)
+    if hasattr(policy, "_handle_message"):
+        return policy._handle_message
+    if callable(policy):
+        return policy
+    raise ValueError(f"Invalid policy: {policy}")
@@ -0,0 +1,156 @@
+from collections import OrderedDict, Counter
+import numpy as np
+from .grid import CELL_CODES
+from .chunkedgrid import ChunkedGrid, CHUNK_SIZE
+from .fieldofview import STATIC_VERSIONS
+
+
+# A very large procedural world that is streamed by chunk. A chunk is generated from the seed and its
+# coordinates when an observation window first reaches it, so the same chunk is always generated the same way.
+# When more than max_chunks chunks are loaded, the least recently used chunks that no agent observes are
+# evicted. The entities of an evicted chunk are saved if they changed, and restored when it is loaded again.
+# Chunks that are not loaded are walls. The trove and the agents start in a cleared room in the center.
+class ProceduralGrid(ChunkedGrid):
+
+    def __init__(self, parameters, agents):
+        super().__init__(parameters["width"], parameters["height"], parameters.get("chunk_size", CHUNK_SIZE))
+        self.seed = parameters["seed"]
+        self.obstacle_density = parameters["obstacle_density"]
+        self.gold_density = parameters["gold_density"]
+        self.max_chunks = parameters.get("max_chunks", 256)
+        if self.width < agents + 4 or self.height < 5:
+            raise ValueError("The procedural grid is too small for the agents")
+
+        # The trove and the agents are in a row in the center, in a room without walls and gold.
+        center_x = self.width // 2
+        center_y = self.height // 2
+        self.trove_position = (center_x, center_y)
+        self.agent_positions = [(center_x + 1 + agent_index, center_y) for agent_index in range(agents)]
+        self.room = (center_x - 1, center_y - 1, center_x + agents + 2, center_y + 2)
+
+        # The loaded chunks, least recently used first, and the entities of the evicted chunks that changed.
+        self.loaded_chunks = OrderedDict()
+        self.saved_chunks = {}
+
+
+    def fork(self, copy_entity):
+        grid = super().fork(copy_entity)
+        for name in ["seed", "obstacle_density", "gold_density", "max_chunks", "trove_position", "agent_positions", "room"]:
+            setattr(grid, name, getattr(self, name))
+        grid.static_chunks = dict(self.static_chunks)
+        grid.loaded_chunks = OrderedDict(self.loaded_chunks)
+        grid.saved_chunks = dict(self.saved_chunks)
+        return grid
+
+
+    def get_static_chunk(self, chunk_x, chunk_y):
+        return self.static_chunks.get((chunk_x, chunk_y), self.uniform_chunks[CELL_CODES["wall"]])
+
+
+    def generate_chunk(self, chunk_x, chunk_y):
+        # Returns the static cells and the entities of a chunk. Deterministic in the seed and the chunk coordinates.
+        size = self.chunk_size
+        random = np.random.default_rng([self.seed, chunk_x, chunk_y])
+        walls = random.random((size, size)) < self.obstacle_density
+        gold = random.random((size, size)) < self.gold_density
+
+        # The border and everything outside of the world are walls.
+        xs = chunk_x * size + np.arange(size)
+        ys = chunk_y * size + np.arange(size)
+        walls |= (xs[None, :] <= 0) | (xs[None, :] >= self.width - 1) | (ys[:, None] <= 0) | (ys[:, None] >= self.height - 1)
+
+        # Clear the room.
+        start_x, start_y, end_x, end_y = self.room
+        room = (xs[None, :] >= start_x) & (xs[None, :] < end_x) & (ys[:, None] >= start_y) & (ys[:, None] < end_y)
+        walls &= ~room
+        gold &= ~walls & ~room
+
+        # Share the chunk if it is all wall.
+        if walls.all():
+            cells = self.uniform_chunks[CELL_CODES["wall"]]
+        else:
+            cells = np.where(walls, CELL_CODES["wall"], CELL_CODES["empty"]).astype(np.uint8)
+            cells.flags.writeable = False
+
+        # The entities as (name, x, y, state).
+        gold_y, gold_x = np.nonzero(gold)
+        entities = [("gold", x, y, "normal") for x, y in zip((gold_x + chunk_x * size).tolist(), (gold_y + chunk_y * size).tolist())]
+        if self.get_chunk_key(*self.trove_position) == (chunk_x, chunk_y):
+            entities.append(("trove",) + self.trove_position + ("normal",))
+        return cells, entities
+
+
+    def get_chunk_key(self, x, y):
+        return (x // self.chunk_size, y // self.chunk_size)
+
+
+    def get_chunk_keys(self, start_x, start_y, end_x, end_y):
+        # Returns the keys of the chunks that overlap a region.
+        size = self.chunk_size
+        return [(chunk_x, chunk_y) for chunk_y in range(max(0, start_y) // size, -(-min(end_y, self.height) // size)) for chunk_x in range(max(0, start_x) // size, -(-min(end_x, self.width) // size))]
+
+
+    def load_region(self, start_x, start_y, end_x, end_y):
+        # Loads the chunks of a region that are not loaded yet and marks all of them as recently used.
+        # Returns the entities of the chunks that were loaded, for the simulation to add.
+        entities = []
+        for key in self.get_chunk_keys(start_x, start_y, end_x, end_y):
+            if key in self.loaded_chunks:
+                self.loaded_chunks.move_to_end(key)
+                continue
+            cells, generated_entities = self.generate_chunk(*key)
+            self.static_chunks[key] = cells
+            self.static_version = next(STATIC_VERSIONS)
+            self.loaded_chunks[key] = True
+            entities += self.saved_chunks.pop(key, generated_entities)
+        return entities
+
+
+    def get_chunks(self):
+        # Returns the loaded chunks, least recently used first, and the saved entities of the evicted chunks.
+        return {
+            "loaded": [list(key) for key in self.loaded_chunks],
+            "saved": [[chunk_x, chunk_y, list(entities)] for (chunk_x, chunk_y), entities in self.saved_chunks.items()],
+        }
+
+
+    def restore_chunks(self, chunks):
+        # Unloads all the chunks and loads the chunks from get_chunks again. Only their static cells are
+        # generated, the caller adds the entities on the grid.
+        self.static_chunks.clear()
+        self.loaded_chunks.clear()
+        for chunk_x, chunk_y in chunks["loaded"]:
+            self.static_chunks[(chunk_x, chunk_y)], _ = self.generate_chunk(chunk_x, chunk_y)
+            self.loaded_chunks[(chunk_x, chunk_y)] = True
+        self.saved_chunks = {(chunk_x, chunk_y): [tuple(entity) for entity in entities] for chunk_x, chunk_y, entities in chunks["saved"]}
+        self.static_version = next(STATIC_VERSIONS)
+
+
+    def get_evictable_chunks(self, keep):
+        # Returns the least recently used chunks over max_chunks that are not in keep.
+        evictable = []
+        excess = len(self.loaded_chunks) - self.max_chunks
+        for key in self.loaded_chunks:
+            if len(evictable) >= excess:
+                break
+            if key not in keep:
+                evictable.append(key)
+        return evictable
+
+
+    def get_chunk_entities(self, key):
+        chunk = self.entity_chunks.get(key)
+        if chunk is None:
+            return []
+        return self.get_own_entities(key, [entity for entities in chunk.cells_entities.values() for entity in entities])
+
+
+    def unload_chunk(self, key, entities):
+        # Unloads a chunk whose entities were removed. They are saved if they are not the generated ones.
+        entities = [(entity.name, entity.x, entity.y, entity.state) for entity in entities]
+        _, generated_entities = self.generate_chunk(*key)
+        if Counter(entities) != Counter(generated_entities):
+            self.saved_chunks[key] = entities
+        del self.static_chunks[key]
+        del self.loaded_chunks[key]
+        self.static_version = next(STATIC_VERSIONS)
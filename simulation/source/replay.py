@@ -0,0 +1,164 @@
+import io
+import copy
+import json
+import time
+import struct
+import contextlib
+from .simulation import Simulation
+
+# The replay files start with a magic string and a version. Version 1 stored the length of escaped actions in one byte.
+MAGIC = b"GRIDREPLAY"
+VERSION = 2
+SUPPORTED_VERSIONS = [1, 2]
+
+# The actions as small integer codes. Other actions are stored as strings after the escape code.
+ACTIONS = ["none", "up", "down", "left", "right", "pickup", "drop", "skip", "attack"]
+ACTION_CODES = {action: code for code, action in enumerate(ACTIONS)}
+ESCAPE_CODE = 255
+
+# The structs of the file. The header length, the step record header, one action and the length of an escaped action.
+HEADER_LENGTH = struct.Struct("<I")
+STEP_RECORD = struct.Struct("<IH")
+ACTION_RECORD = struct.Struct("<HB")
+ESCAPED_LENGTH = struct.Struct("<I")
+
+
+# Writes an append-only binary log of a simulation run. The header holds the initial layout, the seed and
+# the agents. Each step holds the actions in the order in which they were added, as integer codes.
+# The file is flushed every flush_interval steps, so a crashed run can be replayed up to the last flush.
+class ReplayRecorder:
+
+    def __init__(self, simulation, path, flush_interval=1):
+        if simulation.get_step() != 0:
+            raise ValueError("The recorder must be attached before the first step")
+
+        # The layout of the simulation is stored bottom row first, custom layouts are given top row first.
+        # Binary levels are referenced by their path, procedural grids by their parameters.
+        config = copy.deepcopy(simulation.config)
+        if simulation.config["grid"]["type"] in ["binary", "procedural"]:
+            config["grid"] = dict(simulation.config["grid"])
+        else:
+            config["grid"] = {
+                "type": "custom",
+                "layout": list(simulation.config["grid"]["layout"][::-1]),
+            }
+        config["seed"] = simulation.seed
+        self.agent_ids = list(simulation.agents.keys())
+        self.agent_indices = {agent_id: index for index, agent_id in enumerate(self.agent_ids)}
+        header = json.dumps({"config": config, "agent_ids": self.agent_ids}).encode("utf-8")
+
+        # Write the header and attach to the simulation.
+        self.flush_interval = flush_interval
+        self.unflushed_steps = 0
+        self.file = open(path, "wb")
+        self.file.write(MAGIC + bytes([VERSION]))
+        self.file.write(HEADER_LENGTH.pack(len(header)))
+        self.file.write(header)
+        self.file.flush()
+        simulation.recorder = self
+        self.simulation = simulation
+
+
+    def record_step(self, step, actions):
+        record = bytearray(STEP_RECORD.pack(step, len(actions)))
+        for agent_id, action in actions.items():
+            action = action["action"]
+            code = ACTION_CODES.get(action, ESCAPE_CODE)
+            record += ACTION_RECORD.pack(self.agent_indices[agent_id], code)
+            if code == ESCAPE_CODE:
+                encoded = action.encode("utf-8")
+                record += ESCAPED_LENGTH.pack(len(encoded)) + encoded
+        self.file.write(record)
+
+        # Flush regularly, so that the steps are on disk if the server crashes.
+        self.unflushed_steps += 1
+        if self.unflushed_steps >= self.flush_interval:
+            self.file.flush()
+            self.unflushed_steps = 0
+
+
+    def close(self):
+        if self.simulation.recorder is self:
+            self.simulation.recorder = None
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.close()
+
+
+# Plays a replay file back deterministically. Either as fast as possible or paced with an interval.
+class ReplayPlayer:
+
+    def __init__(self, path, quiet=True):
+        with open(path, "rb") as f:
+            data = f.read()
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"Not a replay file: {path}")
+        self.version = data[len(MAGIC)]
+        if self.version not in SUPPORTED_VERSIONS:
+            raise ValueError(f"Unsupported replay version: {self.version}")
+        offset = len(MAGIC) + 1
+        header_length, = HEADER_LENGTH.unpack_from(data, offset)
+        offset += HEADER_LENGTH.size
+        header = json.loads(data[offset:offset + header_length].decode("utf-8"))
+        offset += header_length
+
+        self.config = header["config"]
+        self.agent_ids = header["agent_ids"]
+        self.quiet = quiet
+        self.steps = self.__parse_steps(data, offset)
+
+
+    def __parse_steps(self, data, offset):
+        # The last step of a crashed run can be incomplete. It is dropped.
+        length_struct = ESCAPED_LENGTH if self.version >= 2 else struct.Struct("<B")
+        steps = []
+        try:
+            while offset < len(data):
+                step, count = STEP_RECORD.unpack_from(data, offset)
+                offset += STEP_RECORD.size
+                actions = []
+                for _ in range(count):
+                    agent_index, code = ACTION_RECORD.unpack_from(data, offset)
+                    offset += ACTION_RECORD.size
+                    if code == ESCAPE_CODE:
+                        length, = length_struct.unpack_from(data, offset)
+                        offset += length_struct.size
+                        if offset + length > len(data):
+                            raise struct.error("Incomplete action")
+                        action = data[offset:offset + length].decode("utf-8")
+                        offset += length
+                    else:
+                        action = ACTIONS[code]
+                    actions.append((self.agent_ids[agent_index], action))
+                steps.append((step, actions))
+        except struct.error:
+            pass
+        return steps
+
+
+    def play(self, interval=None, callback=None):
+        # Plays all the steps and returns the simulation. The callback gets the simulation and the events of each step.
+        output = io.StringIO() if self.quiet else None
+        with contextlib.redirect_stdout(output) if output is not None else contextlib.nullcontext():
+            simulation = Simulation(copy.deepcopy(self.config))
+            next_time = time.monotonic()
+            for step, actions in self.steps:
+                if simulation.get_step() != step:
+                    raise ValueError(f"Replay is out of sync at step {step}, simulation is at step {simulation.get_step()}")
+                for agent_id, action in actions:
+                    simulation.add_action(agent_id, {"action": action})
+                events = simulation.step()
+                if callback is not None:
+                    callback(simulation, events)
+
+                # Pace the playback.
+                if interval is not None:
+                    next_time += interval
+                    time.sleep(max(0, next_time - time.monotonic()))
+        return simulation
@@ -0,0 +1,464 @@
+import os
+import sys
+import json
+import copy
+import random
+import shutil
+import bisect
+import tempfile
+import traceback
+import multiprocessing
+from collections import Counter
+from .simulation import Simulation
+from .agent import Agent
+from .item import Item
+from .entitystore import EntityStore
+from .layoutgenerator import LayoutGenerator
+from .levelcompiler import CompiledLevel, LevelCache
+from .triggerengine import parse_condition
+
+
+def get_band(region, width):
+    # Returns the regions of the cells of a region that are at most width cells from its border.
+    start_x, start_y, end_x, end_y = region
+    inner_start_y, inner_end_y = min(start_y + width, end_y), max(end_y - width, start_y + width)
+    bands = [
+        (start_x, start_y, end_x, inner_start_y),
+        (start_x, inner_end_y, end_x, end_y),
+        (start_x, inner_start_y, min(start_x + width, end_x), inner_end_y),
+        (max(end_x - width, start_x + width), inner_start_y, end_x, inner_end_y),
+    ]
+    return [band for band in bands if band[2] > band[0] and band[3] > band[1]]
+
+
+def run_shard(connection, config, region, ghost_width, quiet):
+    # The main loop of a worker process. It runs the commands of the coordinator until it is stopped.
+    if quiet:
+        sys.stdout = open(os.devnull, "w")
+    try:
+        shard = Shard(config, region, ghost_width)
+        connection.send(("ok", shard.get_ready()))
+        while True:
+            command, *arguments = connection.recv()
+            if command == "stop":
+                break
+            connection.send(("ok", getattr(shard, command)(*arguments)))
+    except Exception as exception:
+        connection.send(("error", (exception, traceback.format_exc())))
+    finally:
+        connection.close()
+
+
+# The part of the world that one worker process owns. It runs a simulation of the whole level, but only has
+# the entities and the agents of its region. Around the region there is a border of ghost cells with copies of
+# the entities and the agents of the neighbours, so that moves and observations across the border see them.
+class Shard:
+
+    def __init__(self, config, region, ghost_width):
+        self.simulation = Simulation(config)
+        self.region = region
+        self.ghost_width = ghost_width
+        self.ghosts = []
+        self.ghost_counts = Counter()
+
+        # The ghost items are not items of the simulation. They have a store of their own.
+        self.ghost_items = EntityStore()
+
+        # Remove everything outside of the region. The ghosts are added by the coordinator.
+        simulation = self.simulation
+        for entity in simulation.entities.select(owned=False):
+            if not self.owns(entity.x, entity.y):
+                simulation.grid.remove_entity(entity)
+                simulation.entities.remove(entity)
+        for agent_id, agent in list(simulation.agents.items()):
+            if not self.owns(agent.x, agent.y):
+                simulation.grid.remove_entity(agent)
+                del simulation.agents[agent_id]
+        simulation.agent_indices = None
+
+
+    def owns(self, x, y):
+        start_x, start_y, end_x, end_y = self.region
+        return start_x <= x < end_x and start_y <= y < end_y
+
+
+    def get_ready(self):
+        return list(self.simulation.agents.keys()), self.get_border_records()
+
+
+    def get_border_records(self):
+        # Returns the entities and the agents in the cells that are ghost cells of the neighbours.
+        grid = self.simulation.grid
+        records = []
+        for start_x, start_y, end_x, end_y in get_band(self.region, self.ghost_width):
+            ys, xs = grid.get_entity_counts(start_x, start_y, end_x, end_y).nonzero()
+            for x, y in zip((xs + start_x).tolist(), (ys + start_y).tolist()):
+                for entity in grid.get_entities_at(x, y):
+                    records.append((entity.id if isinstance(entity, Agent) else None, entity.name, x, y, entity.state))
+        return records
+
+
+    def step(self, actions, names):
+        simulation = self.simulation
+        for agent_id, action in actions.items():
+            simulation.add_action(agent_id, action)
+        events = simulation.step()
+
+        # The agents that left the region move to the shard that owns their cell. The items of their inventory
+        # leave the store and travel as names. The new shard adds them to its store.
+        emigrants = [agent for agent in simulation.agents.values() if not self.owns(agent.x, agent.y)]
+        for agent in emigrants:
+            simulation.grid.remove_entity(agent)
+            del simulation.agents[agent.id]
+            agent.observations = None
+            inventory = [item.name for item in agent.inventory]
+            for item in agent.inventory:
+                simulation.entities.remove(item)
+            agent.inventory = inventory
+        if len(emigrants) > 0:
+            simulation.agent_indices = None
+
+        # Count the entities of the region for the triggers and for the end of the simulation.
+        counts = {name: simulation.grid.count_entities(name) - self.ghost_counts[name] for name in names}
+        carrying = any(len(agent.inventory) > 0 for agent in simulation.agents.values())
+        return events, emigrants, self.get_border_records(), counts, carrying
+
+
+    def exchange(self, immigrants, ghosts):
+        simulation = self.simulation
+        grid = simulation.grid
+
+        # Replace the ghosts.
+        for ghost in self.ghosts:
+            grid.remove_entity(ghost)
+        self.ghosts = []
+        self.ghost_counts = Counter()
+        self.ghost_items = EntityStore()
+        for agent_id, name, x, y, state in ghosts:
+            if agent_id is not None:
+                ghost = Agent(agent_id, name, x, y)
+                ghost.state = state
+            else:
+                ghost = self.ghost_items.add(name, x, y, state)
+            grid.add_entity(ghost, x, y)
+            self.ghosts.append(ghost)
+            self.ghost_counts[name] += 1
+
+        # Take over the agents that entered the region.
+        for agent in immigrants:
+            simulation.agents[agent.id] = agent
+            grid.add_entity(agent, agent.x, agent.y)
+            agent.inventory = [simulation.entities.add(name, agent.x, agent.y, owner=agent.id) for name in agent.inventory]
+        if len(immigrants) > 0:
+            simulation.agent_indices = None
+
+        # The observations see the new ghosts and agents.
+        simulation.world_snapshot = None
+        for agent in simulation.agents.values():
+            agent.observations = None
+
+
+    def remove(self, removals):
+        # Removes the items of the triggers. Either the shard owns them or they are ghosts.
+        simulation = self.simulation
+        removed = set()
+        for name, positions in removals:
+            for x, y in positions:
+                for entity in list(simulation.grid.get_entities_at(x, y)):
+                    if isinstance(entity, Item) and entity.name == name:
+                        simulation.grid.remove_entity(entity)
+                        if entity.store is simulation.entities:
+                            simulation.entities.remove(entity)
+                        removed.add(id(entity))
+        if len(removed) > 0:
+            self.ghosts = [ghost for ghost in self.ghosts if id(ghost) not in removed]
+            self.ghost_counts = Counter(ghost.name for ghost in self.ghosts)
+            simulation.world_snapshot = None
+            for agent in simulation.agents.values():
+                agent.observations = None
+
+
+    def observe(self, agent_ids):
+        return [self.simulation.get_agent_observations(agent_id) for agent_id in agent_ids]
+
+
+    def get_agents(self):
+        return [(agent.id, agent.name, agent.x, agent.y, agent.state, [item.name for item in agent.inventory], agent.score, agent.action_count) for agent in self.simulation.agents.values()]
+
+
+# A world that is split into rectangular regions, each one owned by a worker process. Every step is a barrier:
+# the workers execute the actions of their agents, then the agents that crossed a border migrate with their
+# inventory and the ghost cells are refreshed. The triggers are global and handled here with the merged counts.
+# The level is compiled once and memory-mapped by all the workers. Procedural grids and the 'all' observation
+# mode are not supported. The events of a step are the events of the shards in order, then the trigger events.
+class ShardedSimulation:
+
+    def __init__(self, config, shards_x=2, shards_y=2, quiet=True):
+
+        # If config is a file, load it with json.
+        if isinstance(config, str) and os.path.exists(config):
+            with open(config) as f:
+                config = json.load(f)
+        if not isinstance(config, dict):
+            raise ValueError("Invalid simulation config")
+        config = copy.deepcopy(config)
+        self.config = config
+        self.simulation_step = 0
+        self.actions = {}
+        self.directory = None
+        self.workers = []
+
+        # The ghost cells must cover the observation windows and the moves.
+        observation = config.get("observation", {})
+        if observation.get("mode") == "square":
+            ghost_width = max(1, observation["grid_size"] // 2)
+        elif observation.get("mode") == "fov":
+            ghost_width = max(1, observation["radius"])
+        else:
+            raise ValueError("Sharded simulations need the 'square' or the 'fov' observation mode")
+
+        # Compile the level once and store it where the workers can map it.
+        grid_config = config["grid"]
+        if grid_config["type"] == "binary":
+            path = grid_config["path"]
+            level = CompiledLevel.load(path, mmap=True)
+            exits = config.get("exits", level.exits)
+            triggers = config.get("triggers", level.triggers)
+        else:
+            exits = config.get("exits", {})
+            triggers = config.get("triggers", [])
+            if grid_config["type"] == "custom":
+                level = LevelCache().load_or_compile(grid_config["layout"][::-1], exits, triggers)
+            elif grid_config["type"] == "random":
+                parameters = grid_config["parameters"]
+                if parameters.get("seed") is None:
+                    parameters["seed"] = random.randrange(2**32)
+                level = CompiledLevel.compile(LayoutGenerator.generate(**parameters), exits, triggers)
+            else:
+                raise ValueError(f"Grid type cannot be sharded: {grid_config['type']}")
+            self.directory = tempfile.mkdtemp(prefix="thegrid-")
+            path = os.path.join(self.directory, "level.bin")
+            level.save(path)
+        self.triggers = list(triggers)
+        self.exit_positions = exits
+        for trigger in self.triggers:
+            if parse_condition(trigger.get("when"))[0] == "cell":
+                raise ValueError("Agent conditions of triggers are not supported in sharded simulations")
+
+        # Split the world into the regions.
+        height, width = level.cells.shape
+        if shards_x < 1 or shards_y < 1 or shards_x > width or shards_y > height:
+            raise ValueError("Invalid number of shards")
+        self.bounds_x = [width * index // shards_x for index in range(shards_x + 1)]
+        self.bounds_y = [height * index // shards_y for index in range(shards_y + 1)]
+        self.regions = [(self.bounds_x[column], self.bounds_y[row], self.bounds_x[column + 1], self.bounds_y[row + 1]) for row in range(shards_y) for column in range(shards_x)]
+        self.ghost_areas = [(max(0, start_x - ghost_width), max(0, start_y - ghost_width), min(width, end_x + ghost_width), min(height, end_y + ghost_width)) for start_x, start_y, end_x, end_y in self.regions]
+
+        # The workers get the binary level, the exits and their own seed. The triggers are handled here.
+        seed = config.get("seed")
+        if seed is None:
+            seed = random.randrange(2**32)
+        self.seed = seed
+        context = multiprocessing.get_context()
+        for index, region in enumerate(self.regions):
+            worker_config = copy.deepcopy(config)
+            worker_config["grid"] = {key: value for key, value in grid_config.items() if key in ["backend", "chunk_size"]}
+            worker_config["grid"].update({"type": "binary", "path": path})
+            worker_config["exits"] = exits
+            worker_config["triggers"] = []
+            worker_config["seed"] = seed + index
+            connection, worker_connection = context.Pipe()
+            process = context.Process(target=run_shard, args=(worker_connection, worker_config, region, ghost_width, quiet), daemon=True)
+            process.start()
+            worker_connection.close()
+            self.workers.append((process, connection))
+
+        # Find the owners of the agents and add the first ghosts.
+        self.agent_shards = {}
+        records = []
+        for index, (agent_ids, border_records) in enumerate(self.__receive_all()):
+            for agent_id in agent_ids:
+                self.agent_shards[agent_id] = index
+            records += border_records
+        self.__send_all([("exchange", [], ghosts) for ghosts in self.route_ghosts(records)])
+        self.__receive_all()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *arguments):
+        self.close()
+
+
+    def close(self):
+        for process, connection in self.workers:
+            try:
+                connection.send(("stop",))
+            except (BrokenPipeError, OSError):
+                pass
+            process.join()
+            connection.close()
+        self.workers = []
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+
+    def get_shard(self, x, y):
+        column = bisect.bisect_right(self.bounds_x, x) - 1
+        row = bisect.bisect_right(self.bounds_y, y) - 1
+        return row * (len(self.bounds_x) - 1) + column
+
+
+    def route_ghosts(self, records):
+        # Returns the records of the ghosts of each shard, which are in its ghost area but not in its region.
+        ghosts = [[] for _ in self.regions]
+        for record in records:
+            x, y = record[2], record[3]
+            owner = self.get_shard(x, y)
+            for index, (start_x, start_y, end_x, end_y) in enumerate(self.ghost_areas):
+                if index != owner and start_x <= x < end_x and start_y <= y < end_y:
+                    ghosts[index].append(record)
+        return ghosts
+
+
+    def get_step(self):
+        return self.simulation_step
+
+
+    def get_agent_ids(self):
+        return list(self.agent_shards.keys())
+
+
+    def add_action(self, agent_id, action):
+        assert agent_id in self.agent_shards, f"Invalid agent id: {agent_id}"
+        self.actions[agent_id] = action
+
+
+    def step(self):
+
+        # Send the actions to the owners of the agents.
+        actions = [{} for _ in self.regions]
+        for agent_id, action in self.actions.items():
+            actions[self.agent_shards[agent_id]][agent_id] = action
+        self.actions = {}
+        names = sorted(set(parse_condition(trigger["when"])[1] for trigger in self.triggers if parse_condition(trigger["when"])[0] == "count") | {"gold"})
+        self.__send_all([("step", shard_actions, names) for shard_actions in actions])
+
+        # Merge the results.
+        events = []
+        immigrants = [[] for _ in self.regions]
+        records = []
+        self.counts = Counter()
+        self.carrying = False
+        for shard_events, emigrants, border_records, counts, carrying in self.__receive_all():
+            events += shard_events
+            records += border_records
+            self.counts.update(counts)
+            self.carrying |= carrying
+            for agent in emigrants:
+                index = self.get_shard(agent.x, agent.y)
+                immigrants[index].append(agent)
+                self.agent_shards[agent.id] = index
+                records.append((agent.id, agent.name, agent.x, agent.y, agent.state))
+
+        # Migrate the agents and refresh the ghosts.
+        self.__send_all([("exchange", shard_immigrants, ghosts) for shard_immigrants, ghosts in zip(immigrants, self.route_ghosts(records))])
+        self.__receive_all()
+
+        # Handle the triggers with the counts of the whole world.
+        events += self.handle_triggers()
+
+        self.simulation_step += 1
+        return events
+
+
+    def handle_triggers(self):
+        events = []
+        removals = []
+        new_triggers = []
+        for trigger in self.triggers:
+            trigger_type = trigger.get("type")
+            condition = parse_condition(trigger.get("when"))
+            if condition[0] == "count":
+                triggered = condition[2](self.counts[condition[1]], condition[3])
+            else:
+                triggered = self.simulation_step >= condition[1]
+            if not triggered:
+                new_triggers.append(trigger)
+                continue
+            print(f"Triggered: {trigger_type}")
+
+            # Handle the trigger message.
+            if "messages" in trigger:
+                events.append({
+                    "type": "messages",
+                    "messages": trigger["messages"],
+                })
+
+            # The items are removed by the shards that have them.
+            if trigger_type.startswith("remove:"):
+                removals.append((trigger_type.split(":")[1], trigger["positions"]))
+            else:
+                raise ValueError(f"Invalid trigger type: {trigger_type}")
+            if trigger.get("frequency") != "once":
+                raise ValueError(f"Invalid trigger frequency {trigger.get('frequency')}")
+        self.triggers = new_triggers
+
+        if len(removals) > 0:
+            self.__send_all([("remove", removals)] * len(self.workers))
+            self.__receive_all()
+        return events
+
+
+    def get_agent_observations(self, agent_id):
+        return self.get_observations([agent_id])[agent_id]
+
+
+    def get_observations(self, agent_ids=None):
+        # Returns the observations of many agents. Each shard computes the ones of its agents in parallel.
+        if agent_ids is None:
+            agent_ids = self.get_agent_ids()
+        shard_agent_ids = [[] for _ in self.regions]
+        for agent_id in agent_ids:
+            shard_agent_ids[self.agent_shards[agent_id]].append(agent_id)
+        self.__send_all([("observe", ids) for ids in shard_agent_ids])
+        observations = {}
+        for ids, shard_observations in zip(shard_agent_ids, self.__receive_all()):
+            observations.update(zip(ids, shard_observations))
+        return observations
+
+
+    def get_agents(self):
+        # Returns the agents as (id, name, x, y, state, inventory, score, action count).
+        self.__send_all([("get_agents",)] * len(self.workers))
+        return [agent for agents in self.__receive_all() for agent in agents]
+
+
+    def is_finished(self):
+        # True if there is no more gold in the grid and no agent has gold in its inventory, as of the last step.
+        if self.simulation_step == 0:
+            return False
+        return self.counts["gold"] == 0 and not self.carrying
+
+
+    def __send_all(self, commands):
+        for (_, connection), command in zip(self.workers, commands):
+            connection.send(command)
+
+
+    def __receive_all(self):
+        # Waits for all the workers. This is the barrier of the step.
+        results = []
+        errors = []
+        for _, connection in self.workers:
+            status, result = connection.recv()
+            if status == "error":
+                errors.append(result)
+            results.append(result)
+        if len(errors) > 0:
+            exception, trace = errors[0]
+            raise RuntimeError(f"A shard failed:\n{trace}") from exception
+        return results
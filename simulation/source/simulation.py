@@ -1,13 +1,23 @@
 import time
-import copy
 import random
 import os
 import json
-import itertools
-from .grid import Grid
+import operator
+import numpy as np
+from .grid import Grid, CELL_CODES
+from .chunkedgrid import ChunkedGrid, CHUNK_SIZE
+from .proceduralgrid import ProceduralGrid
 from .agent import Agent
 from .item import Item
+from .entitystore import EntityStore
+from .actioninbox import ActionInbox
 from .layoutgenerator import LayoutGenerator
+from .levelcompiler import CompiledLevel, LevelCache, ENTITY_TYPES
+from .worldsnapshot import WorldSnapshot, ObservedCells, RememberedCells
+from .bitplanes import CHANNELS, CHANNEL_CODES
+from .fieldofview import FieldOfView
+from .triggerengine import TriggerEngine
+from .vecsimulation import ACTION_CODES, ACTION_DX, ACTION_DY
 
 
 class Simulation:
@@ -16,7 +26,13 @@ class Simulation:
         self.next_id = 1
         self.running = False
         self.simulation_step = 0
-        self.actions = {}
+
+        # The actions of the agents for the next step. They can be added from other threads.
+        self.inbox = ActionInbox()
+
+        # The snapshot of the world after the last update. It is built lazily when observations are requested.
+        self.world_snapshot = None
+        self.world_snapshot_step = 0
 
         # If config is a file, load it with json.
         if isinstance(config, str) and os.path.exists(config):
@@ -30,45 +46,74 @@ class Simulation:
         # Process the config.
         self.raiseIfConfigInvalid(config)
 
-        if config["grid"]["type"] == "custom":
-            layout = config["grid"]["layout"][::-1]
+        # The random number generator for the order of the actions. Without a seed in the config, a seed is drawn.
+        self.seed = config.get("seed")
+        if self.seed is None:
+            self.seed = random.randrange(2**32)
+        self.random = random.Random(self.seed)
+
+        # The recorder that gets the actions of each step, if any.
+        self.recorder = None
+
+        # The field of view of the fov observation mode. It is created when it is first needed.
+        self.field_of_view = None
+
+        # The indices of the agents for the batched action resolution. Created when it is first needed.
+        self.agent_indices = None
+
+        # Procedural worlds are streamed by chunk. The chunks around the agents are loaded once they are placed.
+        exits = config.get("exits", {})
+        triggers = config.get("triggers", [])
+        if config["grid"]["type"] == "procedural":
+            parameters = config["grid"]["parameters"]
+            if parameters.get("seed") is None:
+                parameters["seed"] = random.randrange(2**32)
+            if config.get("observation", {}).get("mode") not in ["square", "fov"]:
+                raise ValueError("Procedural grids need the 'square' or the 'fov' observation mode")
+            self.grid = ProceduralGrid(parameters, len(config["agents"]))
+            agent_positions = self.grid.agent_positions
+            entity_types = np.zeros(0, dtype=np.uint8)
+            entity_x = np.zeros(0, dtype=np.int32)
+            entity_y = np.zeros(0, dtype=np.int32)
+
+        # Compile the level. Custom levels are cached on disk, random levels are compiled every time.
+        # Binary levels are already compiled and memory-mapped. The exits and triggers in the config override theirs.
         else:
-            layout = LayoutGenerator.generate(**config["grid"]["parameters"])
-        config["grid"]["layout"] = layout
-
-        # Greate the grid.
-        self.grid = Grid(config["grid"])
+            if config["grid"]["type"] == "binary":
+                if "path" not in config["grid"]:
+                    raise ValueError("Missing 'path' key in binary grid config")
+                level = CompiledLevel.load(config["grid"]["path"], mmap=True)
+                level.exits = config.get("exits", level.exits)
+                level.triggers = config.get("triggers", level.triggers)
+            elif config["grid"]["type"] == "custom":
+                layout = config["grid"]["layout"][::-1]
+                level = LevelCache().load_or_compile(layout, exits, triggers)
+                config["grid"]["layout"] = layout
+            else:
+                layout = LayoutGenerator.generate(**config["grid"]["parameters"])
+                level = CompiledLevel.compile(layout, exits, triggers)
+                config["grid"]["layout"] = layout
+
+            # Greate the grid. Very large worlds can use the chunked backend.
+            backend = config["grid"].get("backend", "dense")
+            if backend == "dense":
+                self.grid = Grid.from_cells(level.cells)
+            elif backend == "chunked":
+                self.grid = ChunkedGrid.from_cells(level.cells, config["grid"].get("chunk_size", CHUNK_SIZE))
+            else:
+                raise ValueError(f"Invalid grid backend: {backend}")
+
+            # Get the agent positions and the entity tables.
+            agent_positions = level.get_agent_positions()
+            entity_types = level.entity_types
+            entity_x = level.entity_x
+            entity_y = level.entity_y
+            exits = level.exits
+            triggers = level.triggers
         self.agents = {}
-        self.entities = []
-
-        # Get the agent and entities positions.
-        agent_positions = []
-        entities_positions = []
-        y = 0
-        for row in layout:
-            row = row.replace(" ", "")
-            x = 0
-            for cell in row:
-                if cell in ["1", "2"]:
-                    agent_positions += [(x, y)]
-                elif cell == "G":
-                    entities_positions += [("gold", x, y)]
-                elif cell == "T":
-                    entities_positions += [("trove", x, y)]
-                elif cell == "E":
-                    entities_positions += [("enemy", x, y)]
-                elif cell == "D":
-                    entities_positions += [("door", x, y)]
-                elif cell == "S":
-                    entities_positions += [("staircase", x, y)]
-                elif cell == "K":
-                    entities_positions += [("key", x, y)]
-                elif cell in [".", "X"]:
-                    pass
-                else:
-                    raise ValueError(f"Invalid cell type: {cell}")
-                x += 1
-            y += 1
+
+        # The items on the grid and in the inventories.
+        self.entities = EntityStore()
 
         # Create the agents.
         for agent_index, agent_config in enumerate(config["agents"]):
@@ -80,20 +125,27 @@ class Simulation:
             self.agents[identifier] = agent
         self.update_interval_seconds = config.get("update_interval_seconds", 1.0)
 
-        # Create the entities.
-        for entity_type, entity_x, entity_y in entities_positions:
-            entity = Item(entity_type, entity_x, entity_y)
-            self.entities.append(entity)
+        # Create the entities from the tables.
+        items = self.entities.extend(ENTITY_TYPES, entity_types, entity_x, entity_y)
 
-        # Store the triggers.
-        self.triggers = config.get("triggers", [])
+        # Add the entities and then the agents to the grid.
+        self.grid.add_entities(items, entity_x, entity_y, entity_types, ENTITY_TYPES)
+        for agent in self.agents.values():
+            self.grid.add_entity(agent, agent.x, agent.y)
+
+        # Store the triggers. The engine decides which of them fire.
+        self.triggers = triggers
+        self.trigger_engine = TriggerEngine(triggers, self.grid)
 
         # Store the exit positions.
-        self.exit_positions = config.get("exits", [])
+        self.exit_positions = exits
 
         # Set the config.
         self.config = config
 
+        # Load the chunks around the agents.
+        self.stream_chunks()
+
 
     def raiseIfConfigInvalid(self, config):
         if "grid" not in config:
@@ -102,6 +154,99 @@ class Simulation:
             raise ValueError("Invalid 'update_interval_seconds' value in simulation config")
         if "agents" in config and not isinstance(config["agents"], list):
             raise ValueError("Invalid 'agents' value in simulation config")
+        if "seed" in config and config["seed"] is not None and not isinstance(config["seed"], int):
+            raise ValueError("Invalid 'seed' value in simulation config")
+        if config.get("action_resolution", "sequential") not in ["sequential", "batched"]:
+            raise ValueError("Invalid 'action_resolution' value in simulation config")
+
+
+    def snapshot(self, include_entities=True):
+
+        # Store the dynamic state only. The static layout and the config are not part of it.
+        # The entities on the grid can be left out, for callers that track their changes in the entity store.
+        # Procedural grids add their loaded and saved chunks, which go with the entities on the grid. The agents that
+        # remember cells in the fov memory mode add them as (x, y, seen_step, elements).
+        return {
+            "simulation_step": self.simulation_step,
+            "entities": self.entities.get_records(owned=False) if include_entities else None,
+            "agents": [(agent.id, agent.x, agent.y, agent.state, [item.name for item in agent.inventory], agent.score, agent.action_count) for agent in self.agents.values()],
+            "triggers": list(self.triggers),
+            "actions": self.inbox.get_pending(),
+            "random": self.random.getstate(),
+            "world_snapshot_step": self.world_snapshot_step,
+            "chunks": self.grid.get_chunks() if isinstance(self.grid, ProceduralGrid) else None,
+            "explored": {agent.id: [(x, y, seen_step, elements) for (x, y), (seen_step, elements) in agent.explored.items()] for agent in self.agents.values() if len(agent.explored) > 0},
+        }
+
+
+    def restore(self, state):
+
+        # Procedural grids load the chunks of the snapshot without their generated entities, since the snapshot
+        # has the entities of the loaded chunks.
+        if isinstance(self.grid, ProceduralGrid):
+            if state.get("chunks") is None:
+                raise ValueError("The snapshot has no chunks for the procedural grid")
+            self.grid.restore_chunks(state["chunks"])
+
+        # Restore the entities and the agents and rebuild the entity index.
+        self.grid.clear_entities()
+        self.entities = EntityStore()
+        for name, x, y, entity_state in state["entities"]:
+            entity = self.entities.add(name, x, y, entity_state)
+            self.grid.add_entity(entity, x, y)
+        for agent_id, x, y, agent_state, inventory, score, action_count in state["agents"]:
+            agent = self.agents[agent_id]
+            agent.state = agent_state
+            agent.inventory = [self.entities.add(name, x, y, owner=agent_id) for name in inventory]
+            agent.score = score
+            agent.action_count = action_count
+            agent.explored = {(cell_x, cell_y): (seen_step, elements) for cell_x, cell_y, seen_step, elements in state.get("explored", {}).get(agent_id, [])}
+            self.grid.add_entity(agent, x, y)
+
+        # Restore the rest.
+        self.simulation_step = state["simulation_step"]
+        self.triggers = list(state["triggers"])
+        self.trigger_engine = TriggerEngine(self.triggers, self.grid)
+        self.inbox = ActionInbox(state["actions"], self.simulation_step)
+        version, internal_state, gauss_next = state["random"]
+        self.random.setstate((version, tuple(internal_state), gauss_next))
+
+        # The world snapshot and the observations are computed again when requested.
+        self.world_snapshot = None
+        self.world_snapshot_step = state["world_snapshot_step"]
+        for agent in self.agents.values():
+            agent.observations = None
+
+
+    def fork(self):
+
+        # Create a simulation that shares the static layout, the config and the immutable world snapshot.
+        simulation = Simulation.__new__(Simulation)
+        simulation.__dict__.update(self.__dict__)
+
+        # Fork the dynamic state. The fork shares the items and the entity index until it changes them, and then
+        # uses its own copies, which copy_entity finds. The agents are few, so they are copied right away.
+        simulation.entities = self.entities.fork()
+        simulation.agents = {}
+        for agent_id, agent in self.agents.items():
+            agent_copy = agent.copy()
+            agent_copy.inventory = [simulation.entities.get_item(item.uid) for item in agent.inventory]
+            simulation.agents[agent_id] = agent_copy
+        simulation.grid = self.grid.fork(simulation.copy_entity)
+        simulation.triggers = list(self.triggers)
+        simulation.trigger_engine = TriggerEngine(simulation.triggers, simulation.grid)
+        simulation.inbox = self.inbox.copy()
+        simulation.random = random.Random()
+        simulation.random.setstate(self.random.getstate())
+        simulation.recorder = None
+        return simulation
+
+
+    def copy_entity(self, entity):
+        # Returns the entity of this simulation for an entity of the simulation that it was forked from.
+        if isinstance(entity, Agent):
+            return self.agents[entity.id]
+        return self.entities.get_item(entity.uid)
 
 
     def get_renderer_data(self, version="v1"):
@@ -129,12 +274,12 @@ class Simulation:
                 })
 
         # Add the entities to the renderer data.
-        for entity in self.entities:
+        for name, x, y, state in self.entities.get_records(owned=False):
             grid_cells.append({
-                "x": entity.x,
-                "y": entity.y,
-                "sprite": entity.name,
-                "state": entity.state,
+                "x": x,
+                "y": y,
+                "sprite": name,
+                "state": state,
             })
 
         # Add the agents to the renderer data.
@@ -188,13 +333,23 @@ class Simulation:
         return self.agents.get(agent_id)
 
 
-    def add_action(self, agent_id, action):
-        self.actions[agent_id] = action
+    def add_action(self, agent_id, action, target_step=None):
+        # The target step is the step after the observations that the action responds to, if it is known.
+        self.inbox.put(agent_id, action, target_step)
+
+
+    def get_action_stats(self):
+        # Returns the numbers of late and dropped actions per agent.
+        return self.inbox.get_stats()
 
 
     def get_agent_observations(self, agent_id):
         assert agent_id in self.agents, f"Invalid agent id: {agent_id}"
         agent = self.agents.get(agent_id)
+
+        # Compute the observations the first time they are requested after an update.
+        if agent.observations is None:
+            agent.observations = self.compute_agent_observations(agent)
         return agent.observations
     
 
@@ -227,16 +382,30 @@ class Simulation:
 
     def update(self):
 
+        # Many agents are resolved in a batch.
+        if self.config.get("action_resolution", "sequential") == "batched":
+            return self.update_batched()
+
         # These are the events that will be returned.
         events = []
 
-        # Clone the actions and clear the actions dictionary.
-        actions_to_execute = copy.deepcopy(self.actions)
-        self.actions = {}
+        # Take the actions of the step from the inbox.
+        actions_to_execute, late_actions = self.inbox.swap(self.simulation_step)
+
+        # Record the actions before they are executed.
+        if self.recorder is not None:
+            self.recorder.record_step(self.simulation_step, actions_to_execute)
+
+        # Report the actions that arrived after the step they targeted.
+        if len(late_actions) > 0:
+            events.append({
+                "type": "late_actions",
+                "target_steps": dict(late_actions),
+            })
 
         # Shuffle the agents to randomize the order in which they execute their actions.
         agent_ids = list(actions_to_execute.keys())
-        random.shuffle(agent_ids)
+        self.random.shuffle(agent_ids)
         for agent_id in agent_ids:
             print(f"Agent {agent_id} is executing action {actions_to_execute[agent_id]}")
             action_failure_cause, event = self.perform_agent_action(agent_id, actions_to_execute[agent_id])
@@ -257,16 +426,163 @@ class Simulation:
         # Handle the exit positions.
         events += self.handle_exits()
 
-        # Update the grid.
-        self.grid.clear_entities()
-        for entity in self.entities:
-            self.grid.add_entity(entity, entity.x, entity.y)
-        for agent in self.agents.values():
-            self.grid.add_entity(agent, agent.x, agent.y)
+        # Load and evict the chunks of procedural grids.
+        self.stream_chunks()
 
-        # Update agent observations.
+        # Invalidate the world snapshot and the agent observations. They are computed lazily when requested.
+        self.world_snapshot = None
+        self.world_snapshot_step = self.simulation_step
         for agent in self.agents.values():
-            agent.observations = self.compute_agent_observations(agent)
+            agent.observations = None
+
+        return events
+
+
+    def update_batched(self):
+        # Resolves the actions of all the agents at once, for swarms of agents. All the moves are resolved
+        # against the positions at the start of the step. Only one agent can enter a cell per step and the gold
+        # of a cell goes to the pickups with the highest priority. The priorities are a permutation drawn from
+        # the random number generator of the simulation, so the resolution is deterministic in the seed.
+        # Instead of an event per action there is one event with the numbers of the outcomes.
+        events = []
+
+        # Take the actions of the step from the inbox.
+        actions_to_execute, late_actions = self.inbox.swap(self.simulation_step)
+
+        # Record the actions before they are executed.
+        if self.recorder is not None:
+            self.recorder.record_step(self.simulation_step, actions_to_execute)
+
+        # Report the actions that arrived after the step they targeted.
+        if len(late_actions) > 0:
+            events.append({
+                "type": "late_actions",
+                "target_steps": dict(late_actions),
+            })
+
+        # Encode the actions and the positions of all the agents as arrays.
+        agents = list(self.agents.values())
+        if self.agent_indices is None:
+            self.agent_indices = {agent_id: index for index, agent_id in enumerate(self.agents)}
+        assert self.agent_indices.keys() >= actions_to_execute.keys(), f"Invalid agent ids: {actions_to_execute.keys() - self.agent_indices.keys()}, {self.agents.keys()}"
+        indices = np.fromiter(map(self.agent_indices.__getitem__, actions_to_execute), dtype=np.int64, count=len(actions_to_execute))
+        codes = np.zeros(len(agents), dtype=np.int64)
+        codes[indices] = np.fromiter((ACTION_CODES.get(action["action"], -1) for action in actions_to_execute.values()), dtype=np.int64, count=len(indices))
+        submitted = np.zeros(len(agents), dtype=bool)
+        submitted[indices] = True
+        alive = np.fromiter(map(operator.attrgetter("state"), agents), dtype=object, count=len(agents)) != "dead"
+        xs = np.fromiter(map(operator.attrgetter("x"), agents), dtype=np.int64, count=len(agents))
+        ys = np.fromiter(map(operator.attrgetter("y"), agents), dtype=np.int64, count=len(agents))
+        priorities = np.random.default_rng(self.random.getrandbits(64)).permutation(len(agents))
+
+        # Every action of a living agent counts, also "none" and invalid ones, like in perform_agent_action.
+        acting = alive & submitted
+        for index in np.nonzero(acting)[0].tolist():
+            agents[index].action_count += 1
+
+        # The moves that stay in the grid, on empty cells without doors.
+        moving = acting & (codes >= ACTION_CODES["up"]) & (codes <= ACTION_CODES["right"])
+        new_xs = xs + ACTION_DX[np.where(moving, codes, 0)]
+        new_ys = ys + ACTION_DY[np.where(moving, codes, 0)]
+        moving &= (new_xs >= 0) & (new_xs < self.grid.width) & (new_ys >= 0) & (new_ys < self.grid.height)
+        moving[moving] = self.grid.get_celltype_codes_at(new_xs[moving], new_ys[moving]) == CELL_CODES["empty"]
+        door_positions = self.grid.get_positions("door")
+        if len(door_positions) > 0:
+            moving[moving] = [(x, y) not in door_positions for x, y in zip(new_xs[moving].tolist(), new_ys[moving].tolist())]
+
+        # Only the move with the highest priority enters a contested cell.
+        candidates = np.nonzero(moving)[0]
+        cell_keys = new_ys * self.grid.width + new_xs
+        candidates = candidates[np.lexsort((priorities[candidates], cell_keys[candidates]))]
+        first = np.ones(len(candidates), dtype=bool)
+        first[1:] = cell_keys[candidates][1:] != cell_keys[candidates][:-1]
+        movers = candidates[first]
+        self.grid.move_entities([agents[index] for index in movers.tolist()], new_xs[movers], new_ys[movers])
+        xs[movers] = new_xs[movers]
+        ys[movers] = new_ys[movers]
+
+        # Rank the pickups per cell by priority. As many pickups as there is gold on a cell succeed.
+        pickups = np.nonzero(acting & (codes == ACTION_CODES["pickup"]))[0]
+        picked_up = 0
+        if len(pickups) > 0:
+            available = self.grid.count_entities_at("gold", xs[pickups], ys[pickups])
+            pickup_keys = ys[pickups] * self.grid.width + xs[pickups]
+            order = np.lexsort((priorities[pickups], pickup_keys))
+            sorted_keys = pickup_keys[order]
+            group_starts = np.concatenate([[0], np.nonzero(sorted_keys[1:] != sorted_keys[:-1])[0] + 1])
+            ranks = np.arange(len(order)) - np.repeat(group_starts, np.diff(np.concatenate([group_starts, [len(order)]])))
+            winners = pickups[order][ranks < available[order]]
+            for index in winners.tolist():
+                agent = agents[index]
+                item = next(entity for entity in self.grid.get_entities_at(agent.x, agent.y) if isinstance(entity, Item) and entity.name == "gold")
+                agent.inventory.append(item)
+                item.owner = agent.id
+                self.grid.remove_entity(item)
+            picked_up = len(winners)
+
+        # Resolve the drops one by one in the order of the priorities. They follow perform_agent_action.
+        # Agents without an inventory have nothing to drop.
+        drops = np.nonzero(acting & (codes == ACTION_CODES["drop"]))[0]
+        dropped = 0
+        for index in drops[np.argsort(priorities[drops])].tolist():
+            agent = agents[index]
+            if len(agent.inventory) == 0:
+                continue
+            items = [entity for entity in self.grid.get_entities_at(agent.x, agent.y) if isinstance(entity, Item)]
+            if any(item.name == "trove" for item in items) and len(agent.inventory) > 0 and agent.inventory[0].name == "gold":
+                self.entities.remove(agent.inventory.pop())
+                agent.score += 1
+                dropped += 1
+            elif len(items) == 0 and len(agent.inventory) > 0:
+                item = agent.inventory.pop()
+                self.grid.add_entity(item, agent.x, agent.y)
+                item.owner = None
+                dropped += 1
+
+        events.append({
+            "type": "batched_actions",
+            "actions": int(acting.sum()),
+            "moved": len(movers),
+            "picked_up": picked_up,
+            "dropped": dropped,
+            "invalid": int((acting & (codes < 0)).sum()),
+        })
+
+        # Handle the triggers.
+        events += self.handle_triggers()
+
+        # Kill the agents on the cells of enemies. The positions are looked up in a hash of the cell keys.
+        agent_keys = ys * self.grid.width + xs
+        enemy_keys = np.array([y * self.grid.width + x for x, y in self.grid.get_positions("enemy")], dtype=np.int64)
+        for index in np.nonzero(alive & np.isin(agent_keys, enemy_keys))[0].tolist():
+            events.append({
+                "type": "agent_killed",
+                "agent_id": agents[index].id,
+                "messages": "player_killed_by_enemy",
+            })
+            agents[index].state = "dead"
+
+        # Handle the exits in the same way. The first exit of a position wins, like in handle_exits.
+        exit_levels = {}
+        for next_level, positions in self.exit_positions.items():
+            for x, y in positions:
+                exit_levels.setdefault(y * self.grid.width + x, next_level)
+        exit_keys = np.array(list(exit_levels.keys()), dtype=np.int64)
+        for index in np.nonzero(np.isin(agent_keys, exit_keys))[0].tolist():
+            events.append({
+                "type": "exit",
+                "agent_id": agents[index].id,
+                "next_level": exit_levels[int(agent_keys[index])],
+            })
+
+        # Load and evict the chunks of procedural grids.
+        self.stream_chunks()
+
+        # Invalidate the world snapshot and the agent observations. They are computed lazily when requested.
+        self.world_snapshot = None
+        self.world_snapshot_step = self.simulation_step
+        for agent in agents:
+            agent.observations = None
 
         return events
 
@@ -324,8 +640,7 @@ class Simulation:
             if action_failed_cause is not None:
                 print(f"Action failed: {action_failed_cause}")
             else:
-                agent.x = new_x
-                agent.y = new_y
+                self.grid.move_entity(agent, new_x, new_y)
 
         # Handle pickup action.
         elif action == "pickup":
@@ -339,7 +654,8 @@ class Simulation:
             # Success.
             if item is not None:
                 agent.inventory.append(item)
-                self.entities.remove(item)
+                item.owner = agent_id
+                self.grid.remove_entity(item)
                 print(f"Agent {agent_id} picked up item {item.name}")
             
             # Failure.
@@ -356,16 +672,15 @@ class Simulation:
 
             # Dropping gold in a trove.
             if is_trove and first_inventory_item_is_gold:
-                agent.inventory.pop()
+                self.entities.remove(agent.inventory.pop())
                 agent.score += 1
                 print(f"Agent {agent_id} dropped gold at {agent.x}, {agent.y}")
             
             # Dropping an item on an empty cell.
             elif len(items) == 0 and len(agent.inventory) > 0:
                 item = agent.inventory.pop()
-                item.x = agent.x
-                item.y = agent.y
-                self.entities.append(item)
+                self.grid.add_entity(item, agent.x, agent.y)
+                item.owner = None
                 print(f"Agent {agent_id} dropped item {item.name}")
             else:
                 print(f"Agent {agent_id} cannot drop item at {agent.x}, {agent.y} because there are items there")
@@ -380,83 +695,61 @@ class Simulation:
         # These are the events that will be returned.
         events = []
 
-        # Go through all the triggers.
-        new_triggers = []
-        for trigger in self.triggers:
-
-            # Get the trigger data.
-            trigger_when = trigger.get("when")
-            trigger_frequency = trigger.get("frequency")
-            trigger_type = trigger.get("type")
-            
-            # If there is no entity with the in the grid, trigger.
-            triggered = False
-            if trigger_when.startswith("no:"):
-                entity_name = trigger_when.split(":")[1]
-                entities = [entity for entity in self.entities if entity.name == entity_name]
-                if len(entities) == 0:
-                    triggered = True
-            else:
-                raise ValueError("Invalid trigger condition")
-            
-            if triggered:
+        # Handle the triggers that fire. The removals can make more triggers fire.
+        triggers = self.trigger_engine.update(self.simulation_step)
+        while len(triggers) > 0:
+            for trigger in triggers:
+                trigger_type = trigger.get("type")
                 print(f"Triggered: {trigger_type}")
-            else:
-                new_triggers.append(trigger)
-                continue
 
-            # Handle the trigger message.
-            if "messages" in trigger:
-                events.append({
-                    "type": "messages",
-                    "messages": trigger["messages"],
-                })
+                # Handle the trigger message.
+                if "messages" in trigger:
+                    events.append({
+                        "type": "messages",
+                        "messages": trigger["messages"],
+                    })
 
-            # Handle the trigger.
-            if trigger_type.startswith("remove:"):
+                # Handle the trigger.
+                if trigger_type.startswith("remove:"):
 
-                # Get the entities and filter for the positions.
-                entity_name = trigger_type.split(":")[1]
-                entities_to_be_removed = [entity for entity in self.entities if entity.name == entity_name]
-                entities_to_be_removed = [entity for entity in entities_to_be_removed if [entity.x, entity.y] in trigger["positions"]]
-                assert len(entities_to_be_removed) == len(trigger["positions"]), f"Invalid entities to be removed: {entities_to_be_removed} {trigger['positions']}, {entity_name}"
+                    # Get the entities at the positions.
+                    entity_name = trigger_type.split(":")[1]
+                    entities_to_be_removed = []
+                    for x, y in trigger["positions"]:
+                        entities_to_be_removed += [entity for entity in self.grid.get_entities_at(x, y) if isinstance(entity, Item) and entity.name == entity_name]
+                    assert len(entities_to_be_removed) == len(trigger["positions"]), f"Invalid entities to be removed: {entities_to_be_removed} {trigger['positions']}, {entity_name}"
 
-                # Remove the entities.
-                self.entities = [entity for entity in self.entities if entity not in entities_to_be_removed]
+                    # Remove the entities.
+                    for entity in entities_to_be_removed:
+                        self.grid.remove_entity(entity)
+                        self.entities.remove(entity)
 
-            # Should not happen.
-            else:
-                raise ValueError(f"Invalid trigger type: {trigger_type}")
-            
-            # Decide if the trigger should be kept.
-            if trigger_frequency == "once":
-                pass
-            else:
-                raise ValueError(f"Invalid trigger frequency {trigger_frequency}")
+                # Should not happen.
+                else:
+                    raise ValueError(f"Invalid trigger type: {trigger_type}")
 
-        # Update the triggers.
-        self.triggers = new_triggers
+            # Update the triggers.
+            self.triggers = self.trigger_engine.get_triggers()
+            triggers = self.trigger_engine.update(self.simulation_step)
 
         # Return the events.
         return events
-    
+
 
     def handle_entity_interactions(self):
 
         # If an agent is on the same cell as an enemy, the agent is killed.
         events = []
 
+        enemy_positions = self.grid.get_positions("enemy")
         for agent in self.agents.values():
-            if agent.state == "normal":
-                entities = self.grid.get_entities_at(agent.x, agent.y)
-                for entity in entities:
-                    if entity.name == "enemy":
-                        events.append({
-                            "type": "agent_killed",
-                            "agent_id": agent.id,
-                            "messages": "player_killed_by_enemy",
-                        })
-                        agent.state = "dead"
+            if agent.state == "normal" and (agent.x, agent.y) in enemy_positions:
+                events.append({
+                    "type": "agent_killed",
+                    "agent_id": agent.id,
+                    "messages": "player_killed_by_enemy",
+                })
+                agent.state = "dead"
 
         return events
 
@@ -501,11 +794,91 @@ class Simulation:
                 })
 
         # Add the step.
-        observations["step"] = self.simulation_step
+        observations["step"] = self.world_snapshot_step
 
         # Add the inventory.
         observations["inventory"] = [item.name for item in agent.inventory]
 
+        # The bitplanes format delivers the observed window as an array instead of a list of cells.
+        observation_format = self.config["observation"].get("format", "cells")
+        if observation_format == "bitplanes":
+            if self.config["observation"]["mode"] not in ["square", "all"]:
+                raise ValueError("The bitplanes format needs the 'square' or the 'all' observation mode")
+            observations["channels"] = CHANNELS
+            observations["origin"], observations["planes"] = self.compute_agent_planes(agent)
+            return observations
+        elif observation_format != "cells":
+            raise ValueError(f"Invalid observation format: {observation_format}")
+
+        # Get the records of the cells in the observation window. In the fov mode only the visible cells.
+        # The records of a region are shared by the agents that observe the same region.
+        snapshot = self.get_world_snapshot()
+        own_positions = snapshot.get_positions(agent.name)
+        if self.config["observation"]["mode"] == "fov":
+            records = [snapshot.get_record(x, y) for x, y in self.get_field_of_view().get_visible_cells(self.grid, agent.x, agent.y)]
+            own_indices = [index for index, record in enumerate(records) if (record["x"], record["y"]) in own_positions]
+        else:
+            start_x, start_y, end_x, end_y = self.get_observation_window(agent)
+            records = snapshot.get_records(start_x, start_y, end_x, end_y)
+            own_indices = [(x - start_x) * (end_y - start_y) + y - start_y for x, y in own_positions if start_x <= x < end_x and start_y <= y < end_y]
+
+        # Only the cells with the name of the agent have to be changed. The agent does not see itself.
+        if len(own_indices) > 0:
+            records = list(records)
+            for index in own_indices:
+                x, y = records[index]["x"], records[index]["y"]
+                records[index] = {"x": x, "y": y, "elements": snapshot.get_elements_without(x, y, agent.name)}
+
+        # Remember the visible cells. Only they are updated, the observations hold all the explored cells and get the
+        # number of steps since a cell was seen when it is read.
+        if self.config["observation"]["mode"] == "fov" and self.config["observation"].get("memory", False):
+            for record in records:
+                agent.explored[(record["x"], record["y"])] = (snapshot.step, record["elements"])
+            observations["cells"] = RememberedCells(list(agent.explored.items()), snapshot.step, agent.x, agent.y)
+            return observations
+
+        # The agent-relative coordinates are added when the cells are read.
+        observations["cells"] = ObservedCells(records, agent.x, agent.y)
+
+        return observations
+
+
+    def compute_agent_planes(self, agent):
+
+        # The window of the square mode is not clipped. The cells outside of the grid are walls.
+        if self.config["observation"]["mode"] == "square":
+            window_size = self.config["observation"]["grid_size"]
+            origin_x = agent.x - window_size // 2
+            origin_y = agent.y - window_size // 2
+            width = height = window_size
+        else:
+            origin_x, origin_y, width, height = 0, 0, self.grid.width, self.grid.height
+        planes = np.zeros((len(CHANNELS), height, width), dtype=np.uint8)
+        planes[CHANNEL_CODES["wall"]] = 1
+
+        # Copy the walls of the part of the window that is in the grid.
+        start_x, start_y, end_x, end_y = self.get_observation_window(agent)
+        if start_x >= end_x or start_y >= end_y:
+            return {"x": origin_x, "y": origin_y}, planes
+        region = (slice(start_y - origin_y, end_y - origin_y), slice(start_x - origin_x, end_x - origin_x))
+        planes[CHANNEL_CODES["wall"]][region] = self.grid.get_celltype_codes(start_x, start_y, end_x, end_y) == CELL_CODES["wall"]
+
+        # Set the entities. Only the occupied cells are looked at. The agent does not see itself.
+        occupied_y, occupied_x = np.nonzero(self.grid.get_entity_counts(start_x, start_y, end_x, end_y))
+        for x, y in zip((occupied_x + start_x).tolist(), (occupied_y + start_y).tolist()):
+            for entity in self.grid.get_entities_at(x, y):
+                if isinstance(entity, Agent):
+                    channel = CHANNEL_CODES["agent"] if entity is not agent else None
+                else:
+                    channel = CHANNEL_CODES.get(entity.name)
+                if channel is not None:
+                    planes[channel, y - origin_y, x - origin_x] = 1
+
+        return {"x": origin_x, "y": origin_y}, planes
+
+
+    def get_observation_window(self, agent):
+
         # Handle the observation mode.
         if "observation" not in self.config:
             raise ValueError("Missing 'observation' key in simulation config")
@@ -527,47 +900,66 @@ class Simulation:
             start_y = max(0, start_y)
             end_y = agent.y + grid_size // 2 + 1
             end_y = min(self.grid.height, end_y)
-            range_x = range(start_x, end_x)
-            range_y = range(start_y, end_y)
-            cell_coordinates = list(itertools.product(range_x, range_y))
+            return start_x, start_y, end_x, end_y
+
+        # Get the square around the field of view.
+        elif self.config["observation"]["mode"] == "fov":
+            radius = self.get_field_of_view().radius
+            return max(0, agent.x - radius), max(0, agent.y - radius), min(self.grid.width, agent.x + radius + 1), min(self.grid.height, agent.y + radius + 1)
 
         # Get all the cells in the grid.
         elif self.config["observation"]["mode"] == "all":
-            cell_coordinates = list(itertools.product(range(self.grid.width), range(self.grid.height)))
+            return 0, 0, self.grid.width, self.grid.height
 
         # Should not happen.
         else:
             raise ValueError("Invalid observation mode")
-    
-        # Go through all the cells.
-        observations["cells"] = []
-        for x, y in cell_coordinates:
-            elements = []
-            cell_type = self.grid.get_celltype_at(x, y)
-            if cell_type not in ["empty"]:
-                elements.append(cell_type)
-            elements += self.grid.get_entity_names_at(x, y)
-            if agent.name in elements:
-                elements.remove(agent.name)
-            if elements == []:
-                elements = "empty"
-            x_relative = x - agent.x
-            y_relative = y - agent.y
-            observations["cells"].append({
-                "x": x,
-                "y": y,
-                "x_relative": x_relative,
-                "y_relative": y_relative,
-                "elements": elements,
-            })
 
-        return observations
+
+    def get_field_of_view(self):
+        if self.field_of_view is None:
+            if "radius" not in self.config["observation"]:
+                raise ValueError("Missing 'radius' key in observation config")
+            self.field_of_view = FieldOfView(self.config["observation"]["radius"])
+        return self.field_of_view
+
+
+    def stream_chunks(self):
+        # Only procedural grids are streamed.
+        if not isinstance(self.grid, ProceduralGrid):
+            return
+
+        # Load the chunks that the observation windows of the agents reach.
+        keep = set()
+        for agent in self.agents.values():
+            window = self.get_observation_window(agent)
+            keep.update(self.grid.get_chunk_keys(*window))
+            for name, x, y, state in self.grid.load_region(*window):
+                entity = self.entities.add(name, x, y, state)
+                self.grid.add_entity(entity, x, y)
+
+        # Evict the least recently used chunks that no agent observes, with their items.
+        for key in self.grid.get_evictable_chunks(keep):
+            items = [entity for entity in self.grid.get_chunk_entities(key) if isinstance(entity, Item)]
+            for item in items:
+                self.grid.remove_entity(item)
+            self.grid.unload_chunk(key, items)
+            for item in items:
+                self.entities.remove(item)
+
+
+    def get_world_snapshot(self):
+        if self.world_snapshot is None:
+            self.world_snapshot = WorldSnapshot(self.grid, self.world_snapshot_step)
+        return self.world_snapshot
+
 
     def is_finished(self):
 
         # Return true if there is no more gold in the grid and no agent has gold in its inventory.
-        if len([entity for entity in self.entities if entity.name == "gold"]) == 0:
-            if all([len(agent.inventory) == 0 for agent in self.agents.values()]):
+        # The items in the inventories are in the entity store too.
+        if self.entities.count("gold", owned=False) == 0:
+            if self.entities.count(owned=True) == 0:
                 return True
             
         return False
@@ -0,0 +1,182 @@
+import time
+import threading
+
+# The modes of the tick scheduler.
+TICK_MODES = ["fixed_rate", "lockstep", "lockstep_deadline"]
+
+# What happens to the steps that the fixed rate missed.
+LATE_POLICIES = ["skip", "catch_up"]
+
+
+# Decides when the server steps the simulation.
+#   fixed_rate         Steps at a fixed interval. The times of the steps are planned from the first one, so the
+#                      interval does not drift with the time it takes to step. Late steps are counted as overruns.
+#                      The late policy decides what happens to the steps that were missed. With "skip" they are
+#                      dropped and the next step is at the next planned time. With "catch_up" they are stepped
+#                      without waiting, at most max_catch_up_steps of them, then the rest is skipped.
+#   lockstep           Steps as soon as every agent that got observations has responded. Without agents it steps
+#                      at the fixed rate.
+#   lockstep_deadline  Like lockstep, but waits at most deadline_seconds. The agents that missed the deadline
+#                      get the default action, if there is one.
+# In all modes the response latency of each agent is measured, from sending the observations to the response,
+# and the server records the durations of the phases of each tick.
+class TickScheduler:
+
+    def __init__(self, mode="fixed_rate", interval_seconds=1.0, deadline_seconds=1.0, default_action=None, late_policy="skip", max_catch_up_steps=10):
+        if mode not in TICK_MODES:
+            raise ValueError(f"Invalid tick mode: {mode}")
+        if late_policy not in LATE_POLICIES:
+            raise ValueError(f"Invalid late policy: {late_policy}")
+        self.mode = mode
+        self.interval_seconds = interval_seconds
+        self.late_policy = late_policy
+        self.max_catch_up_steps = max_catch_up_steps
+        self.deadline_seconds = deadline_seconds
+        self.default_action = default_action
+
+        # The agents that did not respond to the observations of the current tick yet, and when they got them.
+        self.condition = threading.Condition()
+        self.waiting = set()
+        self.sent_times = {}
+        self.tick_step = None
+        self.tick_time = None
+        self.tick_agents = 0
+
+        # The planned time of the next step in the fixed rate mode and the number of late steps.
+        self.next_step_time = None
+        self.overruns = 0
+        self.skipped_steps = 0
+
+        # The response latencies per agent.
+        self.latencies = {}
+
+        # The durations of the phases of the ticks.
+        self.phases = {}
+
+
+    @staticmethod
+    def from_config(config, mode=None):
+        # Create a scheduler from the "tick" part of a simulation config. The mode can be overridden.
+        # The interval is the update interval of the simulation, unless the tick config has one.
+        tick_config = config.get("tick", {})
+        return TickScheduler(
+            mode=mode or tick_config.get("mode", "fixed_rate"),
+            interval_seconds=tick_config.get("interval_seconds", config.get("update_interval_seconds", 1.0)),
+            deadline_seconds=tick_config.get("deadline_seconds", 1.0),
+            default_action=tick_config.get("default_action"),
+            late_policy=tick_config.get("late_policy", "skip"),
+            max_catch_up_steps=tick_config.get("max_catch_up_steps", 10),
+        )
+
+
+    def start_tick(self, agent_ids, step=None):
+        # Call when the observations of a step were sent to the agents.
+        with self.condition:
+            self.tick_step = step
+            self.tick_time = time.monotonic()
+            self.waiting = set(agent_ids)
+            self.tick_agents = len(self.waiting)
+            self.sent_times = {agent_id: self.tick_time for agent_id in self.waiting}
+
+
+    def on_response(self, agent_id, step=None):
+        # Responses to the observations of an earlier step do not count for the current tick.
+        with self.condition:
+            if step is not None and self.tick_step is not None and step != self.tick_step:
+                return
+            sent_time = self.sent_times.pop(agent_id, None)
+            if sent_time is not None:
+                latency = time.monotonic() - sent_time
+                statistics = self.get_latency(agent_id)
+                statistics["responses"] += 1
+                statistics["total_seconds"] += latency
+                statistics["max_seconds"] = max(statistics["max_seconds"], latency)
+                statistics["last_seconds"] = latency
+            self.waiting.discard(agent_id)
+            if len(self.waiting) == 0:
+                self.condition.notify_all()
+
+
+    def get_latency(self, agent_id):
+        if agent_id not in self.latencies:
+            self.latencies[agent_id] = {"responses": 0, "missed": 0, "total_seconds": 0.0, "max_seconds": 0.0, "last_seconds": 0.0}
+        return self.latencies[agent_id]
+
+
+    def remove_agent(self, agent_id):
+        # Call when an agent disconnects, so that the lockstep does not wait for it.
+        with self.condition:
+            self.waiting.discard(agent_id)
+            self.sent_times.pop(agent_id, None)
+            if len(self.waiting) == 0:
+                self.condition.notify_all()
+
+
+    def wait(self, sleep=time.sleep):
+        # Blocks until the next step is due. Returns the agents that missed the deadline.
+        if self.mode == "fixed_rate" or self.tick_agents == 0:
+            now = time.monotonic()
+            if self.next_step_time is None:
+                self.next_step_time = now + self.interval_seconds
+            if now <= self.next_step_time:
+                sleep(self.next_step_time - now)
+                self.next_step_time += self.interval_seconds
+                return []
+
+            # The step is late. Find the planned time of the next step that can still be made.
+            self.overruns += 1
+            missed = int((now - self.next_step_time) / self.interval_seconds)
+            if self.late_policy == "catch_up" and missed < self.max_catch_up_steps:
+                self.next_step_time += self.interval_seconds
+            else:
+                self.skipped_steps += missed
+                self.next_step_time += (missed + 1) * self.interval_seconds
+            return []
+
+        # Wait for the responses, with the deadline if there is one.
+        with self.condition:
+            timeout = None
+            if self.mode == "lockstep_deadline" and self.tick_time is not None:
+                timeout = max(0.0, self.tick_time + self.deadline_seconds - time.monotonic())
+            self.condition.wait_for(lambda: len(self.waiting) == 0, timeout)
+            missed = sorted(self.waiting)
+            for agent_id in missed:
+                statistics = self.get_latency(agent_id)
+                statistics["missed"] += 1
+            self.waiting = set()
+            self.next_step_time = None
+            return missed
+
+
+    def record_phases(self, durations):
+        # Records the durations of the phases of a tick in seconds, by the name of the phase.
+        for name, duration in durations.items():
+            statistics = self.phases.setdefault(name, {"ticks": 0, "total_seconds": 0.0, "max_seconds": 0.0, "last_seconds": 0.0})
+            statistics["ticks"] += 1
+            statistics["total_seconds"] += duration
+            statistics["max_seconds"] = max(statistics["max_seconds"], duration)
+            statistics["last_seconds"] = duration
+
+
+    def get_stats(self):
+        # Returns the mode, the number of overruns and skipped steps, the response latencies per agent
+        # and the durations of the phases in milliseconds.
+        phases = {}
+        for name, statistics in list(self.phases.items()):
+            phases[name] = {
+                "mean_ms": 1000 * statistics["total_seconds"] / statistics["ticks"],
+                "max_ms": 1000 * statistics["max_seconds"],
+                "last_ms": 1000 * statistics["last_seconds"],
+            }
+        with self.condition:
+            agents = {}
+            for agent_id, statistics in self.latencies.items():
+                responses = statistics["responses"]
+                agents[agent_id] = {
+                    "responses": responses,
+                    "missed": statistics["missed"],
+                    "mean_ms": 1000 * statistics["total_seconds"] / responses if responses > 0 else None,
+                    "max_ms": 1000 * statistics["max_seconds"],
+                    "last_ms": 1000 * statistics["last_seconds"],
+                }
+            return {"mode": self.mode, "overruns": self.overruns, "skipped_steps": self.skipped_steps, "agents": agents, "phases": phases}
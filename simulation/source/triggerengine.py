@@ -0,0 +1,103 @@
+import re
+import heapq
+import operator
+from .agent import Agent
+
+# The comparisons of the count conditions.
+COMPARISONS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    ">=": operator.ge,
+    ">": operator.gt,
+}
+COUNT_CONDITION = re.compile(r"^count:(\w+)(<=|>=|==|<|>)(\d+)$")
+
+
+def parse_condition(when):
+    # Parses the condition of a trigger. Returns ("count", name, comparison, value), ("cell", (x, y)) or ("step", step).
+    #   no:<name>              There are no entities with the name in the grid.
+    #   count:<name><op><n>    The number of entities with the name compares to n. The op is <, <=, ==, >= or >.
+    #   agent_at:<x>,<y>       An agent is on the cell.
+    #   step:<n>               The simulation reached the step.
+    if when is None:
+        raise ValueError("Invalid trigger condition")
+    if when.startswith("no:"):
+        return "count", when.split(":")[1], operator.eq, 0
+    match = COUNT_CONDITION.match(when)
+    if match is not None:
+        return "count", match.group(1), COMPARISONS[match.group(2)], int(match.group(3))
+    if when.startswith("agent_at:"):
+        x, y = when.split(":")[1].split(",")
+        return "cell", (int(x), int(y))
+    if when.startswith("step:"):
+        return "step", int(when.split(":")[1])
+    raise ValueError(f"Invalid trigger condition: {when}")
+
+
+# Decides which triggers fire without going through all of them on every step. The count conditions are
+# only checked when the number of entities with their name changed, the agent conditions only when an entity
+# entered their cell and the step conditions are kept sorted by step. The grid keeps the numbers of entities
+# per name and records the watched cells that entities entered.
+class TriggerEngine:
+
+    def __init__(self, triggers, grid):
+        self.triggers = list(triggers)
+        self.grid = grid
+        self.active = set(range(len(self.triggers)))
+
+        # Index the triggers by what they watch.
+        self.count_watchers = {}
+        self.cell_watchers = {}
+        self.step_watchers = []
+        for index, trigger in enumerate(self.triggers):
+            if trigger.get("frequency") != "once":
+                raise ValueError(f"Invalid trigger frequency {trigger.get('frequency')}")
+            condition = parse_condition(trigger.get("when"))
+            if condition[0] == "count":
+                self.count_watchers.setdefault(condition[1], []).append((index, condition[2], condition[3]))
+            elif condition[0] == "cell":
+                self.cell_watchers.setdefault(condition[1], []).append(index)
+            else:
+                heapq.heappush(self.step_watchers, (condition[1], index))
+
+        # The last numbers of entities of the watched names. All conditions are checked on the first update.
+        self.counts = {}
+        grid.watched_cells = set(self.cell_watchers)
+        grid.entered_cells = set(self.cell_watchers)
+
+
+    def get_triggers(self):
+        # Returns the triggers that did not fire yet, in their order.
+        return [trigger for index, trigger in enumerate(self.triggers) if index in self.active]
+
+
+    def update(self, step):
+        # Returns the triggers that fire, in their order. They are removed from the engine.
+        fired = set()
+
+        # The count conditions of the names whose number of entities changed.
+        for name, watchers in self.count_watchers.items():
+            count = self.grid.count_entities(name)
+            if count == self.counts.get(name):
+                continue
+            self.counts[name] = count
+            for index, comparison, value in watchers:
+                if comparison(count, value):
+                    fired.add(index)
+
+        # The agent conditions of the cells that entities entered.
+        grid = self.grid
+        if len(grid.entered_cells) > 0:
+            for position in grid.entered_cells:
+                if any(isinstance(entity, Agent) for entity in grid.get_entities_at(*position)):
+                    fired.update(self.cell_watchers[position])
+            grid.entered_cells.clear()
+
+        # The step conditions that are due.
+        while len(self.step_watchers) > 0 and self.step_watchers[0][0] <= step:
+            fired.add(heapq.heappop(self.step_watchers)[1])
+
+        fired &= self.active
+        self.active -= fired
+        return [self.triggers[index] for index in sorted(fired)]
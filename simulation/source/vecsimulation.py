@@ -0,0 +1,218 @@
+import os
+import json
+import numpy as np
+from .layoutgenerator import LayoutGenerator
+from .bitplanes import CHANNELS
+
+# The actions as integer codes. The code 0 is the none action, it does nothing but counts as an action.
+ACTIONS = ["none", "up", "down", "left", "right", "pickup", "drop"]
+ACTION_CODES = {action: code for code, action in enumerate(ACTIONS)}
+ACTION_DX = np.array([0, 0, 0, -1, 1, 0, 0])
+ACTION_DY = np.array([0, 1, -1, 0, 0, 0, 0])
+
+# The item types, in the order of the item channels, between the walls and the agents.
+ITEMS = CHANNELS[1:-1]
+ITEM_CODES = {item: code for code, item in enumerate(ITEMS)}
+
+# Maps layout characters to item codes. Every other character is no item.
+LAYOUT_ITEM_CODES = np.full(256, -1, dtype=np.int8)
+for character, item in [("G", "gold"), ("T", "trove"), ("E", "enemy"), ("D", "door"), ("S", "staircase"), ("K", "key")]:
+    LAYOUT_ITEM_CODES[ord(character)] = ITEM_CODES[item]
+
+
+# Holds K independent worlds of the same size in stacked arrays and steps all of them at once.
+# The semantics follow Simulation.update(): movement with walls and doors blocking, pickup of gold,
+# dropping gold into a trove or onto a cell without items, enemies killing agents and triggers of the
+# form no:<item> with remove:<item>. Finished worlds are reset automatically.
+class VecSimulation:
+
+    def __init__(self, config, num_worlds, seed=None, max_steps=1000):
+
+        # If config is a file, load it with json.
+        if isinstance(config, str) and os.path.exists(config):
+            with open(config) as f:
+                config = json.load(f)
+        if not isinstance(config, dict):
+            raise ValueError("Invalid simulation config")
+
+        self.config = config
+        self.num_worlds = num_worlds
+        self.num_agents = len(config["agents"])
+        self.max_steps = max_steps
+        self.random = np.random.default_rng(seed)
+
+        # Get the size of the worlds from the layouts.
+        characters = self.create_layouts(num_worlds)
+        self.height = characters.shape[1]
+        self.width = characters.shape[2]
+
+        # The state of the worlds.
+        shape = (num_worlds, self.height, self.width)
+        self.walls = np.zeros(shape, dtype=bool)
+        self.items = np.zeros((num_worlds, len(ITEMS), self.height, self.width), dtype=np.int16)
+        self.agent_x = np.zeros((num_worlds, self.num_agents), dtype=np.int64)
+        self.agent_y = np.zeros((num_worlds, self.num_agents), dtype=np.int64)
+        self.alive = np.zeros((num_worlds, self.num_agents), dtype=bool)
+        self.inventory = np.zeros((num_worlds, self.num_agents), dtype=np.int32)
+        self.score = np.zeros((num_worlds, self.num_agents), dtype=np.int32)
+        self.action_count = np.zeros((num_worlds, self.num_agents), dtype=np.int32)
+        self.steps = np.zeros(num_worlds, dtype=np.int64)
+
+        # The triggers. The conditions and removals are item codes, the positions are masks.
+        self.triggers = config.get("triggers", [])
+        self.trigger_conditions = np.zeros(len(self.triggers), dtype=np.int64)
+        self.trigger_removals = np.zeros(len(self.triggers), dtype=np.int64)
+        self.trigger_masks = np.zeros((len(self.triggers), self.height, self.width), dtype=bool)
+        for trigger_index, trigger in enumerate(self.triggers):
+            if not trigger["when"].startswith("no:"):
+                raise ValueError("Invalid trigger condition")
+            if not trigger["type"].startswith("remove:"):
+                raise ValueError(f"Invalid trigger type: {trigger['type']}")
+            if trigger.get("frequency") != "once":
+                raise ValueError(f"Invalid trigger frequency {trigger.get('frequency')}")
+            self.trigger_conditions[trigger_index] = ITEM_CODES[trigger["when"].split(":")[1]]
+            self.trigger_removals[trigger_index] = ITEM_CODES[trigger["type"].split(":")[1]]
+            for x, y in trigger["positions"]:
+                self.trigger_masks[trigger_index, y, x] = True
+        self.trigger_active = np.zeros((num_worlds, len(self.triggers)), dtype=bool)
+
+        # Load the worlds.
+        for world in range(num_worlds):
+            self.load_world(world, characters[world])
+
+
+    def create_layouts(self, count):
+        # Returns the layout characters of count worlds as a (count, height, width) array.
+
+        # Custom layouts are stored top row first.
+        if self.config["grid"]["type"] == "custom":
+            rows = [row.replace(" ", "") for row in self.config["grid"]["layout"][::-1]]
+            if len(set(len(row) for row in rows)) != 1:
+                raise ValueError("All rows in the grid must have the same width")
+            characters = np.frombuffer("".join(rows).encode("ascii"), dtype=np.uint8).reshape(len(rows), len(rows[0]))
+            return np.broadcast_to(characters, (count,) + characters.shape)
+
+        # Generate a batch of layouts with the random number generator.
+        parameters = dict(self.config["grid"]["parameters"])
+        parameters["seed"] = self.random
+        return LayoutGenerator.generate_arrays(count, **parameters)
+
+
+    def load_world(self, world, characters):
+
+        # Set the walls and the items.
+        self.walls[world] = characters == ord("X")
+        item_codes = LAYOUT_ITEM_CODES[characters]
+        self.items[world] = item_codes[None, :, :] == np.arange(len(ITEMS))[:, None, None]
+
+        # Set the agents in the order in which they appear in the layout.
+        agent_y, agent_x = np.nonzero((characters == ord("1")) | (characters == ord("2")))
+        if len(agent_x) < self.num_agents:
+            raise ValueError("The layout has less agent positions than agents")
+        self.agent_x[world] = agent_x[:self.num_agents]
+        self.agent_y[world] = agent_y[:self.num_agents]
+        self.alive[world] = True
+        self.inventory[world] = 0
+        self.score[world] = 0
+        self.action_count[world] = 0
+        self.steps[world] = 0
+        self.trigger_active[world] = True
+
+
+    def reset(self):
+        characters = self.create_layouts(self.num_worlds)
+        for world in range(self.num_worlds):
+            self.load_world(world, characters[world])
+        return self.get_observations()
+
+
+    def step(self, actions):
+        actions = np.asarray(actions, dtype=np.int64)
+        if actions.shape != (self.num_worlds, self.num_agents):
+            raise ValueError(f"Invalid actions shape {actions.shape}, expected {(self.num_worlds, self.num_agents)}")
+        if actions.min() < 0 or actions.max() >= len(ACTIONS):
+            raise ValueError("Invalid action code")
+        score_before = self.score.copy()
+        worlds = np.arange(self.num_worlds)
+
+        # The agents act one after the other, in a random order per world. All worlds at once.
+        order = np.argsort(self.random.random((self.num_worlds, self.num_agents)), axis=1)
+        for agent_slot in range(self.num_agents):
+            agents = order[:, agent_slot]
+            action = actions[worlds, agents]
+            # Every action of a living agent counts, also "none", like in Simulation.perform_agent_action.
+            alive = self.alive[worlds, agents]
+            self.action_count[worlds, agents] += alive
+            active = alive & (action != ACTION_CODES["none"])
+            x = self.agent_x[worlds, agents]
+            y = self.agent_y[worlds, agents]
+
+            # Handle movement actions. Walls and doors are blocking.
+            new_x = x + ACTION_DX[action]
+            new_y = y + ACTION_DY[action]
+            inside = (new_x >= 0) & (new_x < self.width) & (new_y >= 0) & (new_y < self.height)
+            clipped_x = np.clip(new_x, 0, self.width - 1)
+            clipped_y = np.clip(new_y, 0, self.height - 1)
+            free = inside & ~self.walls[worlds, clipped_y, clipped_x] & (self.items[worlds, ITEM_CODES["door"], clipped_y, clipped_x] == 0)
+            move = active & ((new_x != x) | (new_y != y)) & free
+            self.agent_x[worlds, agents] = np.where(move, new_x, x)
+            self.agent_y[worlds, agents] = np.where(move, new_y, y)
+
+            # Handle pickup actions.
+            pickup = active & (action == ACTION_CODES["pickup"]) & (self.items[worlds, ITEM_CODES["gold"], y, x] > 0)
+            self.items[worlds[pickup], ITEM_CODES["gold"], y[pickup], x[pickup]] -= 1
+            self.inventory[worlds, agents] += pickup
+
+            # Handle drop actions. Into a trove for a point or onto a cell without items.
+            drop = active & (action == ACTION_CODES["drop"]) & (self.inventory[worlds, agents] > 0)
+            into_trove = drop & (self.items[worlds, ITEM_CODES["trove"], y, x] > 0)
+            onto_cell = drop & ~into_trove & (self.items[worlds, :, y, x].sum(axis=1) == 0)
+            self.inventory[worlds, agents] -= into_trove | onto_cell
+            self.score[worlds, agents] += into_trove
+            self.items[worlds[onto_cell], ITEM_CODES["gold"], y[onto_cell], x[onto_cell]] += 1
+
+        # Handle the triggers in order. A trigger fires once when there are no items of its condition left.
+        for trigger_index in range(len(self.triggers)):
+            counts = self.items[:, self.trigger_conditions[trigger_index]].sum(axis=(1, 2))
+            fired = self.trigger_active[:, trigger_index] & (counts == 0)
+            removal = self.trigger_removals[trigger_index]
+            self.items[fired, removal] = np.where(self.trigger_masks[trigger_index], 0, self.items[fired, removal])
+            self.trigger_active[fired, trigger_index] = False
+
+        # If an agent is on the same cell as an enemy, the agent is killed.
+        on_enemy = self.items[worlds[:, None], ITEM_CODES["enemy"], self.agent_y, self.agent_x] > 0
+        self.alive &= ~on_enemy
+
+        # Compute the rewards and the done flags.
+        self.steps += 1
+        rewards = (self.score - score_before).astype(np.float32)
+        no_gold = (self.items[:, ITEM_CODES["gold"]].sum(axis=(1, 2)) == 0) & (self.inventory.sum(axis=1) == 0)
+        dones = no_gold | ~self.alive.any(axis=1) | (self.steps >= self.max_steps)
+
+        # Reset the finished worlds.
+        finished_worlds = np.flatnonzero(dones)
+        if len(finished_worlds) > 0:
+            characters = self.create_layouts(len(finished_worlds))
+            for world, world_characters in zip(finished_worlds, characters):
+                self.load_world(world, world_characters)
+
+        return self.get_observations(), rewards, dones
+
+
+    def get_observations(self):
+
+        # The walls and items as planes.
+        planes = np.zeros((self.num_worlds, len(CHANNELS), self.height, self.width), dtype=np.uint8)
+        planes[:, CHANNELS.index("wall")] = self.walls
+        planes[:, 1:1 + len(ITEMS)] = self.items > 0
+
+        # The alive agents.
+        worlds, agents = np.nonzero(self.alive)
+        planes[worlds, CHANNELS.index("agent"), self.agent_y[worlds, agents], self.agent_x[worlds, agents]] = 1
+
+        return {
+            "planes": planes,
+            "positions": np.stack([self.agent_x, self.agent_y], axis=-1),
+            "inventory": self.inventory.copy(),
+            "alive": self.alive.copy(),
+        }
@@ -0,0 +1,144 @@
+import itertools
+from collections.abc import Sequence
+from .grid import CELL_TYPES, CELL_CODES
+
+
+# An immutable view of the world at one simulation step. It is built once per step and shared by the
+# observations of all the agents. The records of the cells, with the coordinates and the elements, are
+# computed once and then reused, so the observations only have to add the agent-relative fields when
+# they are read. The records and the element lists are shared between the observations and must not be modified.
+class WorldSnapshot:
+
+    def __init__(self, grid, step):
+        self.step = step
+        self.width = grid.width
+        self.height = grid.height
+        self.get_celltype_code = grid.get_celltype_code
+
+        # The elements of cells without entities, per cell code.
+        self.static_elements = ["empty" if code == CELL_CODES["empty"] else [cell_type] for code, cell_type in enumerate(CELL_TYPES)]
+
+        # Copy the entity names of the occupied cells and the positions per entity name.
+        self.entity_names = {position: [entity.name for entity in entities] for position, entities in grid.get_occupied_cells()}
+        self.positions_by_name = {name: frozenset(positions) for name, positions in grid.positions_by_name.items()}
+
+        # The cached records and regions.
+        self.records = {}
+        self.regions = {}
+
+
+    def get_positions(self, name):
+        return self.positions_by_name.get(name, frozenset())
+
+
+    def get_record(self, x, y):
+        record = self.records.get((x, y))
+        if record is None:
+            code = self.get_celltype_code(x, y)
+            entity_names = self.entity_names.get((x, y))
+            if entity_names is None:
+                elements = self.static_elements[code]
+            elif code == CELL_CODES["empty"]:
+                elements = entity_names
+            else:
+                elements = [CELL_TYPES[code]] + entity_names
+            record = {"x": x, "y": y, "elements": elements}
+            self.records[(x, y)] = record
+        return record
+
+
+    def get_elements(self, x, y):
+        return self.get_record(x, y)["elements"]
+
+
+    def get_elements_without(self, x, y, name):
+        # Get the elements of a cell without one entity with the given name. Used to hide the observing agent.
+        elements = self.get_elements(x, y)
+        if elements == "empty" or name not in elements:
+            return elements
+        elements = list(elements)
+        elements.remove(name)
+        if elements == []:
+            elements = "empty"
+        return elements
+
+
+    def get_records(self, start_x, start_y, end_x, end_y):
+        # Get the records of all the cells in a region. Column by column.
+        region = (start_x, start_y, end_x, end_y)
+        records = self.regions.get(region)
+        if records is None:
+            records = [self.get_record(x, y) for x, y in itertools.product(range(start_x, end_x), range(start_y, end_y))]
+            self.regions[region] = records
+        return records
+
+
+# The cells of the observations of one agent. It holds the shared records of the cells and adds the
+# coordinates relative to the agent when a cell is read, so the observations of many agents do not
+# allocate a dictionary per cell and step. Reading a cell returns a new dictionary. Use list() to get
+# the cells as a list of dictionaries, for example to serialize them.
+class ObservedCells(Sequence):
+
+    def __init__(self, records, x, y):
+        self.records = records
+        self.x = x
+        self.y = y
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.get_cell(record) for record in self.records[index]]
+        return self.get_cell(self.records[index])
+
+
+    def __iter__(self):
+        return map(self.get_cell, self.records)
+
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return list(self) == list(other)
+
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+    def get_cell(self, record):
+        cell = {
+            "x": record["x"],
+            "y": record["y"],
+            "x_relative": record["x"] - self.x,
+            "y_relative": record["y"] - self.y,
+            "elements": record["elements"],
+        }
+        if "staleness" in record:
+            cell["staleness"] = record["staleness"]
+        return cell
+
+
+# The cells of the observations of one agent in the fov memory mode. It holds the explored cells of the agent as
+# ((x, y), (seen_step, elements)) and derives the staleness from the step when a cell is read. The visible cells
+# were seen in the step, so their staleness is 0.
+class RememberedCells(ObservedCells):
+
+    def __init__(self, explored, step, x, y):
+        super().__init__(explored, x, y)
+        self.step = step
+
+
+    def get_cell(self, record):
+        (x, y), (seen_step, elements) = record
+        return {
+            "x": x,
+            "y": y,
+            "x_relative": x - self.x,
+            "y_relative": y - self.y,
+            "elements": elements,
+            "staleness": self.step - seen_step,
+        }
@@ -0,0 +1,14 @@
+import os
+import sys
+import pytest
+
+# The tests import the simulation like run.py does, from the simulation directory.
+SIMULATION_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SIMULATION_DIRECTORY)
+
+
+# The compiled levels are cached in a temporary directory, not in the cache of the user.
+@pytest.fixture(autouse=True)
+def level_cache_directory(tmp_path, monkeypatch):
+    monkeypatch.setenv("GRID_LEVEL_CACHE_DIR", str(tmp_path / "levels"))
+    return tmp_path / "levels"
@@ -0,0 +1,61 @@
+import os
+import numpy as np
+from source.grid import Grid
+from source.chunkedgrid import ChunkedGrid
+from source.entitystore import EntityStore
+from source import levelcompiler
+
+
+def index_of(grid):
+    cells = sorted((position, sorted(entity.name for entity in entities)) for position, entities in grid.get_occupied_cells())
+    positions = {name: dict(positions) for name, positions in grid.positions_by_name.items() if len(positions) > 0}
+    return cells, positions, dict(grid.name_counts), grid.get_entity_counts(0, 0, grid.width, grid.height).tolist()
+
+
+def test_add_entities_equals_add_entity():
+    # Twice the same entities, so the second call has to add to occupied cells. A cell also gets two at once.
+    names = ["gold", "trove"]
+    xs = np.array([1, 2, 1, 7], dtype=np.int32)
+    ys = np.array([1, 1, 1, 6], dtype=np.int32)
+    codes = np.array([0, 0, 1, 0], dtype=np.uint8)
+    cells = np.zeros((8, 9), dtype=np.uint8)
+    for create_grid in [lambda: Grid.from_cells(cells), lambda: ChunkedGrid.from_cells(cells, 4)]:
+        bulk = create_grid()
+        store = EntityStore()
+        for _ in range(2):
+            bulk.add_entities(store.extend(names, codes, xs, ys), xs, ys, codes, names)
+        single = create_grid()
+        store = EntityStore()
+        for _ in range(2):
+            for item, x, y in zip(store.extend(names, codes, xs, ys), xs.tolist(), ys.tolist()):
+                single.add_entity(item, x, y)
+        assert index_of(bulk) == index_of(single)
+
+
+def test_chunked_grid_from_cells():
+    # Random cells with a wall block and an empty block, on a size that is not a multiple of the chunk size.
+    random = np.random.default_rng(0)
+    cells = (random.random((30, 23)) < 0.3).astype(np.uint8)
+    cells[0:8, 0:8] = 1
+    cells[8:16, 8:16] = 0
+    cells[24:, 16:] = 1
+    grid = ChunkedGrid.from_cells(cells, 8)
+    assert np.array_equal(grid.get_celltype_codes(0, 0, 23, 30), cells)
+    assert grid.static_chunks[(0, 0)] is grid.uniform_chunks[1]
+    assert (1, 1) not in grid.static_chunks
+    assert grid.static_chunks[(2, 3)] is not grid.uniform_chunks[1]
+
+
+def test_level_cache_key_covers_the_version_and_the_entity_types(level_cache_directory, monkeypatch):
+    layout = ["XXXXX", "X1GTX", "XXXXX"]
+    levelcompiler.LevelCache().load_or_compile(layout)
+    levelcompiler.LevelCache().load_or_compile(layout)
+    assert len(os.listdir(level_cache_directory)) == 1
+
+    # Another version or other entity types compile the level again.
+    monkeypatch.setattr(levelcompiler, "VERSION", levelcompiler.VERSION + 1)
+    levelcompiler.LevelCache().load_or_compile(layout)
+    assert len(os.listdir(level_cache_directory)) == 2
+    monkeypatch.setattr(levelcompiler, "ENTITY_TYPES", levelcompiler.ENTITY_TYPES + ["other"])
+    levelcompiler.LevelCache().load_or_compile(layout)
+    assert len(os.listdir(level_cache_directory)) == 3
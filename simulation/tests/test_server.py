@@ -0,0 +1,59 @@
+import os
+import asyncio
+import threading
+import run
+from conftest import SIMULATION_DIRECTORY
+
+
+# A server in lockstep mode with one socket client, whose emit is replaced by the given function.
+def create_server(emit):
+    server = run.Server(os.path.join(SIMULATION_DIRECTORY, "simulations", "simulation.json"), tick_mode="lockstep")
+    server.socketio.emit = emit
+    server.add_client("agent1", "sid1")
+    return server
+
+
+def test_response_during_emit_counts_for_the_tick():
+    # The client answers synchronously while its message is emitted, before the tick would have started.
+    def emit(event, message, room=None):
+        server.add_response({"id": message["id"], "response": {"action": "none"}, "step": message["observations"]["step"]})
+
+    server = create_server(emit)
+    for _ in range(3):
+        server.tick()
+        assert server.scheduler.waiting == set()
+        assert server.scheduler.wait() == []
+    assert server.scheduler.get_stats()["agents"]["agent1"]["responses"] == 3
+
+
+def test_async_responses_are_added_in_the_simulation_thread():
+    server = run.AsyncServer(os.path.join(SIMULATION_DIRECTORY, "simulations", "simulation.json"))
+    threads = []
+    add_action = server.simulation.add_action
+    def record_thread(*args):
+        threads.append(threading.current_thread())
+        add_action(*args)
+    server.simulation.add_action = record_thread
+    simulation_thread = server.executor.submit(threading.current_thread).result()
+
+    asyncio.run(server.handle_response("sid1", {"id": "agent1", "response": {"action": "none"}, "step": 0}))
+    assert threads == [simulation_thread]
+    server.executor.shutdown()
+
+
+def test_checkpointer_is_closed_on_reset_and_shutdown(tmp_path):
+    server = run.Server(os.path.join(SIMULATION_DIRECTORY, "simulations", "simulation.json"), checkpoint_dir=str(tmp_path), checkpoint_interval=0.0)
+    server.prepare_messages()
+    checkpointer = server.checkpointer
+
+    # A finished simulation is replaced, the checkpoints of the old one are written first.
+    server.simulation.is_finished = lambda: True
+    server.prepare_messages()
+    assert not checkpointer.thread.is_alive()
+    assert server.checkpointer is not checkpointer
+
+    # Closing the server writes the checkpoint of the new simulation. It replaces the one of the old simulation.
+    checkpointer = server.checkpointer
+    server.close()
+    assert not checkpointer.thread.is_alive()
+    assert run.Checkpointer.list_checkpoints(str(tmp_path)) == [(1, "full")]
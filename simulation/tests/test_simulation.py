@@ -0,0 +1,121 @@
+import copy
+import random
+import pytest
+import numpy as np
+from source.simulation import Simulation
+from source.vecsimulation import VecSimulation, ACTIONS
+from source.checkpointer import Checkpointer
+from source.entitystore import EntityStore
+
+
+def create_config(observation, action_resolution="sequential"):
+    return {
+        "grid": {"type": "random", "parameters": {"seed": 3, "width": 20, "height": 20, "obstacle_density": 0.2, "gold_density": 0.1, "agents": 2}},
+        "agents": [{"identifier": "a", "name": "red"}, {"identifier": "b", "name": "blue"}],
+        "observation": observation,
+        "action_resolution": action_resolution,
+        "seed": 5,
+    }
+
+
+def run(simulation, seed, steps):
+    # Steps with random actions and returns the observations of every step.
+    generator = random.Random(seed)
+    observations = []
+    for _ in range(steps):
+        for agent_id in ["a", "b"]:
+            simulation.add_action(agent_id, {"action": generator.choice(["up", "down", "left", "right", "pickup", "drop", "none"])})
+        simulation.step()
+        observations.append([list(simulation.get_agent_observations(agent_id)["cells"]) for agent_id in ["a", "b"]])
+    return observations
+
+
+def test_fov_memory_survives_restore_and_checkpoint(tmp_path):
+    simulation = Simulation(create_config({"mode": "fov", "radius": 3, "memory": True}))
+    run(simulation, 1, 30)
+    state = simulation.snapshot()
+    checkpointer = Checkpointer(str(tmp_path), full_interval=1)
+    checkpointer.checkpoint(simulation)
+    checkpointer.close()
+    expected = run(simulation, 2, 30)
+
+    # Restore the snapshot into the same simulation.
+    simulation.restore(state)
+    assert run(simulation, 2, 30) == expected
+
+    # Resume from the checkpoint in a new simulation.
+    static, state = Checkpointer.load_latest(str(tmp_path))
+    resumed = Simulation(static)
+    resumed.restore(state)
+    assert run(resumed, 2, 30) == expected
+
+
+def create_batched_config():
+    # A small level with gold on every free cell and a trove, so that the agents pick up and drop.
+    layout = ["XXXXXXXX", "X1GGGGGX", "XGGGXGGX", "XGGTGG2X", "XGGGGGGX", "XXXXXXXX"]
+    return {
+        "grid": {"type": "custom", "layout": layout},
+        "agents": [{"identifier": "a", "name": "red"}, {"identifier": "b", "name": "blue"}],
+        "observation": {"mode": "square", "grid_size": 5},
+        "action_resolution": "batched",
+        "seed": 5,
+    }
+
+
+def test_batched_fork_matches_restore():
+    simulation = Simulation(create_batched_config())
+    run(simulation, 1, 10)
+    state = simulation.snapshot()
+
+    # The fork and the simulation it was forked from run different actions.
+    fork = simulation.fork()
+    expected_fork = run(fork, 2, 30)
+    expected = run(simulation, 3, 30)
+    assert expected_fork != expected
+
+    # Both match a simulation restored from the state at the fork.
+    restored = Simulation(create_batched_config())
+    restored.restore(state)
+    assert run(restored, 2, 30) == expected_fork
+    restored.restore(state)
+    assert run(restored, 3, 30) == expected
+
+
+def test_removed_item_does_not_alias_the_next_item():
+    store = EntityStore()
+    item = store.add("gold", 1, 2)
+    store.remove(item)
+    other = store.add("key", 3, 4)
+    assert other.uid == item.uid
+    with pytest.raises(ValueError):
+        item.x
+    with pytest.raises(ValueError):
+        item.owner = "a"
+    assert (other.x, other.y, other.owner) == (3, 4, None)
+
+    # A fork translates the items it shares to its own views of the same rows.
+    fork = store.fork()
+    assert fork.get_item(other.uid).x == 3
+    store.remove(other)
+    assert fork.get_item(other.uid).x == 3
+
+
+def test_vec_simulation_counts_actions_like_the_simulation():
+    # One agent next to an enemy, so that it can die and stop acting.
+    config = {
+        "grid": {"type": "custom", "layout": ["X X X X X X", "X . E . . X", "X . X X . X", "X . . . . X", "X 1 G T . X", "X X X X X X"]},
+        "agents": [{"identifier": "a", "name": "red"}],
+        "observation": {"mode": "all"},
+    }
+    generator = random.Random(4)
+    for episode in range(20):
+        simulation = Simulation(copy.deepcopy(config))
+        vec_simulation = VecSimulation(copy.deepcopy(config), 1, seed=episode, max_steps=1000)
+        for _ in range(30):
+            action = generator.randrange(len(ACTIONS))
+            simulation.add_action("a", {"action": ACTIONS[action]})
+            simulation.step()
+            _, _, dones = vec_simulation.step(np.array([[action]]))
+            if dones[0]:
+                break
+            assert vec_simulation.action_count[0, 0] == simulation.get_agent("a").action_count